@@ -0,0 +1,134 @@
+import collections
+import logging
+import math
+import time
+
+class Node(object):
+  def __init__(self, name, start_time):
+    self.name = name
+    # Time the node was created, in seconds since the epoch.
+    self.start_time = start_time
+
+  def __repr__(self):
+    return "Node(%s, %d)" % (self.name, self.start_time)
+
+class Provider(object):
+  """Interface to the cloud provider's pool of slave nodes."""
+
+  def list_nodes(self):
+    """Return the nodes in the pool, including those still booting."""
+    raise NotImplementedError()
+
+  def grow_to(self, num_nodes):
+    """Grow the pool to 'num_nodes' nodes, counting those still booting.
+    Asking for a size the pool already has, or is growing to, adds none."""
+    raise NotImplementedError()
+
+  def remove_nodes(self, names):
+    raise NotImplementedError()
+
+class SimulatedProvider(Provider):
+  """In-memory pool for offline testing, which also totals up what its
+  nodes would have been billed."""
+
+  def __init__(self, clock, billing_minimum_secs=600, billing_period_secs=60):
+    self.clock = clock
+    self.billing_minimum_secs = billing_minimum_secs
+    self.billing_period_secs = billing_period_secs
+    self.nodes = {}
+    self.next_id = 0
+    self.billed_secs = 0
+
+  def list_nodes(self):
+    return sorted(self.nodes.values(), key=lambda n: n.name)
+
+  def grow_to(self, num_nodes):
+    for _ in xrange(num_nodes - len(self.nodes)):
+      name = "sim-%d" % self.next_id
+      self.next_id += 1
+      self.nodes[name] = Node(name, self.clock())
+
+  def remove_nodes(self, names):
+    for name in names:
+      node = self.nodes.pop(name)
+      self.billed_secs += billed_secs(self.clock() - node.start_time,
+                                      self.billing_minimum_secs, self.billing_period_secs)
+
+def billed_secs(uptime_secs, minimum_secs, period_secs):
+  """Seconds billed for a node that ran for 'uptime_secs', when billing is
+  per 'period_secs' after an initial 'minimum_secs'."""
+  if uptime_secs <= minimum_secs:
+    return minimum_secs
+  return minimum_secs + \
+      int(math.ceil((uptime_secs - minimum_secs) / float(period_secs))) * period_secs
+
+class Autoscaler(object):
+  """Sizes the slave pool so that the outstanding work, as estimated by the
+  master's /stats.json, would be done within 'target_secs'.
+
+  The pool grows as soon as more nodes are wanted. It only shrinks to the
+  largest size wanted during the last 'shrink_delay_secs', so that a brief
+  lull between jobs does not throw away nodes which are needed again a
+  minute later. Nodes are only removed when little of the time already paid
+  for is left: the billing minimum, then the current billing period."""
+
+  def __init__(self, provider, target_secs=600, executors_per_node=1,
+               min_nodes=1, max_nodes=100, shrink_delay_secs=600,
+               billing_minimum_secs=600, billing_period_secs=60,
+               billing_slack_secs=60, clock=time.time):
+    self.provider = provider
+    self.target_secs = target_secs
+    self.executors_per_node = executors_per_node
+    self.min_nodes = min_nodes
+    self.max_nodes = max_nodes
+    self.shrink_delay_secs = shrink_delay_secs
+    self.billing_minimum_secs = billing_minimum_secs
+    self.billing_period_secs = billing_period_secs
+    # Remove nodes this close to the end of a paid-for period.
+    self.billing_slack_secs = billing_slack_secs
+    self.clock = clock
+    # (time, desired size) of recent decisions, oldest first.
+    self.recent_desired = collections.deque()
+
+  def desired_size(self, stats):
+    work = stats['outstanding_work']
+    work_secs = work['queued_work_secs'] + work['running_work_secs']
+    num_tasks = work['queued_tasks'] + work['running_tasks']
+    nodes = int(math.ceil(work_secs / float(self.target_secs * self.executors_per_node)))
+    # Nodes beyond one executor per task would sit idle, however long the tasks.
+    nodes = min(nodes, int(math.ceil(num_tasks / float(self.executors_per_node))))
+    return max(self.min_nodes, min(self.max_nodes, nodes))
+
+  def paid_secs_remaining(self, node, now):
+    """Seconds left of the time already paid for 'node'."""
+    uptime = now - node.start_time
+    return billed_secs(uptime, self.billing_minimum_secs, self.billing_period_secs) - uptime
+
+  def step(self, stats):
+    """Resize the pool for the given master statistics. Returns the number
+    of nodes added (positive) or removed (negative)."""
+    now = self.clock()
+    desired = self.desired_size(stats)
+    self.recent_desired.append((now, desired))
+    while self.recent_desired[0][0] < now - self.shrink_delay_secs:
+      self.recent_desired.popleft()
+
+    nodes = self.provider.list_nodes()
+    if desired > len(nodes):
+      logging.info("Growing from %d to %d nodes", len(nodes), desired)
+      self.provider.grow_to(desired)
+      return desired - len(nodes)
+
+    target = max(d for _, d in self.recent_desired)
+    if target >= len(nodes):
+      return 0
+    # Remove the nodes whose paid-for time runs out first.
+    removable = [n for n in nodes
+                 if self.paid_secs_remaining(n, now) <= self.billing_slack_secs]
+    removable.sort(key=lambda n: self.paid_secs_remaining(n, now))
+    to_remove = removable[:len(nodes) - target]
+    if to_remove:
+      logging.info("Shrinking from %d to %d nodes, removing %s",
+                   len(nodes), len(nodes) - len(to_remove), [n.name for n in to_remove])
+      self.provider.remove_nodes([n.name for n in to_remove])
+    return -len(to_remove)
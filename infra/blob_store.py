@@ -0,0 +1,287 @@
+import boto
+import cache
+import logging
+import metrics
+import os
+import shutil
+import tempfile
+import urllib
+import urllib2
+
+# Size of the chunks used when streaming blobs.
+CHUNK_SIZE = 1024 * 1024
+
+def _timed(op):
+  """Decorator recording the latency of a blob store operation."""
+  def decorator(fn):
+    def wrapper(self, *args, **kwargs):
+      with metrics.BLOB_STORE_SECONDS.time(self.BACKEND, op):
+        return fn(self, *args, **kwargs)
+    wrapper.__name__ = fn.__name__
+    wrapper.__doc__ = fn.__doc__
+    return wrapper
+  return decorator
+
+class BlobStore(object):
+  """Interface for the storage of task logs and artifact archives.
+
+  Blobs are identified by a string key. Ranges are half-open, [start, end)."""
+
+  def put_string(self, key, data):
+    raise NotImplementedError()
+
+  def put_file(self, key, fp):
+    """Store the remaining contents of the open file 'fp' without reading it
+    into memory."""
+    raise NotImplementedError()
+
+  def generate_url(self, key):
+    """Return a URL from which a browser or client can download the blob."""
+    raise NotImplementedError()
+
+  def size(self, key):
+    raise NotImplementedError()
+
+  def read_range(self, key, start, end):
+    raise NotImplementedError()
+
+  def iter_range(self, key, start=0, end=None, chunk_size=CHUNK_SIZE):
+    """Generator over the contents of [start, end) in chunks of at most
+    'chunk_size' bytes. An 'end' of None means the end of the blob."""
+    if end is None:
+      end = self.size(key)
+    while start < end:
+      chunk = self.read_range(key, start, min(end, start + chunk_size))
+      if not chunk:
+        break
+      start += len(chunk)
+      yield chunk
+
+class S3BlobStore(BlobStore):
+  """Stores blobs in an S3 bucket and hands out pre-signed links."""
+
+  BACKEND = "s3"
+
+  # Signed links last a day. Signing is relatively expensive, so links are
+  # cached and handed out again while at least half of their lifetime remains.
+  URL_EXPIRY_SECS = 60 * 60 * 24
+  URL_CACHE_TTL_SECS = URL_EXPIRY_SECS / 2
+  URL_CACHE_SIZE = 50000
+
+  def __init__(self, config):
+    config.ensure_aws_configured()
+    self.s3 = boto.connect_s3(config.AWS_ACCESS_KEY, config.AWS_SECRET_KEY)
+    self.s3_bucket = self.s3.get_bucket(config.AWS_TEST_RESULT_BUCKET)
+    self.url_cache = cache.ExpiringCache(max_size=self.URL_CACHE_SIZE)
+    logging.info("Connected to S3 with access key %s" % config.AWS_ACCESS_KEY)
+
+  def _new_key(self, key):
+    k = boto.s3.key.Key(self.s3_bucket)
+    k.key = key
+    # The Content-Disposition header sets the filename that the browser
+    # will use to download this.
+    # We have to cast to str() here, because boto will try to escape the header
+    # incorrectly if you pass a unicode string.
+    k.set_metadata('Content-Disposition', str('inline; filename=%s' % key))
+    return k
+
+  @_timed("put_string")
+  def put_string(self, key, data):
+    self._new_key(key).set_contents_from_string(data, reduced_redundancy=True)
+
+  @_timed("put_file")
+  def put_file(self, key, fp):
+    self._new_key(key).set_contents_from_file(fp, reduced_redundancy=True)
+
+  def generate_url(self, key):
+    url = self.url_cache.get(key)
+    if url is None:
+      k = boto.s3.key.Key(self.s3_bucket)
+      k.key = key
+      with metrics.BLOB_STORE_SECONDS.time(self.BACKEND, "sign_url"):
+        url = k.generate_url(self.URL_EXPIRY_SECS)
+      self.url_cache.put(key, url, self.URL_CACHE_TTL_SECS)
+    return url
+
+  @_timed("size")
+  def size(self, key):
+    k = self.s3_bucket.get_key(key)
+    if k is None:
+      raise KeyError(key)
+    return k.size
+
+  @_timed("read_range")
+  def read_range(self, key, start, end):
+    if end <= start:
+      return ""
+    k = boto.s3.key.Key(self.s3_bucket)
+    k.key = key
+    return k.get_contents_as_string(headers={'Range': 'bytes=%d-%d' % (start, end - 1)})
+
+  def iter_range(self, key, start=0, end=None, chunk_size=CHUNK_SIZE):
+    # Use a single ranged GET rather than one request per chunk.
+    if end is None:
+      end = self.size(key)
+    if end <= start:
+      return
+    k = boto.s3.key.Key(self.s3_bucket)
+    k.key = key
+    k.open_read(headers={'Range': 'bytes=%d-%d' % (start, end - 1)})
+    try:
+      while True:
+        chunk = k.read(chunk_size)
+        if not chunk:
+          break
+        yield chunk
+    finally:
+      k.close()
+
+class LocalBlobStore(BlobStore):
+  """Stores blobs as files in a local (or shared) directory.
+
+  Links point at the dist_test server's /blob endpoint, which serves the
+  files with HTTP range support."""
+
+  BACKEND = "local"
+
+  def __init__(self, root, url):
+    self.root = os.path.realpath(root)
+    self.url = url.rstrip("/")
+    if not os.path.isdir(self.root):
+      os.makedirs(self.root)
+    logging.info("Storing blobs in %s" % self.root)
+
+  def local_path(self, key):
+    path = os.path.realpath(os.path.join(self.root, key))
+    if not path.startswith(self.root + os.sep):
+      raise KeyError("Invalid blob key %s" % key)
+    return path
+
+  @_timed("put_string")
+  def put_string(self, key, data):
+    self._put(key, lambda f: f.write(data))
+
+  @_timed("put_file")
+  def put_file(self, key, fp):
+    self._put(key, lambda f: shutil.copyfileobj(fp, f, CHUNK_SIZE))
+
+  def _put(self, key, write_fn):
+    # Write to a temp file and rename, so readers never see a partial blob.
+    path = self.local_path(key)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(path))
+    try:
+      with os.fdopen(fd, "wb") as f:
+        write_fn(f)
+      os.rename(tmp_path, path)
+    except:
+      os.remove(tmp_path)
+      raise
+
+  def generate_url(self, key):
+    return "%s/blob?%s" % (self.url, urllib.urlencode([("key", key)]))
+
+  @_timed("size")
+  def size(self, key):
+    try:
+      return os.stat(self.local_path(key)).st_size
+    except OSError:
+      raise KeyError(key)
+
+  @_timed("read_range")
+  def read_range(self, key, start, end):
+    if end <= start:
+      return ""
+    with open(self.local_path(key), "rb") as f:
+      f.seek(start)
+      return f.read(end - start)
+
+  def iter_range(self, key, start=0, end=None, chunk_size=CHUNK_SIZE):
+    with open(self.local_path(key), "rb") as f:
+      if end is None:
+        end = os.fstat(f.fileno()).st_size
+      f.seek(start)
+      while start < end:
+        chunk = f.read(min(chunk_size, end - start))
+        if not chunk:
+          break
+        start += len(chunk)
+        yield chunk
+
+class _RewindBodyHandler(urllib2.BaseHandler):
+  """Seeks a file request body back to where it started before each send.
+  urllib2 answers an auth challenge by sending the request again, after
+  the first send has read the file to its end."""
+
+  def http_request(self, req):
+    if getattr(req, 'body_start', None) is not None:
+      req.get_data().seek(req.body_start)
+    return req
+
+  https_request = http_request
+
+class HttpBlobStore(BlobStore):
+  """Client for a dist_test server running a LocalBlobStore. Used by slaves
+  that do not share the server's blob directory. The server requires
+  'user' and 'password', unless the slave is in its allowed IP ranges."""
+
+  BACKEND = "http"
+
+  def __init__(self, url, user=None, password=None):
+    self.url = url.rstrip("/")
+    handlers = [_RewindBodyHandler()]
+    if user:
+      password_mgr = urllib2.HTTPPasswordMgrWithDefaultRealm()
+      password_mgr.add_password(None, self.url, user, password)
+      handlers.append(urllib2.HTTPDigestAuthHandler(password_mgr))
+    self.opener = urllib2.build_opener(*handlers)
+
+  def _upload(self, key, data, length):
+    req = urllib2.Request("%s/upload_blob?%s" % (self.url, urllib.urlencode([("key", key)])),
+                          data=data,
+                          headers={'Content-Type': 'application/octet-stream',
+                                   'Content-Length': str(length)})
+    if hasattr(data, 'seek'):
+      req.body_start = data.tell()
+    self.opener.open(req).read()
+
+  @_timed("put_string")
+  def put_string(self, key, data):
+    self._upload(key, data, len(data))
+
+  @_timed("put_file")
+  def put_file(self, key, fp):
+    self._upload(key, fp, os.fstat(fp.fileno()).st_size - fp.tell())
+
+  def generate_url(self, key):
+    return "%s/blob?%s" % (self.url, urllib.urlencode([("key", key)]))
+
+  @_timed("size")
+  def size(self, key):
+    req = urllib2.Request(self.generate_url(key))
+    req.get_method = lambda: "HEAD"
+    return int(self.opener.open(req).info()['Content-Length'])
+
+  @_timed("read_range")
+  def read_range(self, key, start, end):
+    if end <= start:
+      return ""
+    req = urllib2.Request(self.generate_url(key),
+                          headers={'Range': 'bytes=%d-%d' % (start, end - 1)})
+    return self.opener.open(req).read()
+
+def create_blob_store(config):
+  """Instantiate the blob store selected by the [blob_store] config section."""
+  backend = config.BLOB_STORE_BACKEND
+  if backend == "s3":
+    return S3BlobStore(config)
+  elif backend == "local":
+    config.ensure_blob_store_dir_configured()
+    # Without a configured URL, links are relative to the dist_test server.
+    return LocalBlobStore(config.BLOB_STORE_DIR, config.BLOB_STORE_URL or "")
+  elif backend == "http":
+    config.ensure_dist_test_configured()
+    return HttpBlobStore(config.BLOB_STORE_URL, config.DIST_TEST_USER,
+                         config.DIST_TEST_PASSWORD)
+  raise Exception("Unknown blob store backend %s" % backend)
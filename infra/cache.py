@@ -0,0 +1,64 @@
+import collections
+import heapq
+import threading
+import time
+
+class ExpiringCache(object):
+  """Thread-safe, size-bounded cache whose entries expire at a given time.
+
+  Once the cache holds 'max_size' entries, a put first evicts the entries
+  which have expired, if any, and otherwise the least recently used one.
+  Expired entries are also dropped when they are read. Operations take
+  O(log n) time."""
+
+  def __init__(self, max_size=10000, clock=time.time):
+    self.max_size = max_size
+    self.clock = clock
+    # key -> (value, expiry time), in least- to most-recently used order.
+    self.entries = collections.OrderedDict()
+    # Heap of (expiry time, key), which may also hold the expiry times of
+    # entries since replaced or removed.
+    self.expiries = []
+    self.lock = threading.Lock()
+
+  def get(self, key):
+    """Return the cached value for 'key', or None if absent or expired."""
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry is None:
+        return None
+      value, expiry = entry
+      if expiry <= self.clock():
+        return None
+      self.entries[key] = entry
+      return value
+
+  def put(self, key, value, ttl):
+    """Cache 'value' under 'key' for 'ttl' seconds."""
+    with self.lock:
+      now = self.clock()
+      self.entries.pop(key, None)
+      if len(self.entries) >= self.max_size:
+        self._evict_expired(now)
+      if len(self.entries) >= self.max_size:
+        self.entries.popitem(last=False)
+      self.entries[key] = (value, now + ttl)
+      heapq.heappush(self.expiries, (now + ttl, key))
+      if len(self.expiries) > 2 * self.max_size:
+        # Drop the expiry times of entries which are gone.
+        self.expiries = [(expiry, k) for k, (_, expiry) in self.entries.iteritems()]
+        heapq.heapify(self.expiries)
+
+  def _evict_expired(self, now):
+    while self.expiries and self.expiries[0][0] <= now:
+      expiry, key = heapq.heappop(self.expiries)
+      entry = self.entries.get(key)
+      if entry is not None and entry[1] == expiry:
+        del self.entries[key]
+
+  def invalidate(self, key):
+    with self.lock:
+      self.entries.pop(key, None)
+
+  def __len__(self):
+    return len(self.entries)
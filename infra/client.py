@@ -3,12 +3,15 @@
 from __future__ import with_statement
 import contextlib
 import getpass
+import gzip
 import logging
 import multiprocessing
 from multiprocessing.pool import ThreadPool
 import optparse
 import os
+import shutil
 import socket
+import StringIO
 import sys
 import time
 import urllib
@@ -21,6 +24,7 @@ import time
 import zipfile
 
 import config
+import job_format
 
 config = config.Config()
 config.ensure_dist_test_configured()
@@ -37,6 +41,12 @@ RESET = "\x1b[m"
 # hang forever.
 SOCKET_TIMEOUT_SECS = 60
 
+# Number of tasks to fetch per request when downloading results.
+TASKS_PAGE_SIZE = 5000
+
+# Manifest of deduplicated files inside artifact archives, written by the slave.
+DUPLICATES_MANIFEST = "_DUPLICATES_.json"
+
 LOG = logging.getLogger('dist_test.client')
 LOG.setLevel(logging.INFO)
 
@@ -162,20 +172,30 @@ def load_last_job_id():
   except Exception:
     return None
 
-def submit_job_json(job_prefix, job_json):
-  # Verify that it is proper JSON
-  json.loads(job_json)
+def submit_job_json(job_prefix, job_json, priority_class=None, max_failed_tasks=None):
+  job_desc = json.loads(job_json)
   # Prepend the job_prefix if present
   if job_prefix is not None and len(job_prefix) > 0:
     job_prefix += "."
   job_id = job_prefix + generate_job_id()
-  form_data = urllib.urlencode({'job_id': job_id, 'job_json': job_json})
+  params = {'job_id': job_id, 'user': getpass.getuser()}
+  if priority_class:
+    params['priority_class'] = priority_class
+  if max_failed_tasks is not None:
+    params['max_failed_tasks'] = max_failed_tasks
+  # Send the job in its compact form, gzipped, as the request body.
+  body = StringIO.StringIO()
+  with contextlib.closing(gzip.GzipFile(fileobj=body, mode="w")) as f:
+    json.dump(job_format.compact(job_desc), f)
   url = make_url("/submit_job")
   LOG.info("Submitting job to " + url)
-  result_str = urlopen_with_retry(url, data=form_data).read()
+  req = urllib2.Request(url + "?" + urllib.urlencode(params), data=body.getvalue(),
+                        headers={'Content-Type': 'application/json',
+                                 'Content-Encoding': 'gzip'})
+  result_str = urlopen_with_retry(req).read()
   result = json.loads(result_str)
   if result.get('status') != 'SUCCESS':
-    sys.err.println("Unable to submit job: %s" % repr(result))
+    sys.stderr.write("Unable to submit job: %s\n" % repr(result))
     sys.exit(1)
 
   save_last_job_id(job_id)
@@ -201,13 +221,21 @@ def submit(argv):
                help="Whether to download artifacts")
   p.add_option("--no-wait", dest="no_wait", action="store_true", default=False,
                help="Exit after submitting the job, rather than waiting for completion")
+  p.add_option("-p", "--priority-class", dest="priority_class", type="choice",
+               choices=["interactive", "precommit", "nightly"],
+               help="Priority class of the job: interactive (the default), precommit, " +
+                    "or nightly. Queued tasks of a class run before those of later classes.")
+  p.add_option("--max-failed-tasks", dest="max_failed_tasks", type="int",
+               help="Cancel the job once more than this many of its tasks have failed " +
+                    "(default 100)")
   options, args = p.parse_args()
 
   if len(args) != 1:
     p.print_help()
     sys.exit(1)
 
-  job_id = submit_job_json(options.name, file(args[0]).read())
+  job_id = submit_job_json(options.name, file(args[0]).read(), options.priority_class,
+                           options.max_failed_tasks)
   if options.no_wait:
     sys.exit(0)
   retcode = do_watch_results(job_id)
@@ -236,12 +264,24 @@ def watch(argv):
   sys.exit(ret)
 
 def fetch_tasks(job_id, status=None):
-  params = {"job_id": job_id}
+  """Fetch the task records of a job, a page at a time."""
+  params = {"job_id": job_id, "limit": TASKS_PAGE_SIZE}
   if status is not None:
     params["status"] = status
-  url = make_url("/tasks?" + urllib.urlencode(params))
-  results_str = urlopen_with_retry(url).read()
-  return json.loads(results_str)
+  tasks = []
+  while True:
+    url = make_url("/tasks?" + urllib.urlencode(params))
+    results_str = urlopen_with_retry(url).read()
+    page = json.loads(results_str)
+    if "error" in page:
+      raise Exception("Unable to fetch tasks: %s" % page["error"])
+    # Rows are compact lists of the values of 'fields', with nulls for
+    # missing values. Turn them back into records.
+    for row in page["rows"]:
+      tasks.append(dict([(f, v) for f, v in zip(page["fields"], row) if v is not None]))
+    if page["next_cursor"] is None:
+      return tasks
+    params["cursor"] = page["next_cursor"]
 
 def safe_name(s):
   return "".join([c.isalnum() and c or "_" for c in str(s)])
@@ -368,6 +408,27 @@ def _parallel_download(links, paths):
     except Exception as e:
       raise
 
+def _restore_duplicates(dest_path):
+  """Slaves store files with identical contents only once per archive, and
+  list the omitted copies in a manifest. Recreate them from the stored copy."""
+  dest_path = os.path.realpath(dest_path)
+  manifest_path = os.path.join(dest_path, DUPLICATES_MANIFEST)
+  if not os.path.exists(manifest_path):
+    return
+  with file(manifest_path, "r") as f:
+    duplicates = json.load(f)
+  for dup, orig in duplicates.iteritems():
+    dup_path = os.path.normpath(os.path.join(dest_path, dup))
+    orig_path = os.path.normpath(os.path.join(dest_path, orig))
+    if not dup_path.startswith(os.path.join(dest_path, "")) or \
+        not orig_path.startswith(os.path.join(dest_path, "")):
+      LOG.warn("Skipping duplicate outside of %s: %s -> %s", dest_path, dup, orig)
+      continue
+    if not os.path.exists(os.path.dirname(dup_path)):
+      os.makedirs(os.path.dirname(dup_path))
+    shutil.copyfile(orig_path, dup_path)
+  os.remove(manifest_path)
+
 def _extract(path, out_dir):
   # Use the zipfile's basename for uniqueness
   zipname = os.path.basename(path)
@@ -381,6 +442,7 @@ def _extract(path, out_dir):
       with contextlib.closing(zipfile.ZipFile(path, "r")) as myzip:
         for info in myzip.infolist():
             myzip.extract(info, dest_path)
+      _restore_duplicates(dest_path)
     except Exception as e:
       print >> sys.stderr, "Error extracting %s: %s" % (path, e)
       raise
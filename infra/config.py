@@ -10,6 +10,11 @@ class Config(object):
   AWS_SECRET_KEY_CONFIG = ('aws', 'secret_key', 'AWS_SECRET_KEY')
   AWS_TEST_RESULT_BUCKET_CONFIG = ('aws', 'test_result_bucket', 'TEST_RESULT_BUCKET')
 
+  # Blob store settings
+  BLOB_STORE_BACKEND_CONFIG = ('blob_store', 'backend', 'BLOB_STORE_BACKEND')
+  BLOB_STORE_DIR_CONFIG = ('blob_store', 'dir', 'BLOB_STORE_DIR')
+  BLOB_STORE_URL_CONFIG = ('blob_store', 'url', 'BLOB_STORE_URL')
+
   # MySQL settings
   MYSQL_HOST_CONFIG = ('mysql', 'host', 'MYSQL_HOST')
   MYSQL_PORT_CONFIG = ('mysql', 'port', 'MYSQL_PORT')
@@ -31,6 +36,8 @@ class Config(object):
   DIST_TEST_USER_CONFIG = ('dist_test', 'user', 'DIST_TEST_USER')
   DIST_TEST_PASSWORD_CONFIG = ('dist_test', 'password', 'DIST_TEST_PASSWORD')
   DIST_TEST_URL_TIMEOUT_CONFIG = ('dist_test', 'url_timeout', 'DIST_TEST_URL_TIMEOUT')
+  DIST_TEST_COMPRESS_ARTIFACTS_CONFIG = ('dist_test', 'compress_artifacts',
+                                         'DIST_TEST_COMPRESS_ARTIFACTS')
 
   def __init__(self, path=None):
     if path is None:
@@ -44,6 +51,16 @@ class Config(object):
       "submit_gce_metrics" : "True",
       "allowed_ip_ranges": "0.0.0.0/0",
       "accounts": "{}",
+      "fair_share_weights": "{}",
+      "class_quotas": "{}",
+      "batch_state_writes": "False",
+      "warmup_isolates": "False",
+      "peer_blobs": "False",
+      "peer_blobs_port": "0",
+      "task_affinity": "False",
+      "retry_cache_size": "100",
+      "server_threads": "10",
+      "retry_cache_ttl_secs": "600",
     }
     self.config = SafeConfigParser(defaults)
     self.config.read(path)
@@ -58,6 +75,14 @@ class Config(object):
     self.AWS_SECRET_KEY = self._get_with_env_override(*self.AWS_SECRET_KEY_CONFIG)
     self.AWS_TEST_RESULT_BUCKET = self._get_with_env_override(*self.AWS_TEST_RESULT_BUCKET_CONFIG)
 
+    # Blob store settings. The 'local' backend stores results in a directory
+    # served by the dist_test server, and 'http' uploads them to that server.
+    self.BLOB_STORE_BACKEND = self._get_with_env_override(*self.BLOB_STORE_BACKEND_CONFIG)
+    if self.BLOB_STORE_BACKEND is None:
+      self.BLOB_STORE_BACKEND = "s3"
+    self.BLOB_STORE_DIR = self._get_with_env_override(*self.BLOB_STORE_DIR_CONFIG)
+    self.BLOB_STORE_URL = self._get_with_env_override(*self.BLOB_STORE_URL_CONFIG)
+
     # MySQL settings
     self.MYSQL_HOST = self._get_with_env_override(*self.MYSQL_HOST_CONFIG)
     try:
@@ -75,6 +100,8 @@ class Config(object):
     if not self.config.has_section('dist_test'):
       self.config.add_section('dist_test')
     self.DIST_TEST_MASTER = self._get_with_env_override(*self.DIST_TEST_MASTER_CONFIG)
+    if self.BLOB_STORE_URL is None:
+      self.BLOB_STORE_URL = self.DIST_TEST_MASTER
     self.DIST_TEST_JOB_PATH = self._get_with_env_override(*self.DIST_TEST_JOB_PATH_CONFIG)
     if self.DIST_TEST_JOB_PATH is None:
       self.DIST_TEST_JOB_PATH = os.path.expanduser("~/.dist-test-last-job")
@@ -83,10 +110,41 @@ class Config(object):
     self.DIST_TEST_URL_TIMEOUT = self._get_with_env_override(*self.DIST_TEST_URL_TIMEOUT_CONFIG)
     if self.DIST_TEST_URL_TIMEOUT  is not None:
       self.DIST_TEST_URL_TIMEOUT = float(self.DIST_TEST_URL_TIMEOUT)
+    # Whether artifact archives are deflated, rather than stored. zipfile
+    # only deflates at its default level.
+    compress = self._get_with_env_override(*self.DIST_TEST_COMPRESS_ARTIFACTS_CONFIG)
+    self.DIST_TEST_COMPRESS_ARTIFACTS = compress is None or \
+        compress.lower() not in ("0", "false", "no", "off")
 
     # dist_test master configs (in the 'dist_test' section)
     self.DIST_TEST_ALLOWED_IP_RANGES = self.config.get('dist_test', 'allowed_ip_ranges')
     self.ACCOUNTS = self.config.get('dist_test', 'accounts')
+    # JSON map of user (or job id) to fair share weight, by default 1.
+    self.DIST_TEST_FAIR_SHARE_WEIGHTS = self.config.get('dist_test', 'fair_share_weights')
+    # JSON map of priority class to the most of its tasks to run at once,
+    # by default unlimited. Checked by the slaves.
+    self.DIST_TEST_CLASS_QUOTAS = self.config.get('dist_test', 'class_quotas')
+    # Whether slaves record task state through the master, which batches the
+    # writes of all slaves, rather than writing to MySQL themselves.
+    self.DIST_TEST_BATCH_STATE_WRITES = self.config.getboolean('dist_test', 'batch_state_writes')
+    # Request threads of the master. A batched state write holds one until
+    # its batch commits.
+    self.DIST_TEST_SERVER_THREADS = self.config.getint('dist_test', 'server_threads')
+    # Whether idle slaves download the isolates of newly submitted jobs into
+    # their cache, before their tasks are reserved.
+    self.DIST_TEST_WARMUP_ISOLATES = self.config.getboolean('dist_test', 'warmup_isolates')
+    # Whether slaves serve the blobs in their isolate cache to each other,
+    # and fetch blobs from each other before the isolate server. The port
+    # of the blob server is picked by the OS if it is 0.
+    self.DIST_TEST_PEER_BLOBS = self.config.getboolean('dist_test', 'peer_blobs')
+    self.DIST_TEST_PEER_BLOBS_PORT = self.config.getint('dist_test', 'peer_blobs_port')
+    # Whether slaves report the isolates in their cache, and take the tasks
+    # which the server routes to them for those isolates.
+    self.DIST_TEST_TASK_AFFINITY = self.config.getboolean('dist_test', 'task_affinity')
+    # The most retries, and for how long, which slaves avoid running on the
+    # host that submitted them.
+    self.DIST_TEST_RETRY_CACHE_SIZE = self.config.getint('dist_test', 'retry_cache_size')
+    self.DIST_TEST_RETRY_CACHE_TTL_SECS = self.config.getint('dist_test', 'retry_cache_ttl_secs')
 
     self.log_dir = self.config.get('dist_test', 'log_dir')
     # Make the log directory if it doesn't exist
@@ -96,6 +154,8 @@ class Config(object):
     self.SERVER_ERROR_LOG = os.path.join(self.log_dir, "server-error.log")
     self.SERVER_LOG = os.path.join(self.log_dir, "server.log")
     self.SLAVE_LOG = os.path.join(self.log_dir, "slave.log")
+    # Compiled dashboard templates, cached across server restarts.
+    self.TEMPLATE_CACHE_DIR = os.path.join(self.log_dir, "template-cache")
 
   @staticmethod
   def mkdir_p(path):
@@ -122,6 +182,9 @@ class Config(object):
                           self.AWS_SECRET_KEY_CONFIG,
                           self.AWS_TEST_RESULT_BUCKET_CONFIG])
 
+  def ensure_blob_store_dir_configured(self):
+    self._ensure_configs([self.BLOB_STORE_DIR_CONFIG])
+
   def ensure_isolate_configured(self):
     self._ensure_configs([self.ISOLATE_HOME_CONFIG,
                           self.ISOLATE_SERVER_CONFIG,
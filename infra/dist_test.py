@@ -1,5 +1,7 @@
+import base64
 import beanstalkc
-import boto
+import collections
+import contextlib
 from ConfigParser import SafeConfigParser
 import errno
 import logging
@@ -13,12 +15,139 @@ except:
   import json
 import socket
 import threading
+import time
 
 # We don't actually use 'yaml' here. But, without yaml available,
 # beanstalkc will fall back to providing string results for stats()
 # and stats_tube(). So, we import it just to make sure it's around.
 import yaml
+import blob_store
 import config
+import metrics
+
+# Beanstalk priority of newly submitted tasks. Lower values are reserved first.
+DEFAULT_PRIORITY = 2**31
+
+# Largest beanstalk priority.
+MAX_PRIORITY = 2**32 - 1
+
+# Priority classes, from most to least urgent. Each class has its own tube,
+# and its own band of priorities, starting at DEFAULT_PRIORITY for the most
+# urgent. Slaves reserve the lowest priority across tubes, so every queued
+# task of a class runs before any of the classes after it.
+PRIORITY_CLASSES = ["interactive", "precommit", "nightly"]
+DEFAULT_PRIORITY_CLASS = "interactive"
+PRIORITY_CLASS_BAND = 2**29
+
+AFFINITY_TUBE_PREFIX = "dist_test-affinity-"
+KILL_TUBE_PREFIX = "dist_test-kill-"
+
+# A job is canceled once more than this many of its tasks have failed,
+# unless it was submitted with its own limit.
+DEFAULT_MAX_FAILED_TASKS = 100
+
+# Phases of a task run with duration statistics: "total" is the sum of the
+# others.
+DURATION_PHASES = ["download", "run", "upload", "total"]
+
+def class_base_priority(priority_class):
+  """Lowest priority given to new tasks of 'priority_class'."""
+  return DEFAULT_PRIORITY + PRIORITY_CLASSES.index(priority_class) * PRIORITY_CLASS_BAND
+
+def class_tube(priority_class):
+  return "dist_test-%s" % priority_class
+
+def affinity_tube(slave_id):
+  """Tube of the tasks routed to the slave 'slave_id' for its isolate cache."""
+  return AFFINITY_TUBE_PREFIX + slave_id
+
+def kill_tube(bs_id):
+  """Tube on which the slave running beanstalk job 'bs_id' is told to kill it."""
+  return KILL_TUBE_PREFIX + str(bs_id)
+
+def retry_priority(attempt, priority_class=DEFAULT_PRIORITY_CLASS):
+  """Beanstalk priority for the given retry attempt of a task. Retries run
+  with a boosted priority, ahead of new tasks of their class, which prevents
+  them from straggling if we've already started running another job."""
+  return max(class_base_priority(priority_class) - (1000 * attempt), 1000)
+
+def assign_affinity(tasks, costs, warm_slaves, budget_secs, assigned=None):
+  """Pick a slave which has the isolate of each of 'tasks' in its cache,
+  given their expected durations 'costs' and a dict of isolate hash to the
+  ids of the slaves which have it. A slave is given tasks until it has
+  'budget_secs' of expected work, since that is how long it has to start
+  them before they fall back to any slave. 'assigned', if given, is a dict
+  of slave id to the work given to it by earlier calls, which is updated.
+  Returns a list with, for each task, the id of its slave, or None."""
+  if assigned is None:
+    assigned = {}
+  slaves = []
+  for task, cost in zip(tasks, costs):
+    choice = None
+    for slave_id in warm_slaves.get(task.isolate_hash, []):
+      work = assigned.get(slave_id, 0)
+      if work < budget_secs and (choice is None or work < assigned.get(choice, 0)):
+        choice = slave_id
+    if choice is not None:
+      assigned[choice] = assigned.get(choice, 0) + cost
+    slaves.append(choice)
+  return slaves
+
+def sort_tasks_by_duration(tasks, durations):
+  """Sort tasks by their expected duration, descending, given a dict of
+  description to duration. Tasks which have not run before go last.
+
+  This is a simple form of longest-task-first scheduling to reduce the
+  effect of stragglers on overall job runtime."""
+  return sorted(tasks, key=lambda t: durations.get(t.description, 0), reverse=True)
+
+class FairShare(object):
+  """Assigns beanstalk priorities to new tasks by start-time fair queuing, so
+  that slaves, which reserve the lowest priority first, serve the flow (a user,
+  or a job) which has had the least service relative to its weight.
+
+  Each task is tagged with its flow's virtual time, which then advances by the
+  task's expected duration divided by the flow's weight. A flow with nothing
+  queued starts at the system virtual time: the priority at the head of the
+  queue. A small job submitted behind a large one is thus interleaved with it,
+  rather than waiting for it, while the large job still runs on any slaves
+  the small one leaves idle.
+
+  Tags lie in [base_priority, max_priority], which is the band of one
+  priority class. Retries, which have lower priorities, still go first."""
+
+  def __init__(self, weights=None, base_priority=DEFAULT_PRIORITY, max_priority=MAX_PRIORITY):
+    # flow -> weight. Flows not listed have a weight of 1.
+    self.weights = weights or {}
+    self.base_priority = base_priority
+    self.max_priority = max_priority
+    # flow -> virtual time at which its queued tasks run out.
+    self.finish_tags = {}
+    self.lock = threading.Lock()
+
+  def assign_priorities(self, flow, costs, head_priority):
+    """Return priorities for a flow's new tasks, given their expected costs in
+    seconds, in the order they should run. 'head_priority' is the priority of
+    the next task to be reserved, or None if no tasks are ready."""
+    weight = float(self.weights.get(flow, 1))
+    with self.lock:
+      if head_priority is None:
+        # Nothing is queued, so no flow is owed anything.
+        self.finish_tags.clear()
+        virtual_time = self.base_priority
+      else:
+        virtual_time = max(head_priority, self.base_priority)
+      # Flows whose tasks have all reached the head of the queue start afresh.
+      for f, tag in self.finish_tags.items():
+        if tag <= virtual_time:
+          del self.finish_tags[f]
+      tag = max(virtual_time, self.finish_tags.get(flow, 0))
+      priorities = []
+      for cost in costs:
+        priorities.append(min(int(tag), self.max_priority))
+        tag += max(cost, 1) / weight
+      self.finish_tags[flow] = tag
+    return priorities
 
 class Task(object):
   """Serializable task description used for communicating tasks between
@@ -47,6 +176,10 @@ class Task(object):
     self.max_retries = d.get('max_retries', 0)
     self.docker_image = d.get('docker_image')
     self.artifact_archive_globs = d.get('artifact_archive_globs', [])
+    self.priority_class = d.get('priority_class', DEFAULT_PRIORITY_CLASS)
+    # Whether this is a duplicate of a straggling attempt, which shares the
+    # attempt's row in the results store.
+    self.speculative = d.get('speculative', False)
 
   def to_json(self):
     job_struct = dict(
@@ -58,17 +191,72 @@ class Task(object):
       attempt=self.attempt,
       max_retries=self.max_retries,
       artifact_archive_globs=self.artifact_archive_globs,
+      priority_class=self.priority_class,
     )
     if self.docker_image is not None:
       job_struct['docker_image'] = self.docker_image
+    if self.speculative:
+      job_struct['speculative'] = True
     return json.dumps(job_struct)
 
+  def to_ref_json(self):
+    """The reference to this task which is queued in beanstalk: only its
+    attempt, since the rest is in the description of its job."""
+    ref = dict(job_id=self.job_id, task_id=self.task_id, attempt=self.attempt)
+    if self.speculative:
+      ref['speculative'] = True
+    return json.dumps(ref)
+
   def get_retry_id(self):
     return "%s.%s" % (self.job_id, self.task_id)
 
   def get_id(self):
     return "%s.%s.%s" % (self.job_id, self.task_id, self.attempt)
 
+class TaskResult(object):
+  """The outcome of a run of a task attempt, with the blob store keys of its
+  uploaded output, to be recorded by ResultsStore.record_task_results."""
+
+  @staticmethod
+  def from_json(json_str):
+    d = json.loads(json_str)
+    result = TaskResult(Task(d['task']), d['result_code'], d['hostname'])
+    for k in TaskResult.OUTPUT_FIELDS + TaskResult.PHASE_FIELDS:
+      setattr(result, k, d[k])
+    return result
+
+  OUTPUT_FIELDS = ["stdout_key", "stdout_abbrev", "stderr_key", "stderr_abbrev",
+                   "artifact_archive_key"]
+  # Seconds spent downloading the task's files, running it, and archiving
+  # and uploading its output.
+  PHASE_FIELDS = ["download_secs", "run_secs", "upload_secs"]
+
+  def __init__(self, task, result_code, hostname, download_secs=0, run_secs=0, upload_secs=0):
+    self.task = task
+    self.result_code = result_code
+    self.hostname = hostname
+    self.download_secs = download_secs
+    self.run_secs = run_secs
+    self.upload_secs = upload_secs
+    self.stdout_key = None
+    self.stdout_abbrev = ""
+    self.stderr_key = None
+    self.stderr_abbrev = ""
+    self.artifact_archive_key = None
+
+  def to_json(self):
+    d = dict(task=json.loads(self.task.to_json()),
+             result_code=self.result_code,
+             hostname=self.hostname)
+    for k in self.OUTPUT_FIELDS + self.PHASE_FIELDS:
+      d[k] = getattr(self, k)
+    return json.dumps(d)
+
+  def matches(self, row):
+    """Return whether 'row' of dist_test_tasks already records this result."""
+    return row['status'] == self.result_code and row['hostname'] == self.hostname and \
+        row['stdout_key'] == self.stdout_key and row['stderr_key'] == self.stderr_key
+
 class TaskGroup(object):
   """Calculate group-level status information about a set of tasks rows returned
   by fetch_task_rows_for_job"""
@@ -108,48 +296,270 @@ class TaskGroup(object):
     if any_succeeded or (all_failed and not has_retries_remaining):
       self.is_finished = True
 
+def make_job_task(job_id, priority_class, index, task_desc):
+  """Return the Task at 'index' of the tasks of a submitted job, given its
+  description 'task_desc', which is modified."""
+  task_desc['job_id'] = job_id
+  task_desc['priority_class'] = priority_class
+  task_desc['task_id'] = "%s.%d" % (task_desc['isolate_hash'], index)
+  return Task(task_desc)
+
+def job_task_index(task_id):
+  """The index of a task in its job, from the task id given by make_job_task."""
+  return int(task_id.rsplit(".", 1)[1])
+
 class ReservedTask(object):
+  """A task reserved from beanstalk. Its 'ref' is the reference queued by
+  TaskQueue.submit_task, and 'task' is None until it has been resolved
+  from the description of its job. Tasks queued before references were
+  queued carry the whole task. A task routed to a slave by affinity also
+  names its 'fallback' copy, and runs only if TaskQueue.claim_affinity_task
+  succeeds."""
   def __init__(self, bs_elem):
     self.bs_elem = bs_elem
-    self.task = Task.from_json(bs_elem.body)
+    self.ref = json.loads(bs_elem.body)
+    self.task = None
+    if 'isolate_hash' in self.ref:
+      self.task = Task(self.ref)
 
 class TaskQueue(object):
+  # How often a slave waiting for a task re-checks the class quotas.
+  QUOTA_RECHECK_SECS = 10
+
   def __init__(self, config):
     config.ensure_beanstalk_configured()
     self.bs = beanstalkc.Connection(config.BEANSTALK_HOST)
+    # Tasks submitted before priority classes were added are in the default
+    # tube, which stays watched.
+    for priority_class in PRIORITY_CLASSES:
+      self.bs.watch(class_tube(priority_class))
     # beanstalkc is not thread-safe
     self.lock = threading.Lock()
 
-  def submit_task(self, task, priority=2147483648):
-    """Submit a beanstalk task, with optional non-negative integer priority.
-    Lower priority values are reserved first."""
+  def watch_affinity_tube(self, slave_id):
+    """Also take the tasks routed to this slave, 'slave_id'."""
+    with self.lock:
+      self.bs.watch(affinity_tube(slave_id))
+
+  def submit_task(self, task, priority=None, delay=0, full=False):
+    """Submit a beanstalk task to the tube of its priority class, with
+    optional non-negative integer priority, by default the lowest of its
+    class. Lower priority values are reserved first. The task is not ready
+    to be reserved for 'delay' seconds. Only a reference to the task is
+    queued, which slaves resolve with the description of its job, unless
+    'full' is set, for tasks of jobs with no recorded description. Returns
+    the beanstalk job id."""
     logging.info("Submitting task %s" % task.job_id)
+    if priority is None:
+      priority = class_base_priority(task.priority_class)
+    body = task.to_json() if full else task.to_ref_json()
+    with self.lock:
+      self.bs.use(class_tube(task.priority_class))
+      return self.bs.put(body, priority=priority, delay=delay)
+
+  def submit_affinity_task(self, task, slave_id, fallback_bs_id, priority):
+    """Submit a copy of 'task' to the slave 'slave_id', with the same
+    'priority' as its delayed copy 'fallback_bs_id' for any slave, which
+    whichever of the two is reserved first deletes (see
+    claim_affinity_task). Returns the beanstalk job id."""
+    ref = json.loads(task.to_ref_json())
+    ref['fallback'] = fallback_bs_id
+    # To move the copy back to its class if the slave goes away.
+    ref['priority_class'] = task.priority_class
+    with self.lock:
+      self.bs.use(affinity_tube(slave_id))
+      return self.bs.put(json.dumps(ref), priority=priority)
+
+  def claim_affinity_task(self, reserved_task):
+    """Return whether 'reserved_task' should be run. A task routed by
+    affinity runs only if its fallback copy could be deleted; otherwise the
+    fallback was reserved by another slave, which runs the task instead."""
+    fallback = reserved_task.ref.get('fallback')
+    if fallback is None:
+      return True
     with self.lock:
-      self.bs.put(task.to_json(), priority=priority)
+      try:
+        self.bs.delete(fallback)
+        return True
+      except beanstalkc.CommandFailed:
+        return False
+
+  def rescue_affinity_tasks(self):
+    """Move the ready tasks of affinity tubes which no slave watches any
+    more, because their slave exited, to the tubes of their classes. They
+    keep their fallback, so the task still runs only once. Returns a list
+    of the (job id, new beanstalk job id) of the moved tasks."""
+    moved = []
+    with self.lock:
+      orphaned = []
+      for tube in self.bs.tubes():
+        if not tube.startswith(AFFINITY_TUBE_PREFIX):
+          continue
+        tube_stats = self.bs.stats_tube(tube)
+        if tube_stats['current-watching'] == 0 and tube_stats['current-jobs-ready'] > 0:
+          orphaned.append(tube)
+      if not orphaned:
+        return moved
+      for tube in orphaned:
+        self.bs.watch(tube)
+      for tube in self.bs.watching():
+        if tube not in orphaned:
+          self.bs.ignore(tube)
+      try:
+        while True:
+          bs_elem = self.bs.reserve(timeout=0)
+          if bs_elem is None:
+            break
+          ref = json.loads(bs_elem.body)
+          self.bs.use(class_tube(ref['priority_class']))
+          moved.append((ref['job_id'], self.bs.put(bs_elem.body, priority=bs_elem.stats()['pri'])))
+          bs_elem.delete()
+      finally:
+        self.bs.watch("default")
+        for priority_class in PRIORITY_CLASSES:
+          self.bs.watch(class_tube(priority_class))
+        for tube in orphaned:
+          self.bs.ignore(tube)
+    return moved
+
+  def cancel_tasks(self, bs_ids):
+    """Delete the given beanstalk jobs if they are still queued, and tell
+    the slaves running any of them to kill them. Returns a tuple of the
+    number deleted and the number killed."""
+    deleted = killed = 0
+    for bs_id in bs_ids:
+      # Take the lock for each job, so that submissions are not held up.
+      with self.lock:
+        try:
+          self.bs.delete(bs_id)
+          deleted += 1
+          continue
+        except beanstalkc.CommandFailed:
+          # Reserved by a slave, or already finished.
+          pass
+        try:
+          if self.bs.stats_job(bs_id)['state'] != 'reserved':
+            continue
+        except beanstalkc.CommandFailed:
+          continue
+        self.bs.use(kill_tube(bs_id))
+        kill_id = self.bs.put("kill")
+        try:
+          self.bs.stats_job(bs_id)
+        except beanstalkc.CommandFailed:
+          # Finished since it was checked, so its slave may have stopped
+          # reading the kill tube already.
+          self.bs.delete(kill_id)
+          continue
+        killed += 1
+    return deleted, killed
+
+  def delete_task(self, reserved_task):
+    """Delete 'reserved_task' once it is done with, along with any kill
+    message for it which was put after the slave last checked."""
+    with self.lock:
+      reserved_task.bs_elem.delete()
+      self.bs.use(kill_tube(reserved_task.bs_elem.jid))
+      while True:
+        bs_elem = self.bs.peek_ready()
+        if bs_elem is None:
+          break
+        try:
+          bs_elem.delete()
+        except beanstalkc.CommandFailed:
+          # Deleted by another slave handed the same task.
+          pass
 
-  def reserve_task(self):
+  def check_killed(self, reserved_task):
+    """Return whether the slave running 'reserved_task' has been told to
+    kill it, consuming the message."""
     with self.lock:
-      bs_elem = self.bs.reserve()
+      self.bs.use(kill_tube(reserved_task.bs_elem.jid))
+      bs_elem = self.bs.peek_ready()
+      if bs_elem is None:
+        return False
+      bs_elem.delete()
+      return True
+
+  def ready_priority(self, priority_class):
+    """Return the priority of the next task of 'priority_class' to be
+    reserved, or None if there are no ready tasks of that class."""
+    with self.lock:
+      self.bs.use(class_tube(priority_class))
+      bs_elem = self.bs.peek_ready()
+      if bs_elem is None:
+        return None
+      try:
+        return bs_elem.stats()['pri']
+      except beanstalkc.CommandFailed:
+        # Reserved by a slave since we peeked.
+        return None
+
+  def reserve_task(self, quotas=None):
+    """Reserve the next task. 'quotas' optionally limits the number of
+    tasks of each priority class that may run at once; classes at their
+    quota are skipped, and None is returned if no task was reserved within
+    QUOTA_RECHECK_SECS. The quotas are only approximate, since slaves check
+    them independently."""
+    with self.lock:
+      if not quotas:
+        return ReservedTask(self.bs.reserve())
+      for priority_class in PRIORITY_CLASSES:
+        tube = class_tube(priority_class)
+        if priority_class in quotas and \
+            self._num_reserved(tube) >= quotas[priority_class]:
+          self.bs.ignore(tube)
+        else:
+          self.bs.watch(tube)
+      bs_elem = self.bs.reserve(timeout=self.QUOTA_RECHECK_SECS)
+    if bs_elem is None:
+      return None
     return ReservedTask(bs_elem)
 
+  def _num_reserved(self, tube):
+    try:
+      return self.bs.stats_tube(tube)['current-jobs-reserved']
+    except beanstalkc.CommandFailed:
+      # The tube does not exist until something is put in it.
+      return 0
+
   def stats(self):
+    """Beanstalk statistics for the task queue as a whole: job counts are
+    summed over the tubes of the priority classes, while every idle slave
+    waits on all of them. Tasks routed to a slave are not counted, since
+    they are copies of the tasks queued for any slave, nor are kill
+    messages."""
+    totals = collections.defaultdict(int)
+    for tube, tube_stats in self.tube_stats().iteritems():
+      if tube.startswith(AFFINITY_TUBE_PREFIX) or tube.startswith(KILL_TUBE_PREFIX):
+        continue
+      for k, v in tube_stats.iteritems():
+        if k == 'current-waiting':
+          totals[k] = max(totals[k], v)
+        elif k.startswith('current-jobs-'):
+          totals[k] += v
+    return totals
+
+  def tube_stats(self):
+    """Return a dict of tube name to beanstalk stats, for each tube in use."""
     with self.lock:
-      return self.bs.stats_tube("default")
+      return dict((tube, self.bs.stats_tube(tube)) for tube in self.bs.tubes())
 
 class ResultsStore(object):
+  # Duration statistics are computed from the last DURATION_MAX_SAMPLES
+  # successful runs of a task within DURATION_WINDOW_DAYS.
+  DURATION_MAX_SAMPLES = 20
+  DURATION_WINDOW_DAYS = 14
+
   def __init__(self, config):
     self.config = config
-    self.config.ensure_aws_configured()
     self.config.ensure_mysql_configured()
 
     self.thread_local = threading.local()
     logging.info("Connected to MySQL at %s" % config.MYSQL_HOST)
     self._ensure_tables()
 
-    self.s3 = boto.connect_s3(self.config.AWS_ACCESS_KEY, self.config.AWS_SECRET_KEY)
-    self.s3_bucket = self.s3.get_bucket(self.config.AWS_TEST_RESULT_BUCKET)
-
-    logging.info("Connected to S3 with access key %s" % self.config.AWS_ACCESS_KEY)
+    self.blob_store = blob_store.create_blob_store(self.config)
 
   def _execute_query(self, query, *args, **kwargs):
     """ Execute a query, automatically reconnecting on disconnection. """
@@ -164,19 +574,44 @@ class ResultsStore(object):
       c = self._connect_mysql().cursor(MySQLdb.cursors.DictCursor)
       attempt_num = attempt_num + 1
       try:
-        if kwargs.get('use_executemany', False):
-          c.executemany(query, *args)
-        else:
-          c.execute(query, *args)
+        with metrics.MYSQL_QUERY_SECONDS.time(query.split(None, 1)[0].upper()):
+          if kwargs.get('use_executemany', False):
+            c.executemany(query, *args)
+          else:
+            c.execute(query, *args)
         return c
       except MySQLdb.OperationalError as err:
-        if err.args[0] == MYSQL_SERVER_GONE_AWAY and attempt_num < MAX_ATTEMPTS:
+        # A reconnection would lose any transaction in progress.
+        if err.args[0] == MYSQL_SERVER_GONE_AWAY and attempt_num < MAX_ATTEMPTS and \
+            not getattr(self.thread_local, "in_transaction", False):
           logging.warn("Forcing reconnect to MySQL: %s" % err)
           self.thread_local.db = None
           continue
         else:
           raise
 
+  @contextlib.contextmanager
+  def transaction(self):
+    """Run the queries of the body in a single transaction, committed at
+    its end, or rolled back if it raises. Within a transaction, further
+    transactions join it."""
+    if getattr(self.thread_local, "in_transaction", False):
+      yield
+      return
+    self._execute_query("START TRANSACTION")
+    self.thread_local.in_transaction = True
+    try:
+      yield
+      self._execute_query("COMMIT")
+    except:
+      try:
+        self._execute_query("ROLLBACK")
+      except MySQLdb.Error:
+        logging.warn("Failed to roll back transaction", exc_info=True)
+      raise
+    finally:
+      self.thread_local.in_transaction = False
+
   def _connect_mysql(self):
     if hasattr(self.thread_local, "db") and \
           self.thread_local.db is not None:
@@ -212,35 +647,332 @@ class ResultsStore(object):
         PRIMARY KEY(job_id, task_id, attempt),
         INDEX(submit_timestamp)
       );""")
+    # Durations of the download, run and upload phases of successful runs,
+    # and statistics of the most recent samples of each description.
+    self._execute_query("""
+      CREATE TABLE IF NOT EXISTS dist_test_duration_samples (
+        id bigint not null auto_increment primary key,
+        description varchar(100) not null,
+        complete_timestamp timestamp not null default current_timestamp,
+        download_secs float not null,
+        run_secs float not null,
+        upload_secs float not null,
+        INDEX(description, id)
+      );""")
+    stats_table_exists = self._execute_query(
+      "SHOW TABLES LIKE 'dist_test_duration_stats'").fetchone()
     self._execute_query("""
-      CREATE TABLE IF NOT EXISTS dist_test_durations (
+      CREATE TABLE IF NOT EXISTS dist_test_duration_stats (
         description varchar(100) not null primary key,
-        task_id varchar(100) not null,
-        duration_secs int not null
+        num_samples int not null,
+        download_p50 float not null,
+        download_p90 float not null,
+        run_p50 float not null,
+        run_p90 float not null,
+        upload_p50 float not null,
+        upload_p90 float not null,
+        total_p50 float not null,
+        total_p90 float not null,
+        update_timestamp timestamp not null default current_timestamp on update current_timestamp,
+        INDEX(update_timestamp)
+      );""")
+    if stats_table_exists and not self._execute_query(
+        "SHOW COLUMNS FROM dist_test_duration_stats LIKE 'update_timestamp'").fetchone():
+      # Added after the table, so that the master can fetch only changed rows.
+      self._execute_query("""
+        ALTER TABLE dist_test_duration_stats
+          ADD COLUMN update_timestamp timestamp not null
+            default current_timestamp on update current_timestamp,
+          ADD INDEX(update_timestamp)""")
+    if not stats_table_exists and \
+        self._execute_query("SHOW TABLES LIKE 'dist_test_durations'").fetchone():
+      # Start from the smoothed durations which the statistics replace,
+      # until there are samples.
+      logging.info("Seeding dist_test_duration_stats from dist_test_durations")
+      self._execute_query("""
+        INSERT IGNORE INTO dist_test_duration_stats
+          (description, num_samples, download_p50, download_p90, run_p50, run_p90,
+           upload_p50, upload_p90, total_p50, total_p90)
+        SELECT description, 0, 0, 0, duration_secs, duration_secs, 0, 0,
+               duration_secs, duration_secs
+        FROM dist_test_durations""")
+    jobs_table_exists = self._execute_query("SHOW TABLES LIKE 'dist_test_jobs'").fetchone()
+    # One row per job, so that listing recent jobs does not need to scan
+    # their tasks. 'num_tasks' counts attempts, 'num_groups' distinct tasks,
+    # and 'failed_tasks' failed attempts. 'max_failed_tasks' is NULL for the
+    # default of DEFAULT_MAX_FAILED_TASKS.
+    self._execute_query("""
+      CREATE TABLE IF NOT EXISTS dist_test_jobs (
+        job_id varchar(100) not null primary key,
+        submit_timestamp timestamp not null default current_timestamp,
+        complete_timestamp timestamp null,
+        num_tasks int not null default 0,
+        num_groups int not null default 0,
+        finished_groups int not null default 0,
+        failed_tasks int not null default 0,
+        max_failed_tasks int null,
+        state varchar(20) not null default 'running',
+        INDEX(submit_timestamp)
+      );""")
+    if not jobs_table_exists:
+      self._backfill_jobs_table()
+    elif not self._execute_query("SHOW COLUMNS FROM dist_test_jobs LIKE 'failed_tasks'").fetchone():
+      # Added after the table. Failures of jobs already running are not counted.
+      self._execute_query("""
+        ALTER TABLE dist_test_jobs
+          ADD COLUMN failed_tasks int not null default 0 AFTER finished_groups,
+          ADD COLUMN max_failed_tasks int null AFTER failed_tasks""")
+    # Jobs as submitted, which the master registers and queues in chunks.
+    # 'task_order' is the JSON list of the indexes of the tasks in
+    # 'job_json', in the order they are queued, and 'enqueued_tasks' how many
+    # of them have been. The order is dropped once all of them are queued,
+    # while slaves keep reading the tasks from 'job_json'. 'isolate_hashes'
+    # is the JSON list of the job's distinct isolate hashes, in queue order.
+    self._execute_query("""
+      CREATE TABLE IF NOT EXISTS dist_test_submissions (
+        job_id varchar(100) not null primary key,
+        submit_timestamp timestamp not null default current_timestamp,
+        user varchar(100),
+        priority_class varchar(20) not null,
+        num_tasks int not null,
+        enqueued_tasks int not null default 0,
+        job_json longblob,
+        task_order longblob,
+        isolate_hashes mediumtext,
+        INDEX(submit_timestamp)
+      );""")
+    # The slaves whose isolate cache has all the blobs of an isolate, as the
+    # URL of their peer blob server.
+    self._execute_query("""
+      CREATE TABLE IF NOT EXISTS dist_test_isolate_peers (
+        isolate_hash varchar(100) not null,
+        peer_url varchar(100) not null,
+        update_timestamp timestamp not null default current_timestamp on update current_timestamp,
+        PRIMARY KEY(isolate_hash, peer_url),
+        INDEX(update_timestamp)
+      );""")
+    # The isolates in the cache of each slave which takes tasks by affinity.
+    self._execute_query("""
+      CREATE TABLE IF NOT EXISTS dist_test_slave_isolates (
+        isolate_hash varchar(100) not null,
+        slave_id varchar(100) not null,
+        update_timestamp timestamp not null default current_timestamp on update current_timestamp,
+        PRIMARY KEY(isolate_hash, slave_id),
+        INDEX(update_timestamp)
       );""")
+    if not self._execute_query(
+        "SHOW COLUMNS FROM dist_test_submissions LIKE 'isolate_hashes'").fetchone():
+      # Added after the table, for slaves to warm their isolate caches with.
+      self._execute_query("""
+        ALTER TABLE dist_test_submissions ADD COLUMN isolate_hashes mediumtext""")
+
+  def _backfill_jobs_table(self):
+    """Populate a newly created dist_test_jobs table from the last day of tasks."""
+    logging.info("Backfilling dist_test_jobs from dist_test_tasks")
+    self._execute_query("""
+      INSERT IGNORE INTO dist_test_jobs
+        (job_id, submit_timestamp, complete_timestamp, num_tasks, num_groups, finished_groups,
+         failed_tasks, state)
+      SELECT job_id,
+             MIN(submit_timestamp),
+             IF(SUM(status IS NULL) = 0, MAX(complete_timestamp), NULL),
+             COUNT(*),
+             COUNT(DISTINCT task_id),
+             IF(SUM(status IS NULL) = 0, COUNT(DISTINCT task_id), 0),
+             SUM(status IS NOT NULL AND status != 0),
+             IF(SUM(status IS NULL) = 0, 'finished', 'running')
+      FROM dist_test_tasks
+      WHERE submit_timestamp > now() - interval 1 day
+      GROUP BY job_id""")
 
 
-  def register_tasks(self, tasks):
+  def register_tasks(self, tasks, job_counted=False):
+    """Add rows for new tasks, or new attempts of tasks. If 'job_counted' is
+    set, the tasks were already counted in dist_test_jobs by
+    create_submission, and rows which already exist are left alone, so that
+    a chunk of a submission can be registered again after a restart."""
     tuples = []
     for task in tasks:
       tuples.append((task.job_id, task.task_id, task.attempt, task.max_retries, task.description))
     self._execute_query("""
-      INSERT INTO dist_test_tasks(job_id, task_id, attempt, max_retries, description) VALUES (%s, %s, %s, %s, %s)
-      """, tuples, use_executemany=True)
+      INSERT %s INTO dist_test_tasks(job_id, task_id, attempt, max_retries, description) VALUES (%%s, %%s, %%s, %%s, %%s)
+      """ % (job_counted and "IGNORE" or ""), tuples, use_executemany=True)
+    if job_counted:
+      return
+
+    # Count the new attempts, and the new groups (first attempts), per job.
+    counts = {}
+    for task in tasks:
+      num_tasks, num_groups = counts.get(task.job_id, (0, 0))
+      counts[task.job_id] = (num_tasks + 1, num_groups + (task.attempt == 0))
+    self._execute_query("""
+      INSERT INTO dist_test_jobs(job_id, num_tasks, num_groups)
+        VALUES (%s, %s, %s)
+      ON DUPLICATE KEY UPDATE
+        num_tasks = num_tasks + VALUES(num_tasks),
+        num_groups = num_groups + VALUES(num_groups)
+      """, [(job_id, n, g) for job_id, (n, g) in counts.iteritems()],
+      use_executemany=True)
+
+  def create_submission(self, job_id, job_json, task_order, isolate_hashes, user,
+                        priority_class, max_failed_tasks):
+    """Persist a newly submitted job, whose tasks are registered later, in
+    chunks, in the order of the indexes in 'task_order'. Its row in
+    dist_test_jobs already counts all of its tasks, so it does not look
+    finished in between. 'max_failed_tasks' sets its failure limit.
+    Returns False if the job was already submitted."""
+    with self.transaction():
+      c = self._execute_query("""
+        INSERT IGNORE INTO dist_test_submissions(job_id, user, priority_class, num_tasks,
+                                                 job_json, task_order, isolate_hashes)
+          VALUES (%(job_id)s, %(user)s, %(priority_class)s, %(num_tasks)s,
+                  %(job_json)s, %(task_order)s, %(isolate_hashes)s)""",
+        dict(job_id=job_id, user=user, priority_class=priority_class,
+             num_tasks=len(task_order), job_json=job_json, task_order=json.dumps(task_order),
+             isolate_hashes=json.dumps(isolate_hashes)))
+      if c.rowcount == 0:
+        return False
+      self._execute_query("""
+        INSERT INTO dist_test_jobs(job_id, num_tasks, num_groups, max_failed_tasks)
+          VALUES (%(job_id)s, %(num_tasks)s, %(num_tasks)s, %(max_failed_tasks)s)""",
+        dict(job_id=job_id, num_tasks=len(task_order), max_failed_tasks=max_failed_tasks))
+    return True
+
+  def record_submission_progress(self, job_id, enqueued_tasks):
+    """Record that the first 'enqueued_tasks' tasks of a submission are
+    registered and queued. Once all of them are, the task order is
+    dropped."""
+    self._execute_query("""
+      UPDATE dist_test_submissions SET
+        task_order = IF(%(enqueued_tasks)s >= num_tasks, NULL, task_order),
+        enqueued_tasks = %(enqueued_tasks)s
+      WHERE job_id = %(job_id)s""", dict(job_id=job_id, enqueued_tasks=enqueued_tasks))
+
+  def fetch_job_descriptor(self, job_id):
+    """Fetch the description and priority class of a submitted job, as a
+    row with 'job_json' and 'priority_class', or None if it is unknown."""
+    c = self._execute_query("""
+      SELECT job_json, priority_class FROM dist_test_submissions
+      WHERE job_id = %(job_id)s""", dict(job_id=job_id))
+    return c.fetchone()
+
+  def fetch_recent_isolate_hashes(self, window_secs, exclude_job_ids):
+    """Fetch the job_id and isolate_hashes of the jobs submitted within the
+    last 'window_secs' seconds, except those in 'exclude_job_ids'."""
+    query = """
+      SELECT job_id, isolate_hashes FROM dist_test_submissions
+      WHERE submit_timestamp > now() - interval %(window_secs)s second
+        AND isolate_hashes IS NOT NULL"""
+    if exclude_job_ids:
+      query += " AND job_id NOT IN %(exclude_job_ids)s"
+    c = self._execute_query(query + " ORDER BY submit_timestamp",
+                            dict(window_secs=int(window_secs),
+                                 exclude_job_ids=tuple(exclude_job_ids)))
+    return c.fetchall()
+
+  def advertise_isolate(self, isolate_hash, peer_url):
+    """Record that the peer blob server at 'peer_url' has the blobs of
+    'isolate_hash'."""
+    self._execute_query("""
+      INSERT INTO dist_test_isolate_peers(isolate_hash, peer_url)
+        VALUES (%(isolate_hash)s, %(peer_url)s)
+      ON DUPLICATE KEY UPDATE update_timestamp = now()""",
+      dict(isolate_hash=isolate_hash, peer_url=peer_url))
+
+  def fetch_isolate_peers(self, isolate_hash, limit=50):
+    """Return the URLs of the peer blob servers which had the blobs of
+    'isolate_hash' within the last day, most recent first."""
+    c = self._execute_query("""
+      SELECT peer_url FROM dist_test_isolate_peers
+      WHERE isolate_hash = %(isolate_hash)s
+        AND update_timestamp > now() - interval 1 day
+      ORDER BY update_timestamp DESC
+      LIMIT %(limit)s""", dict(isolate_hash=isolate_hash, limit=int(limit)))
+    return [row['peer_url'] for row in c.fetchall()]
+
+  def purge_isolate_peers(self):
+    """Forget the peers which have not advertised an isolate for a day."""
+    self._execute_query("""
+      DELETE FROM dist_test_isolate_peers
+      WHERE update_timestamp < now() - interval 1 day""")
+
+  def record_slave_isolate(self, slave_id, isolate_hash):
+    """Record that the slave 'slave_id' has 'isolate_hash' in its cache."""
+    self._execute_query("""
+      INSERT INTO dist_test_slave_isolates(isolate_hash, slave_id)
+        VALUES (%(isolate_hash)s, %(slave_id)s)
+      ON DUPLICATE KEY UPDATE update_timestamp = now()""",
+      dict(isolate_hash=isolate_hash, slave_id=slave_id))
+
+  def fetch_warm_slaves(self, isolate_hashes):
+    """Return a dict of each of 'isolate_hashes' to the ids of the slaves
+    which reported having it in their cache within the last hour."""
+    isolate_hashes = list(isolate_hashes)
+    if not isolate_hashes:
+      return {}
+    c = self._execute_query("""
+      SELECT isolate_hash, slave_id FROM dist_test_slave_isolates
+      WHERE isolate_hash IN (%s)
+        AND update_timestamp > now() - interval 1 hour""" %
+      ", ".join(["%s"] * len(isolate_hashes)), isolate_hashes)
+    warm_slaves = collections.defaultdict(list)
+    for row in c.fetchall():
+      warm_slaves[row['isolate_hash']].append(row['slave_id'])
+    return warm_slaves
+
+  def purge_slave_isolates(self):
+    """Forget the isolates which slaves have not reported for an hour."""
+    self._execute_query("""
+      DELETE FROM dist_test_slave_isolates
+      WHERE update_timestamp < now() - interval 1 hour""")
+
+  def fetch_unfinished_submissions(self):
+    """Fetch the submissions of the last day which still have tasks to
+    queue, unless their job was canceled."""
+    c = self._execute_query("""
+      SELECT s.*
+      FROM dist_test_submissions s
+      JOIN dist_test_jobs j ON j.job_id = s.job_id
+      WHERE s.submit_timestamp > now() - interval 1 day
+        AND s.enqueued_tasks < s.num_tasks
+        AND j.state = 'running'
+      ORDER BY s.submit_timestamp""")
+    return c.fetchall()
 
   def mark_task_running(self, task):
-    parms = dict(job_id=task.job_id,
-                 task_id=task.task_id,
-                 attempt=task.attempt,
-                 hostname=socket.gethostname())
-    q = self._execute_query("""
-      UPDATE dist_test_tasks SET
-        start_timestamp=now(),
-        hostname=%(hostname)s
-      WHERE job_id = %(job_id)s AND task_id = %(task_id)s AND attempt = %(attempt)s
-      AND status IS NULL""", parms)
-    return q.rowcount > 0
+    """Record that 'task' has started, returning False if it should not be
+    run because its attempt has already finished or been canceled."""
+    return self.record_tasks_running([(task, socket.gethostname())])[0]
 
+  def record_tasks_running(self, entries):
+    """Record the start of each (task, hostname) in 'entries', in a single
+    transaction. Returns a list with, for each entry, whether the task
+    should be run."""
+    with self.transaction():
+      rows = self.lock_task_rows([task for task, _ in entries])
+      started = []
+      run = []
+      for task, hostname in entries:
+        row = rows.get((task.job_id, task.task_id, task.attempt))
+        should_run = row is not None and row['status'] is None
+        run.append(should_run)
+        # The original run of the attempt owns its start time and hostname.
+        if should_run and not task.speculative:
+          started.append((task.job_id, task.task_id, task.attempt, task.description, hostname))
+      if started:
+        # Every row exists, so this only ever updates.
+        self._execute_query("""
+          INSERT INTO dist_test_tasks(job_id, task_id, attempt, description, hostname)
+            VALUES (%s, %s, %s, %s, %s)
+          ON DUPLICATE KEY UPDATE
+            start_timestamp = now(),
+            hostname = VALUES(hostname)""", started, use_executemany=True)
+    return run
+
+  def is_task_running(self, task):
+    """Return whether the attempt of 'task' is still awaiting its result."""
+    row = self.fetch_task(task.job_id, task.task_id, task.attempt)
+    return row is not None and row['status'] is None
 
   def cancel_job(self, job_id):
     parms = dict(result_code=-1,
@@ -252,89 +984,288 @@ class ResultsStore(object):
         stderr_abbrev = %(stderr_abbrev)s,
         complete_timestamp = now()
       WHERE job_id = %(job_id)s AND status IS NULL""", parms)
-    
-  def mark_task_finished(self, task, result_code, stdout, stderr, artifact_archive, duration_secs):
-    stdout_key = None
-    stdout_abbrev = ""
-    stderr_key = None
-    stderr_abbrev = ""
-    artifact_archive_key = None
+    self._execute_query("""
+      UPDATE dist_test_jobs SET
+        state = 'canceled',
+        complete_timestamp = now()
+      WHERE job_id = %(job_id)s AND state = 'running'""", parms)
+
+  def mark_task_finished(self, task, result_code, stdout, stderr, artifact_archive,
+                         download_secs, run_secs, archive_secs=0):
+    """Record the result of 'task'. The first result recorded for an attempt
+    wins: returns False, and discards the result, if the attempt was already
+    finished by a speculative duplicate or canceled."""
+    result = self.upload_task_result(task, result_code, stdout, stderr, artifact_archive,
+                                     download_secs, run_secs, archive_secs)
+    return self.record_task_results([result])[0]
+
+  def upload_task_result(self, task, result_code, stdout, stderr, artifact_archive,
+                         download_secs, run_secs, archive_secs=0):
+    """Upload the output of 'task' to the blob store, returning a TaskResult
+    to be recorded with record_task_results. The time taken by the upload is
+    added to 'archive_secs' for the result's upload phase."""
+    start = time.time()
+    result = TaskResult(task, result_code, socket.gethostname(), download_secs, run_secs)
+    # A speculative run uploads its output under separate keys, so that the
+    # losing run of an attempt never overwrites the winner's.
+    output_id = task.get_id()
+    if task.speculative:
+      output_id += ".speculative"
 
     if stdout:
-      stdout_key = "%s.stdout" % task.get_id()
-      stdout_abbrev = stdout[0:100]
-      self._upload_string_to_s3(stdout_key, stdout)
-      logging.info("Uploaded stdout for %s to S3" % task.get_id())
+      result.stdout_key = "%s.stdout" % output_id
+      result.stdout_abbrev = stdout[0:100]
+      self.blob_store.put_string(result.stdout_key, stdout)
+      logging.info("Uploaded stdout for %s" % task.get_id())
 
     if stderr:
-      stderr_key = "%s.stderr" % task.get_id()
-      stderr_abbrev = stderr[0:100]
-      self._upload_string_to_s3(stderr_key, stderr)
-      logging.info("Uploaded stderr for %s to S3" % task.get_id())
+      result.stderr_key = "%s.stderr" % output_id
+      result.stderr_abbrev = stderr[0:100]
+      self.blob_store.put_string(result.stderr_key, stderr)
+      logging.info("Uploaded stderr for %s" % task.get_id())
 
     if artifact_archive:
-      artifact_archive_key = "%s-artifacts.zip" % task.get_id()
-      self._upload_string_to_s3(artifact_archive_key, artifact_archive.getvalue())
-      logging.info("Uploaded artifact archive for %s to S3" % task.get_id())
-
-    parms = dict(result_code=result_code,
-                 job_id=task.job_id,
-                 task_id=task.task_id,
-                 attempt=task.attempt,
-                 stdout_key=stdout_key,
-                 stdout_abbrev=stdout_abbrev,
-                 stderr_key=stderr_key,
-                 stderr_abbrev=stderr_abbrev,
-                 artifact_archive_key=artifact_archive_key,
-                 description=task.description,
-                 duration_secs=duration_secs)
+      result.artifact_archive_key = "%s-artifacts.zip" % output_id
+      self.blob_store.put_file(result.artifact_archive_key, artifact_archive)
+      logging.info("Uploaded artifact archive for %s" % task.get_id())
+    result.upload_secs = archive_secs + time.time() - start
+    return result
+
+  def record_task_results(self, results):
+    """Record a batch of TaskResults in a single transaction, with one
+    statement per table, plus one per job for its counters. Returns a list
+    with, for each result, whether it was recorded.
+
+    The first result recorded for an attempt wins. A result that is already
+    recorded, as when a write is retried after its commit was not
+    acknowledged, counts as recorded without being applied again."""
+    with self.transaction():
+      rows = self.lock_task_rows([r.task for r in results])
+      recorded = []
+      winners = []
+      for r in results:
+        row = rows.get((r.task.job_id, r.task.task_id, r.task.attempt))
+        if row is not None and row['status'] is None:
+          recorded.append(True)
+          winners.append(r)
+          # Later results for the attempt in this batch lose.
+          row.update(status=r.result_code, hostname=r.hostname,
+                     stdout_key=r.stdout_key, stderr_key=r.stderr_key)
+        else:
+          recorded.append(row is not None and r.matches(row))
+      if not winners:
+        return recorded
+
+      # Every row exists, so this only ever updates.
+      self._execute_query("""
+        INSERT INTO dist_test_tasks(job_id, task_id, attempt, description, status, hostname,
+                                    stdout_key, stdout_abbrev, stderr_key, stderr_abbrev,
+                                    artifact_archive_key)
+          VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+          status = VALUES(status),
+          hostname = VALUES(hostname),
+          stdout_key = VALUES(stdout_key),
+          stdout_abbrev = VALUES(stdout_abbrev),
+          stderr_key = VALUES(stderr_key),
+          stderr_abbrev = VALUES(stderr_abbrev),
+          artifact_archive_key = VALUES(artifact_archive_key),
+          complete_timestamp = now()""",
+        [(r.task.job_id, r.task.task_id, r.task.attempt, r.task.description, r.result_code,
+          r.hostname, r.stdout_key, r.stdout_abbrev, r.stderr_key, r.stderr_abbrev,
+          r.artifact_archive_key) for r in winners],
+        use_executemany=True)
+
+      # An attempt finishes its group if it succeeded or was the last retry.
+      job_counts = collections.defaultdict(lambda: dict(failed=0, finished_groups=0))
+      for r in winners:
+        counts = job_counts[r.task.job_id]
+        counts['failed'] += int(r.result_code != 0)
+        counts['finished_groups'] += int(r.result_code == 0 or r.task.attempt >= r.task.max_retries)
+      # MySQL applies the assignments in order, so the later ones see the
+      # incremented finished_groups.
+      for job_id, counts in sorted(job_counts.iteritems()):
+        self._execute_query("""
+          UPDATE dist_test_jobs SET
+            failed_tasks = failed_tasks + %(failed)s,
+            finished_groups = finished_groups + %(finished_groups)s,
+            complete_timestamp = IF(%(finished_groups)s AND state = 'running' AND
+                                      finished_groups >= num_groups,
+                                    now(), complete_timestamp),
+            state = IF(%(finished_groups)s AND state = 'running' AND finished_groups >= num_groups,
+                       'finished', state)
+          WHERE job_id = %(job_id)s""", dict(counts, job_id=job_id))
+
+      self._record_duration_samples([r for r in winners if r.result_code == 0])
+    return recorded
+
+  def _record_duration_samples(self, results):
+    """Add the phase durations of successful 'results' to the samples of
+    their descriptions, and recompute the statistics of those descriptions
+    from their last DURATION_MAX_SAMPLES samples within the decay window.
+    Older samples are deleted."""
+    if not results:
+      return
     self._execute_query("""
-      UPDATE dist_test_tasks SET
-        status = %(result_code)s,
-        stdout_key = %(stdout_key)s,
-        stdout_abbrev = %(stdout_abbrev)s,
-        stderr_key = %(stderr_key)s,
-        stderr_abbrev = %(stderr_abbrev)s,
-        artifact_archive_key = %(artifact_archive_key)s,
-        complete_timestamp = now()
-      WHERE job_id = %(job_id)s AND task_id = %(task_id)s AND attempt = %(attempt)s""", parms)
+      INSERT INTO dist_test_duration_samples(description, download_secs, run_secs, upload_secs)
+        VALUES (%s, %s, %s, %s)""",
+      [(r.task.description, r.download_secs, r.run_secs, r.upload_secs) for r in results],
+      use_executemany=True)
+
+    descriptions = sorted(set(r.task.description for r in results))
+    c = self._execute_query("""
+      SELECT id, description, download_secs, run_secs, upload_secs
+      FROM dist_test_duration_samples
+      WHERE description IN %(descriptions)s
+        AND complete_timestamp > now() - interval %(window_days)s day
+      ORDER BY id DESC""",
+      dict(descriptions=tuple(descriptions), window_days=self.DURATION_WINDOW_DAYS))
+    samples = collections.defaultdict(list)
+    for row in c.fetchall():
+      if len(samples[row['description']]) < self.DURATION_MAX_SAMPLES:
+        samples[row['description']].append(row)
+
+    stats = []
+    oldest_ids = []
+    for description in descriptions:
+      rows = samples[description]
+      phases = dict((phase, [r[phase + "_secs"] for r in rows])
+                    for phase in ["download", "run", "upload"])
+      phases["total"] = [r["download_secs"] + r["run_secs"] + r["upload_secs"] for r in rows]
+      values = [description, len(rows)]
+      for phase in DURATION_PHASES:
+        values += [metrics.quantile(phases[phase], 0.5), metrics.quantile(phases[phase], 0.9)]
+      stats.append(values)
+      oldest_ids += [description, rows[-1]['id']]
 
-    # Update entry for the description in the dist_test_durations table
     self._execute_query("""
-      INSERT INTO dist_test_durations
-        VALUES (%(description)s, %(task_id)s, %(duration_secs)s)
-      ON DUPLICATE KEY
-        UPDATE task_id = %(task_id)s, duration_secs = (duration_secs * 0.7) + (%(duration_secs)s * 0.3)""", parms)
+      INSERT INTO dist_test_duration_stats
+        (description, num_samples, download_p50, download_p90, run_p50, run_p90,
+         upload_p50, upload_p90, total_p50, total_p90)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+      ON DUPLICATE KEY UPDATE
+        num_samples = VALUES(num_samples),
+        download_p50 = VALUES(download_p50), download_p90 = VALUES(download_p90),
+        run_p50 = VALUES(run_p50), run_p90 = VALUES(run_p90),
+        upload_p50 = VALUES(upload_p50), upload_p90 = VALUES(upload_p90),
+        total_p50 = VALUES(total_p50), total_p90 = VALUES(total_p90)""",
+      stats, use_executemany=True)
+    self._execute_query("""
+      DELETE FROM dist_test_duration_samples WHERE %s""" %
+      " OR ".join(["(description = %s AND id < %s)"] * len(descriptions)), oldest_ids)
 
-  def count_num_failed_tasks(self, task):
-    parms = dict(job_id=task.job_id)
+  def lock_task_rows(self, tasks):
+    """Lock the rows of the attempts of 'tasks' until the end of the current
+    transaction. Returns a dict of (job_id, task_id, attempt) to row. The keys
+    are given as OR-ed equalities, since MySQL before 5.7.3 scans the table,
+    locking every row, for an IN list of row constructors."""
+    # Lock in a consistent order, to avoid deadlocks between batches.
+    keys = sorted(set((t.job_id, t.task_id, t.attempt) for t in tasks))
     c = self._execute_query("""
-      SELECT COUNT(*) as count FROM dist_test_tasks WHERE
-        job_id = %(job_id)s AND
-        status != 0
-    """, parms)
+      SELECT job_id, task_id, attempt, status, hostname, stdout_key, stderr_key
+      FROM dist_test_tasks
+      WHERE %s
+      ORDER BY job_id, task_id, attempt
+      FOR UPDATE""" % " OR ".join(["(job_id = %s AND task_id = %s AND attempt = %s)"] * len(keys)),
+      [v for key in keys for v in key])
+    return dict(((r['job_id'], r['task_id'], r['attempt']), r) for r in c.fetchall())
+
+  def has_too_many_failures(self, job_id):
+    """Return whether more of the job's tasks have failed than its limit."""
+    c = self._execute_query("""
+      SELECT failed_tasks, max_failed_tasks FROM dist_test_jobs
+      WHERE job_id = %(job_id)s""", dict(job_id=job_id))
     row = c.fetchone()
-    return row["count"]
+    if row is None:
+      return False
+    max_failed_tasks = row['max_failed_tasks']
+    if max_failed_tasks is None:
+      max_failed_tasks = DEFAULT_MAX_FAILED_TASKS
+    return row['failed_tasks'] > max_failed_tasks
 
   def generate_output_link(self, key):
-    expiry = 60 * 60 * 24 # link should last 1 day
-    k = boto.s3.key.Key(self.s3_bucket)
-    k.key = key
-    return k.generate_url(expiry)
+    return self.blob_store.generate_url(key)
 
   def fetch_recent_job_rows(self):
     c = self._execute_query("""
-        select jobs.job_id,
-               min(submit_timestamp) as submit_timestamp,
-               count(*) as num_tasks from dist_test_tasks
-        join (select distinct (job_id) from dist_test_tasks
-              where submit_timestamp > now() - interval 1 day)
-        jobs on jobs.job_id = dist_test_tasks.job_id
-        group by jobs.job_id
-        order by submit_timestamp desc;
+        SELECT job_id, submit_timestamp, complete_timestamp, num_tasks, state
+        FROM dist_test_jobs
+        WHERE submit_timestamp > now() - interval 1 day
+        ORDER BY submit_timestamp DESC
     """)
     return c.fetchall()
 
+  def fetch_recent_task_timings(self, window_secs):
+    """Fetch histograms of the queue wait of the tasks that started in the
+    last 'window_secs' seconds, and of the run time of those that finished
+    in it. Returns a dict with 'queue_wait_secs' and 'run_secs', each a list
+    of (seconds, number of tasks). The histograms are counted in MySQL, over
+    the last day of tasks, using the submit_timestamp index."""
+    timings = {}
+    for name, secs_expr, timestamp in [
+        ("queue_wait_secs", "TIMESTAMPDIFF(SECOND, submit_timestamp, start_timestamp)",
+         "start_timestamp"),
+        ("run_secs", "TIMESTAMPDIFF(SECOND, start_timestamp, complete_timestamp)",
+         "complete_timestamp")]:
+      c = self._execute_query("""
+        SELECT %s AS secs, COUNT(*) AS num_tasks
+        FROM dist_test_tasks
+        WHERE submit_timestamp > now() - interval 1 day
+          AND start_timestamp IS NOT NULL
+          AND %s > now() - interval %%(window_secs)s second
+        GROUP BY secs""" % (secs_expr, timestamp), dict(window_secs=int(window_secs)))
+      timings[name] = [(row['secs'], int(row['num_tasks'])) for row in c.fetchall()]
+    return timings
+
+  def fetch_outstanding_work(self, default_duration_secs):
+    """Estimate the work remaining in unfinished tasks from their median
+    durations, using 'default_duration_secs' for tasks never run before.
+
+    Returns a dict with the number of queued and running tasks, and the
+    estimated seconds of work left in each. A running task is expected to
+    need its last duration less the time it has run so far."""
+    c = self._execute_query("""
+      SELECT SUM(t.start_timestamp IS NULL) AS queued_tasks,
+             SUM(t.start_timestamp IS NOT NULL) AS running_tasks,
+             SUM(IF(t.start_timestamp IS NULL,
+                    IFNULL(d.total_p50, %(default_duration_secs)s), 0)) AS queued_work_secs,
+             SUM(IF(t.start_timestamp IS NULL, 0,
+                    GREATEST(IFNULL(d.total_p50, %(default_duration_secs)s) -
+                             TIMESTAMPDIFF(SECOND, t.start_timestamp, now()), 0))) AS running_work_secs
+      FROM dist_test_tasks t
+      LEFT JOIN dist_test_duration_stats d ON d.description = t.description
+      WHERE t.submit_timestamp > now() - interval 1 day
+        AND t.status IS NULL""", dict(default_duration_secs=int(default_duration_secs)))
+    row = c.fetchone()
+    # MySQL returns SUM()s as decimals, or NULL if there are no rows
+    return dict((k, int(v or 0)) for k, v in row.iteritems())
+
+  def fetch_stragglers(self, slowdown, min_overrun_secs, max_remaining_fraction, limit):
+    """Fetch running attempts which have taken over 'slowdown' times the p90
+    of their durations plus 'min_overrun_secs', in jobs with at most
+    'max_remaining_fraction' of their tasks (and at least one) unfinished.
+    Returns at most 'limit' rows, the most overdue first."""
+    c = self._execute_query("""
+      SELECT t.job_id, t.task_id, t.attempt, t.description,
+             TIMESTAMPDIFF(SECOND, t.start_timestamp, now()) AS run_secs,
+             d.total_p90
+      FROM dist_test_jobs j
+      JOIN dist_test_tasks t ON t.job_id = j.job_id
+      JOIN dist_test_duration_stats d ON d.description = t.description
+      WHERE j.submit_timestamp > now() - interval 1 day
+        AND j.state = 'running'
+        AND j.num_groups - j.finished_groups <=
+            GREATEST(j.num_groups * %(max_remaining_fraction)s, 1)
+        AND t.status IS NULL
+        AND t.start_timestamp IS NOT NULL
+        AND TIMESTAMPDIFF(SECOND, t.start_timestamp, now()) >
+            d.total_p90 * %(slowdown)s + %(min_overrun_secs)s
+      ORDER BY TIMESTAMPDIFF(SECOND, t.start_timestamp, now()) - d.total_p90 DESC
+      LIMIT %(limit)s""",
+      dict(slowdown=float(slowdown), min_overrun_secs=int(min_overrun_secs),
+           max_remaining_fraction=float(max_remaining_fraction), limit=int(limit)))
+    return c.fetchall()
+
   def fetch_task(self, job_id, task_id, attempt):
     c = self._execute_query(
       "SELECT * FROM dist_test_tasks WHERE job_id = %(job_id)s AND task_id = %(task_id)s AND attempt = %(attempt)s",
@@ -347,32 +1278,183 @@ class ResultsStore(object):
       dict(job_id=job_id))
     return c.fetchall()
 
-  def fetch_recent_task_durations(self, tasks):
-    """For each task, determine the duration of its last completed run.
-    This is possibly inaccurate, since it identifies a task purely based
-    on its description."""
-    if len(tasks) == 0:
-      return {}
-    # Need to manually construct the values for WHERE IN clause, no support from MySQLdb
-    escaped_descs = ["'" + str(MySQLdb.escape_string(task.description)) + "'" for task in tasks]
-    where_values = ', '.join(escaped_descs)
-    # Fetch duration of last completed run from the dist_test_durations table
-    query = """
-      SELECT description, duration_secs FROM dist_test_durations
-      WHERE description in (%s);
-    """ % (where_values)
-    c = self._execute_query(query)
+  def fetch_task_rows_for_task_ids(self, job_id, task_ids):
+    """Fetch all attempts of the given task IDs of a job."""
+    if len(task_ids) == 0:
+      return []
+    c = self._execute_query(
+      "SELECT * FROM dist_test_tasks WHERE job_id = %(job_id)s AND task_id IN %(task_ids)s",
+      dict(job_id=job_id, task_ids=tuple(task_ids)))
     return c.fetchall()
 
-  def _upload_string_to_s3(self, key, data):
-    k = boto.s3.key.Key(self.s3_bucket)
-    k.key = key
-    # The Content-Disposition header sets the filename that the browser
-    # will use to download this.
-    # We have to cast to str() here, because boto will try to escape the header
-    # incorrectly if you pass a unicode string.
-    k.set_metadata('Content-Disposition', str('inline; filename=%s' % key))
-    k.set_contents_from_string(data, reduced_redundancy=True)
+  # SQL conditions on dist_test_tasks rows (aliased as 't') for each task
+  # status filter supported by the job page and tasks API.
+  #
+  # 'flaky' only matches failed attempts of tasks that later succeeded. Unlike
+  # TaskGroup, it doesn't consider failures that are still awaiting a retry.
+  TASK_STATUS_FILTERS = {
+    None: "TRUE",
+    "running": "t.status IS NULL",
+    "finished": "t.status IS NOT NULL",
+    "succeeded": "t.status = 0",
+    "failed": "t.status != 0",
+    "timedout": "t.status = -9",
+    "flaky": """t.status != 0 AND EXISTS (
+                  SELECT 1 FROM dist_test_tasks s
+                  WHERE s.job_id = t.job_id AND s.task_id = t.task_id AND s.status = 0)""",
+  }
+
+  # Sortable task columns. NULLs are mapped to values that sort first, since
+  # cursors can't compare against NULL. Tasks which are still running have no
+  # runtime yet, so that the order does not change from one page to the next.
+  TASK_SORT_EXPRESSIONS = {
+    "task_id": "t.task_id",
+    "attempt": "t.attempt",
+    "description": "t.description",
+    "hostname": "COALESCE(t.hostname, '')",
+    "status": "COALESCE(t.status, -2147483648)",
+    "runtime": "COALESCE(TIMESTAMPDIFF(SECOND, t.start_timestamp, t.complete_timestamp), -1)",
+  }
+
+  @staticmethod
+  def _encode_cursor(row):
+    return base64.urlsafe_b64encode(json.dumps([row['sort_value'], row['task_id'], row['attempt']]))
+
+  @staticmethod
+  def _decode_cursor(cursor):
+    try:
+      sort_value, task_id, attempt = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except Exception:
+      raise ValueError("Invalid cursor %s" % cursor)
+    return dict(cursor_sort_value=sort_value, cursor_task_id=task_id, cursor_attempt=attempt)
+
+  def fetch_task_rows_page(self, job_id, status=None, sort="task_id", descending=False,
+                           cursor=None, limit=100):
+    """Fetch one page of the task rows of a job, filtered by 'status' (a key of
+    TASK_STATUS_FILTERS) and ordered by 'sort' (a key of TASK_SORT_EXPRESSIONS).
+
+    Pages are addressed by opaque cursors rather than offsets, so that rows
+    before the page are not read and skipped. In 'task_id' order, a page is a
+    range scan of the primary key; other orders sort the job's matching rows.
+    A 'limit' of None fetches all remaining rows.
+    Returns a tuple of (rows, next_cursor). next_cursor is None on the last page."""
+    if status not in self.TASK_STATUS_FILTERS:
+      raise ValueError("Unknown status type %s" % status)
+    if sort not in self.TASK_SORT_EXPRESSIONS:
+      raise ValueError("Unknown sort column %s" % sort)
+    sort_expr = self.TASK_SORT_EXPRESSIONS[sort]
+    if descending:
+      op, order = "<", "DESC"
+    else:
+      op, order = ">", "ASC"
+
+    parms = dict(job_id=job_id)
+    query = """
+      SELECT t.*, %s AS sort_value FROM dist_test_tasks t
+      WHERE t.job_id = %%(job_id)s AND %s""" % (sort_expr, self.TASK_STATUS_FILTERS[status])
+    if cursor is not None:
+      parms.update(self._decode_cursor(cursor))
+      query += """
+        AND (%s, t.task_id, t.attempt) %s
+            (%%(cursor_sort_value)s, %%(cursor_task_id)s, %%(cursor_attempt)s)""" % (sort_expr, op)
+    query += """
+      ORDER BY sort_value %s, t.task_id %s, t.attempt %s""" % (order, order, order)
+    if limit is not None:
+      # Fetch one extra row to find out whether there is another page.
+      query += " LIMIT %d" % (limit + 1)
+    rows = self._execute_query(query, parms).fetchall()
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+      rows = rows[:limit]
+      next_cursor = self._encode_cursor(rows[-1])
+    return rows, next_cursor
+
+  def fetch_job_summary(self, job_id):
+    """Compute the task- and group-level counts of a job in MySQL, with the
+    same semantics as TaskGroup. 'flaky_tasks' counts the attempts which the
+    'flaky' status filter matches. Returns None if the job has no tasks."""
+    c = self._execute_query("""
+      SELECT COUNT(*) AS total_groups,
+             SUM(num_tasks) AS total_tasks,
+             SUM(finished) AS finished_tasks,
+             SUM(running) AS running_tasks,
+             SUM(retried) AS retried_tasks,
+             SUM(timedout) AS timedout_tasks,
+             SUM(failed) AS failed_tasks,
+             SUM(succeeded) AS succeeded_tasks,
+             SUM(is_failed) AS failed_groups,
+             SUM(succeeded > 0) AS succeeded_groups,
+             SUM(is_flaky) AS flaky_groups,
+             SUM(succeeded > 0 OR is_failed) AS finished_groups,
+             SUM(IF(succeeded > 0, failed, 0)) AS flaky_tasks,
+             MIN(submit_timestamp) AS submit_timestamp,
+             MAX(complete_timestamp) AS complete_timestamp
+      FROM (
+        SELECT *,
+               failed = num_tasks AND out_of_retries > 0 AS is_failed,
+               (failed = num_tasks AND out_of_retries = 0) OR
+                 (succeeded > 0 AND failed > 0) AS is_flaky
+        FROM (
+          SELECT COUNT(*) AS num_tasks,
+                 SUM(status IS NOT NULL) AS finished,
+                 SUM(status IS NULL) AS running,
+                 SUM(attempt > 0) AS retried,
+                 SUM(status <=> -9) AS timedout,
+                 SUM(status IS NOT NULL AND status != 0) AS failed,
+                 SUM(status <=> 0) AS succeeded,
+                 SUM(attempt = max_retries) AS out_of_retries,
+                 MIN(submit_timestamp) AS submit_timestamp,
+                 MAX(complete_timestamp) AS complete_timestamp
+          FROM dist_test_tasks
+          WHERE job_id = %(job_id)s
+          GROUP BY task_id) task_counts) group_counts""", dict(job_id=job_id))
+    row = c.fetchone()
+    if row is None or row['total_groups'] == 0:
+      return None
+    summary = {}
+    for k, v in row.iteritems():
+      if k.endswith("_timestamp"):
+        summary[k] = v
+      else:
+        # MySQL returns SUM()s as decimals
+        summary[k] = int(v or 0)
+    return summary
+
+  def purge_duration_stats(self):
+    """Delete the statistics of the descriptions which have no successful
+    run within the decay window, such as tests which now always fail, along
+    with their remaining samples. Statistics are otherwise only recomputed
+    when a run succeeds. Returns the descriptions deleted."""
+    c = self._execute_query("""
+      SELECT s.description FROM dist_test_duration_stats s
+      WHERE s.update_timestamp < now() - interval %(window_days)s day
+        AND NOT EXISTS (
+          SELECT 1 FROM dist_test_duration_samples d
+          WHERE d.description = s.description
+            AND d.complete_timestamp > now() - interval %(window_days)s day)""",
+      dict(window_days=self.DURATION_WINDOW_DAYS))
+    descriptions = [row['description'] for row in c.fetchall()]
+    if descriptions:
+      with self.transaction():
+        self._execute_query("""
+          DELETE FROM dist_test_duration_stats WHERE description IN %(descriptions)s""",
+          dict(descriptions=tuple(descriptions)))
+        self._execute_query("""
+          DELETE FROM dist_test_duration_samples WHERE description IN %(descriptions)s""",
+          dict(descriptions=tuple(descriptions)))
+    return descriptions
+
+  def fetch_duration_stats_since(self, timestamp=None):
+    """Return the rows of dist_test_duration_stats updated at or after
+    'timestamp', a datetime in MySQL's clock, or all rows if it is None."""
+    if timestamp is None:
+      c = self._execute_query("SELECT * FROM dist_test_duration_stats")
+    else:
+      c = self._execute_query(
+        "SELECT * FROM dist_test_duration_stats WHERE update_timestamp >= %(timestamp)s",
+        dict(timestamp=timestamp))
+    return c.fetchall()
 
 def configure_logger(logger, filename):
   handlers = []
@@ -0,0 +1,58 @@
+import datetime
+import logging
+import threading
+
+class DurationCache(object):
+  """In-memory copy of the median durations in dist_test_duration_stats,
+  so that sorting the tasks of a job does not query MySQL.
+
+  The first lookup loads every row. After that, refresh() fetches only the
+  rows updated since the newest one seen, so statistics of tasks which
+  finished meanwhile show up at the next refresh. Rows are re-fetched with
+  an overlap of 'overlap_secs', since a transaction can commit a row some
+  time after its update_timestamp was set."""
+
+  def __init__(self, results_store, overlap_secs=60):
+    self.results_store = results_store
+    self.overlap = datetime.timedelta(seconds=overlap_secs)
+    # description -> total_p50
+    self.durations = {}
+    self.newest_update = None
+    self.loaded = False
+    self.lock = threading.Lock()
+
+  def refresh(self):
+    """Fetch the statistics updated since the last refresh, or all of them
+    the first time."""
+    with self.lock:
+      since = None
+      if self.newest_update is not None:
+        since = self.newest_update - self.overlap
+      rows = self.results_store.fetch_duration_stats_since(since)
+      updates = {}
+      for row in rows:
+        updates[row['description']] = row['total_p50']
+        if self.newest_update is None or row['update_timestamp'] > self.newest_update:
+          self.newest_update = row['update_timestamp']
+      # A single dict.update, so that lookups never see half of a refresh.
+      self.durations.update(updates)
+      if not self.loaded:
+        logging.info("Loaded the durations of %d tasks", len(updates))
+      self.loaded = True
+
+  def forget(self, descriptions):
+    """Drop the durations of 'descriptions', whose statistics were deleted."""
+    with self.lock:
+      durations = dict(self.durations)
+      for description in descriptions:
+        durations.pop(description, None)
+      # Replaced whole, like a refresh.
+      self.durations = durations
+
+  def get_durations(self, descriptions):
+    """Return a dict of description to the median duration of successful
+    runs, for those of 'descriptions' which have run before."""
+    if not self.loaded:
+      self.refresh()
+    durations = self.durations
+    return dict((d, durations[d]) for d in set(descriptions) if d in durations)
@@ -1,56 +1,106 @@
 #!/usr/bin/env python
 
+import autoscale
+import calendar
+import datetime
+import json
 import logging
-import re
+import optparse
 import subprocess
 import time
 import urllib2
 
 DIST_TEST_URL = "http://dist-test.cloudera.org"
-# GCE bills 10-minute minimum, so if we've started instances
-# more recently than 10 minutes ago, we shouldn't shut them down.
-SHRINK_LAG = 600
-
-def get_stats():
-  page = urllib2.urlopen(DIST_TEST_URL).read()
-  m = re.search("Queue length: (\d+).*Running: (\d+)", page, re.DOTALL)
-  if not m:
-    raise Exception("Bad page content")
-  return dict(queue_len=int(m.group(1)), running=int(m.group(2)))
-
-def resize(num_nodes):
-  logging.info("Setting num nodes to %d" % num_nodes)
-  subprocess.check_call(
-     ("gcloud compute instance-groups managed resize " +
-     "dist-test-slave-group --size=%d" % num_nodes).split(" "),
-     stdout=file("/dev/null", "w"))
-
-def get_target_size():
-  output = subprocess.check_output(
-    'gcloud compute instance-groups managed describe dist-test-slave-group'.split(" "))
-  m = re.search('targetSize: (\d+)', output)
-  return int(m.group(1))
-    
+INSTANCE_GROUP = "dist-test-slave-group"
+# GCE bills a 10-minute minimum, then per minute.
+BILLING_MINIMUM_SECS = 600
+BILLING_PERIOD_SECS = 60
+
+def get_stats(url):
+  return json.load(urllib2.urlopen(url + "/stats.json"))
+
+def parse_timestamp(ts):
+  """Convert an RFC 3339 timestamp, as returned by gcloud
+  (e.g. 2016-03-01T10:20:30.123-08:00), to seconds since the epoch."""
+  base, offset = ts[:19], ts[19:].lstrip("0123456789.")
+  secs = calendar.timegm(datetime.datetime.strptime(base, "%Y-%m-%dT%H:%M:%S").timetuple())
+  if offset and offset != "Z":
+    sign = -1 if offset[0] == "-" else 1
+    hours, minutes = offset[1:].split(":")
+    secs -= sign * (int(hours) * 3600 + int(minutes) * 60)
+  return secs
+
+def gcloud_json(cmd):
+  return json.loads(subprocess.check_output(["gcloud"] + cmd + ["--format=json"]))
+
+class GceProvider(autoscale.Provider):
+  """Slaves in a GCE managed instance group."""
+
+  def __init__(self, group):
+    self.group = group
+
+  def list_nodes(self):
+    names = set(i['instance'].split("/")[-1] for i in
+                gcloud_json(["compute", "instance-groups", "managed", "list-instances", self.group]))
+    nodes = []
+    for i in gcloud_json(["compute", "instances", "list"]):
+      if i['name'] in names:
+        nodes.append(autoscale.Node(i['name'], parse_timestamp(i['creationTimestamp'])))
+        names.remove(i['name'])
+    # Instances which the group is still creating are not listed yet.
+    for name in sorted(names):
+      nodes.append(autoscale.Node(name, time.time()))
+    return nodes
+
+  def _resize(self, num_nodes):
+    logging.info("Setting num nodes to %d" % num_nodes)
+    subprocess.check_call(
+       ["gcloud", "compute", "instance-groups", "managed", "resize",
+        self.group, "--size=%d" % num_nodes],
+       stdout=file("/dev/null", "w"))
+
+  def grow_to(self, num_nodes):
+    # The group may already be growing to more nodes than are listed.
+    target_size = gcloud_json(["compute", "instance-groups", "managed", "describe",
+                               self.group])['targetSize']
+    if num_nodes > target_size:
+      self._resize(num_nodes)
+
+  def remove_nodes(self, names):
+    # Deleting instances from a managed group also reduces its target size.
+    subprocess.check_call(
+       ["gcloud", "compute", "instance-groups", "managed", "delete-instances",
+        self.group, "--instances=%s" % ",".join(names)],
+       stdout=file("/dev/null", "w"))
 
 def main():
   logging.basicConfig(level=logging.INFO)
-  last_size = get_target_size()
-  logging.info("initial size: %d" % last_size)
-  last_grow_time = 0
+  p = optparse.OptionParser(usage="usage: %prog [options]")
+  p.add_option("--url", default=DIST_TEST_URL, help="dist_test master URL")
+  p.add_option("--group", default=INSTANCE_GROUP, help="managed instance group of the slaves")
+  p.add_option("--target-secs", type="int", default=600,
+               help="time in which the outstanding work should be done")
+  p.add_option("--executors-per-node", type="int", default=1,
+               help="number of slave processes run on each node")
+  p.add_option("--min-nodes", type="int", default=1)
+  p.add_option("--max-nodes", type="int", default=100)
+  p.add_option("--shrink-delay-secs", type="int", default=600,
+               help="only shrink to the largest size wanted during this long")
+  options, args = p.parse_args()
+
+  scaler = autoscale.Autoscaler(GceProvider(options.group),
+                                target_secs=options.target_secs,
+                                executors_per_node=options.executors_per_node,
+                                min_nodes=options.min_nodes,
+                                max_nodes=options.max_nodes,
+                                shrink_delay_secs=options.shrink_delay_secs,
+                                billing_minimum_secs=BILLING_MINIMUM_SECS,
+                                billing_period_secs=BILLING_PERIOD_SECS)
   while True:
     try:
-      stats = get_stats()
-      logging.info(stats)
-      new_size = last_size
-      if stats['queue_len'] > 0:
-        new_size = min(100, last_size + 10)
-        last_grow_time = time.time()
-      elif stats['queue_len'] + stats['running'] == 0 and \
-           time.time() - last_grow_time > SHRINK_LAG:
-        new_size = 1
-      if new_size != last_size:
-        resize(new_size)
-        last_size = new_size
+      stats = get_stats(options.url)
+      logging.info(stats['outstanding_work'])
+      scaler.step(stats)
     except Exception, e:
       logging.warning("had error" + repr(e))
     time.sleep(10)
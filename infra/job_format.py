@@ -0,0 +1,88 @@
+"""The compact form of job descriptions.
+
+A job description is a dict whose 'tasks' list describes its tasks. In the
+compact form, fields shared by most tasks are given once in the job's
+'task_defaults', which each task may override, and a task which is repeated
+N times in a row is given once, with a 'count' of N:
+
+  {"task_defaults": {"timeout": 600, "artifact_archive_globs": ["**/*.xml"]},
+   "tasks": [{"isolate_hash": "fa0f...", "description": "foo-test", "count": 100},
+             {"isolate_hash": "9c1e...", "description": "bar-test", "timeout": 1200}]}
+
+Descriptions without either are already in the compact form.
+"""
+
+import bisect
+
+class TaskIndex(object):
+  """Random access to the tasks of a job description in the compact form,
+  without expanding it."""
+
+  def __init__(self, job_desc):
+    self.defaults = job_desc.get('task_defaults', {})
+    self.entries = job_desc['tasks']
+    # The index of the task after the last repetition of each entry.
+    self.ends = []
+    end = 0
+    for entry in self.entries:
+      end += entry.get('count', 1)
+      self.ends.append(end)
+
+  def __len__(self):
+    return self.ends and self.ends[-1] or 0
+
+  def task(self, index):
+    """Return a new dict for the task at 'index' of the expanded tasks."""
+    if not 0 <= index < len(self):
+      raise IndexError("Task index %d out of range" % index)
+    task_desc = dict(self.defaults)
+    task_desc.update(self.entries[bisect.bisect_right(self.ends, index)])
+    task_desc.pop('count', None)
+    return task_desc
+
+def expand_tasks(job_desc):
+  """Yield a new dict for each task of 'job_desc', in order, with the
+  defaults applied and repeated tasks repeated."""
+  defaults = job_desc.get('task_defaults', {})
+  for entry in job_desc['tasks']:
+    count = entry.get('count', 1)
+    task_desc = dict(defaults)
+    task_desc.update(entry)
+    task_desc.pop('count', None)
+    for _ in xrange(count):
+      yield dict(task_desc)
+
+def compact(job_desc):
+  """Return the compact form of 'job_desc': a field that every task has
+  defaults to its most common value, and runs of identical tasks become a
+  single task with a count."""
+  tasks = list(expand_tasks(job_desc))
+  # field -> repr of value -> [value, number of tasks]
+  counts = {}
+  for task_desc in tasks:
+    for k, v in task_desc.iteritems():
+      counts.setdefault(k, {}).setdefault(repr(v), [v, 0])[1] += 1
+  defaults = {}
+  for k, values in counts.iteritems():
+    v, n = max(values.itervalues(), key=lambda value: value[1])
+    # Only fields which every task has, and which repeat, are worth a default.
+    if sum(count for _, count in values.itervalues()) == len(tasks) and n > 1:
+      defaults[k] = v
+
+  entries = []
+  for task_desc in tasks:
+    entry = dict((k, v) for k, v in task_desc.iteritems()
+                 if k not in defaults or defaults[k] != v)
+    if entries and entries[-1][0] == entry:
+      entries[-1][1] += 1
+    else:
+      entries.append([entry, 1])
+
+  result = dict((k, v) for k, v in job_desc.iteritems() if k != 'tasks')
+  result['task_defaults'] = defaults
+  result['tasks'] = []
+  for entry, count in entries:
+    if count > 1:
+      entry['count'] = count
+    result['tasks'].append(entry)
+  return result
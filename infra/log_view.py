@@ -0,0 +1,70 @@
+# Default number of bytes of a log returned per page.
+PAGE_SIZE = 256 * 1024
+
+# Largest page a client may request.
+MAX_PAGE_SIZE = 4 * 1024 * 1024
+
+# Maximum number of matching lines returned by a search.
+MAX_MATCHES = 1000
+
+# Lines are searched up to this many bytes, and returned up to
+# MAX_MATCH_TEXT_LENGTH bytes.
+MAX_LINE_LENGTH = 64 * 1024
+MAX_MATCH_TEXT_LENGTH = 1024
+
+# Longest search string accepted.
+MAX_PATTERN_LENGTH = 1024
+
+def read_page(store, key, offset=0, length=PAGE_SIZE, tail=False):
+  """Read one page of the log 'key' from the blob store 'store'.
+
+  If 'tail' is set, the page ends at the end of the log and 'offset' is
+  ignored. Returns a dict describing the [start, end) byte range that was
+  read, the total log size, and the page text."""
+  size = store.size(key)
+  if tail:
+    offset = size - length
+  start = min(max(0, offset), size)
+  end = min(start + length, size)
+  data = store.read_range(key, start, end)
+  return dict(start=start, end=end, size=size,
+              text=data.decode("utf-8", "replace"))
+
+def iter_lines(chunks, max_line_length=MAX_LINE_LENGTH):
+  """Generator of (offset, line) over the lines in a sequence of chunks,
+  where 'offset' is the byte offset of the start of the line. Lines longer
+  than 'max_line_length' are cut short, so a log without newlines is not
+  held in memory; offsets still count every byte."""
+  offset = 0
+  partial = ""
+  # The length of the partial line, including the bytes that were cut.
+  partial_length = 0
+  for chunk in chunks:
+    pieces = chunk.split("\n")
+    last = pieces.pop()
+    for piece in pieces:
+      yield offset, partial + piece[:max_line_length - len(partial)]
+      offset += partial_length + len(piece) + 1
+      partial = ""
+      partial_length = 0
+    partial += last[:max_line_length - len(partial)]
+    partial_length += len(last)
+  if partial_length:
+    yield offset, partial
+
+def grep(chunks, pattern, max_matches=MAX_MATCHES, max_text_length=MAX_MATCH_TEXT_LENGTH):
+  """Search a log, given as a sequence of chunks, for lines containing the
+  literal string 'pattern'. Regular expressions are not supported, since
+  they can take exponential time on the server.
+
+  Returns a tuple (matches, truncated), where 'matches' is a list of
+  (line number, byte offset, line) tuples, with the line cut short at
+  'max_text_length', and 'truncated' is set if the search stopped after
+  'max_matches' matches."""
+  matches = []
+  for lineno, (offset, line) in enumerate(iter_lines(chunks)):
+    if pattern in line:
+      if len(matches) == max_matches:
+        return matches, True
+      matches.append((lineno + 1, offset, line[:max_text_length]))
+  return matches, False
@@ -0,0 +1,132 @@
+import bisect
+import contextlib
+import math
+import threading
+import time
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Histogram(object):
+  """Thread-safe histogram of observations, kept separately for each
+  combination of label values, in the manner of a Prometheus histogram."""
+
+  def __init__(self, name, description, label_names=(), buckets=LATENCY_BUCKETS):
+    self.name = name
+    self.description = description
+    self.label_names = tuple(label_names)
+    self.buckets = tuple(buckets)
+    # label values -> [per-bucket counts (the last is +Inf), count, sum]
+    self.series = {}
+    self.lock = threading.Lock()
+
+  def observe(self, value, *label_values):
+    i = bisect.bisect_left(self.buckets, value)
+    with self.lock:
+      series = self.series.get(label_values)
+      if series is None:
+        series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0, 0.0]
+      series[0][i] += 1
+      series[1] += 1
+      series[2] += value
+
+  @contextlib.contextmanager
+  def time(self, *label_values):
+    """Context manager observing the time its body takes, in seconds."""
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.observe(time.time() - start, *label_values)
+
+  def snapshot(self):
+    """Return a list of (labels dict, cumulative bucket counts, count, sum),
+    where the bucket counts are (upper bound, count) pairs ending with +Inf."""
+    with self.lock:
+      items = [(k, list(v[0]), v[1], v[2]) for k, v in self.series.iteritems()]
+    result = []
+    for label_values, counts, count, total in sorted(items):
+      cumulative = []
+      running = 0
+      for bound, n in zip(self.buckets + (float("inf"),), counts):
+        running += n
+        cumulative.append((bound, running))
+      result.append((dict(zip(self.label_names, label_values)), cumulative, count, total))
+    return result
+
+  def to_json(self):
+    return [dict(labels=labels, count=count, sum=total,
+                 buckets=[["+Inf" if bound == float("inf") else bound, n]
+                          for bound, n in cumulative])
+            for labels, cumulative, count, total in self.snapshot()]
+
+MYSQL_QUERY_SECONDS = Histogram(
+  "dist_test_mysql_query_seconds",
+  "Latency of MySQL queries, by statement type.",
+  ("statement",))
+
+BLOB_STORE_SECONDS = Histogram(
+  "dist_test_blob_store_seconds",
+  "Latency of blob store requests, by backend and operation.",
+  ("backend", "op"))
+
+HISTOGRAMS = [MYSQL_QUERY_SECONDS, BLOB_STORE_SECONDS]
+
+def quantile(values, q):
+  """Return the q-quantile (0 <= q <= 1) of 'values' by the nearest-rank
+  method, or None if there are no values."""
+  if not values:
+    return None
+  values = sorted(values)
+  rank = max(0, int(math.ceil(q * len(values))) - 1)
+  return values[min(rank, len(values) - 1)]
+
+def histogram_quantile(counts, q):
+  """Like quantile, of the values given as a list of (value, count)."""
+  total = sum(count for _, count in counts)
+  if not total:
+    return None
+  rank = max(0, int(math.ceil(q * total)) - 1)
+  for value, count in sorted(counts):
+    if rank < count:
+      return value
+    rank -= count
+
+def _format_labels(labels):
+  if not labels:
+    return ""
+  pairs = []
+  for k, v in sorted(labels.iteritems()):
+    v = str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    pairs.append('%s="%s"' % (k, v))
+  return "{%s}" % ",".join(pairs)
+
+def _format_value(value):
+  if value == float("inf"):
+    return "+Inf"
+  return repr(float(value))
+
+def format_prometheus(gauges, histograms=HISTOGRAMS):
+  """Render metrics in the Prometheus text exposition format.
+
+  'gauges' is a list of (name, description, [(labels dict, value)]). Gauges
+  with a value of None are omitted."""
+  lines = []
+  for name, description, samples in gauges:
+    samples = [(labels, value) for labels, value in samples if value is not None]
+    if not samples:
+      continue
+    lines.append("# HELP %s %s" % (name, description))
+    lines.append("# TYPE %s gauge" % name)
+    for labels, value in samples:
+      lines.append("%s%s %s" % (name, _format_labels(labels), _format_value(value)))
+  for h in histograms:
+    lines.append("# HELP %s %s" % (h.name, h.description))
+    lines.append("# TYPE %s histogram" % h.name)
+    for labels, cumulative, count, total in h.snapshot():
+      for bound, n in cumulative:
+        bucket_labels = dict(labels, le=_format_value(bound))
+        lines.append("%s_bucket%s %d" % (h.name, _format_labels(bucket_labels), n))
+      lines.append("%s_sum%s %s" % (h.name, _format_labels(labels), _format_value(total)))
+      lines.append("%s_count%s %d" % (h.name, _format_labels(labels), count))
+  return "\n".join(lines) + "\n"
@@ -0,0 +1,216 @@
+import BaseHTTPServer
+import hashlib
+import logging
+import os
+import random
+import re
+import shutil
+import socket
+import SocketServer
+import tempfile
+import threading
+import urllib2
+import urlparse
+import zlib
+
+# Blobs are read and written in chunks of this size.
+CHUNK_SIZE = 1024 * 1024
+
+DIGEST_RE = re.compile(r'^[0-9a-f]{40}$')
+RETRIEVE_RE = re.compile(r'^/content-gs/retrieve/([^/]+)/([0-9a-f]{40})$')
+
+def nearest_first(my_ip, peer_urls):
+  """Order 'peer_urls' by how many leading octets their address shares
+  with 'my_ip', so that peers on the same host, then on the same subnet,
+  come first. Peers equally near are shuffled, to spread the load."""
+  def nearness(url):
+    peer_ip = urlparse.urlparse(url).hostname or ""
+    shared = 0
+    for mine, theirs in zip(my_ip.split("."), peer_ip.split(".")):
+      if mine != theirs:
+        break
+      shared += 1
+    return shared
+  urls = list(peer_urls)
+  random.shuffle(urls)
+  return sorted(urls, key=nearness, reverse=True)
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+class PeerBlobServer(object):
+  """Serves the blobs in an isolate cache to other slaves, and fetches the
+  blobs that the slave's own isolate downloads need from them.
+
+  The slave points isolateserver.py at 'local_url', which only listens on
+  the loopback interface. Requests to retrieve a blob are first tried
+  against the peers given to set_peers, in order, and otherwise passed on
+  to the isolate server, as are all other requests. Other slaves fetch
+  blobs from '/blob/<digest>' at 'url', which serves nothing else, so
+  that it cannot be used to reach the isolate server.
+
+  The cache holds each blob uncompressed, in a file named by its SHA-1
+  digest, so blobs from peers are verified against their digest, and
+  compressed again for the '-gzip' namespaces."""
+
+  # The most peers tried for each blob, before the isolate server.
+  MAX_PEERS_PER_BLOB = 3
+  PEER_TIMEOUT_SECS = 10
+  # Blobs up to this size are held in memory while they are verified.
+  MAX_SPOOL_SIZE = 16 * 1024 * 1024
+
+  def __init__(self, cache_dir, isolate_server, port=0, host_ip=None):
+    self.cache_dir = cache_dir
+    self.isolate_server = isolate_server.rstrip("/")
+    self.host_ip = host_ip or socket.gethostbyname(socket.gethostname())
+    self.peers = []
+    # Peers which failed to answer, and are skipped until set_peers.
+    self.failed_peers = set()
+    self.lock = threading.Lock()
+    self.httpd = _ThreadingHTTPServer(("", port), self._make_handler(self._handle_peer))
+    self.url = "http://%s:%d" % (self.host_ip, self.httpd.server_address[1])
+    self.local_httpd = _ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler(self._handle))
+    self.local_url = "http://127.0.0.1:%d" % self.local_httpd.server_address[1]
+
+  def start(self):
+    for httpd, name in [(self.httpd, "peer-blobs"), (self.local_httpd, "peer-blobs-local")]:
+      thread = threading.Thread(target=httpd.serve_forever, name=name)
+      thread.daemon = True
+      thread.start()
+
+  def stop(self):
+    for httpd in [self.httpd, self.local_httpd]:
+      httpd.shutdown()
+      httpd.server_close()
+
+  def set_peers(self, peer_urls):
+    """Try 'peer_urls', in order, for the blobs retrieved from now on."""
+    with self.lock:
+      self.peers = [url for url in peer_urls if url != self.url]
+      self.failed_peers = set()
+
+  def _make_handler(self, handle):
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+      def do_GET(self):
+        handle(self)
+      def do_POST(self):
+        handle(self)
+      def log_message(self, format, *args):
+        logging.debug("peer blobs: " + format, *args)
+    return Handler
+
+  def _handle_peer(self, request):
+    """Serve a blob to another slave."""
+    try:
+      if request.command == "GET" and request.path.startswith("/blob/"):
+        self._serve_blob(request, request.path[len("/blob/"):])
+      else:
+        request.send_error(404)
+    except Exception:
+      logging.warning("Failed to handle %s %s", request.command, request.path, exc_info=True)
+
+  def _handle(self, request):
+    """Serve a request of the slave's isolate download."""
+    try:
+      m = RETRIEVE_RE.match(request.path)
+      if m and request.command == "GET" and 'Range' not in request.headers:
+        f = self._fetch_from_peers(m.group(2), m.group(1).endswith("-gzip"))
+        if f is not None:
+          with f:
+            self._send_file(request, f)
+          return
+      self._proxy(request)
+    except Exception:
+      logging.warning("Failed to handle %s %s", request.command, request.path, exc_info=True)
+      try:
+        request.send_error(502)
+      except Exception:
+        pass
+
+  def _serve_blob(self, request, digest):
+    if not DIGEST_RE.match(digest):
+      request.send_error(404)
+      return
+    try:
+      f = open(os.path.join(self.cache_dir, digest), "rb")
+    except IOError:
+      request.send_error(404)
+      return
+    with f:
+      self._send_file(request, f)
+
+  def _send_file(self, request, f):
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(0)
+    request.send_response(200)
+    request.send_header("Content-Type", "application/octet-stream")
+    request.send_header("Content-Length", str(size))
+    request.end_headers()
+    shutil.copyfileobj(f, request.wfile, CHUNK_SIZE)
+
+  def _fetch_from_peers(self, digest, compress):
+    """Return a file with the blob 'digest', compressed if 'compress' is
+    set, from the first peer which has it intact, or None if none does."""
+    with self.lock:
+      peers = [p for p in self.peers if p not in self.failed_peers]
+    for peer in peers[:self.MAX_PEERS_PER_BLOB]:
+      try:
+        response = urllib2.urlopen("%s/blob/%s" % (peer, digest),
+                                   timeout=self.PEER_TIMEOUT_SECS)
+      except urllib2.HTTPError:
+        # The peer no longer has it.
+        continue
+      except Exception:
+        logging.info("Peer %s is unreachable", peer)
+        with self.lock:
+          self.failed_peers.add(peer)
+        continue
+      f = tempfile.SpooledTemporaryFile(max_size=self.MAX_SPOOL_SIZE)
+      try:
+        if self._copy_verified(response, f, digest, compress):
+          logging.debug("Fetched %s from peer %s", digest, peer)
+          return f
+        logging.warning("Peer %s sent a corrupt copy of %s", peer, digest)
+      except Exception:
+        logging.info("Failed to fetch %s from peer %s", digest, peer, exc_info=True)
+      f.close()
+    return None
+
+  def _copy_verified(self, src, dst, digest, compress):
+    """Copy 'src' to 'dst', compressed if 'compress' is set, and return
+    whether the SHA-1 of what was read matches 'digest'."""
+    h = hashlib.sha1()
+    compressor = compress and zlib.compressobj() or None
+    while True:
+      chunk = src.read(CHUNK_SIZE)
+      if not chunk:
+        break
+      h.update(chunk)
+      if compressor:
+        # zlib buffers its input, so this may write nothing for now.
+        dst.write(compressor.compress(chunk))
+      else:
+        dst.write(chunk)
+    if compressor:
+      dst.write(compressor.flush())
+    return h.hexdigest() == digest
+
+  def _proxy(self, request):
+    """Pass 'request' on to the isolate server, and its response back."""
+    data = None
+    if request.command == "POST":
+      data = request.rfile.read(int(request.headers.get('Content-Length', 0)))
+    headers = dict((k, request.headers[k]) for k in ["Content-Type", "Range"]
+                   if k in request.headers)
+    upstream = urllib2.Request(self.isolate_server + request.path, data=data, headers=headers)
+    try:
+      response = urllib2.urlopen(upstream)
+    except urllib2.HTTPError, e:
+      response = e
+    request.send_response(response.code)
+    for k in ["Content-Type", "Content-Length", "Content-Range"]:
+      if response.info().get(k) is not None:
+        request.send_header(k, response.info()[k])
+    request.end_headers()
+    shutil.copyfileobj(response, request.wfile, CHUNK_SIZE)
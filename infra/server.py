@@ -1,28 +1,42 @@
 #!/usr/bin/env python
 
 from __future__ import with_statement
+import array
 import base64
 import cgi
 import cherrypy
+from cherrypy.lib import static
 import datetime
+import hashlib
 import logging
+import mimetypes
 import os
-from jinja2 import Template
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 import urllib
 try:
   import simplejson as json
 except:
   import json
 import StringIO
+import threading
+import Queue
 import gzip
 import netaddr
 import random
 from collections import defaultdict
 
+import blob_store
+import cache
 from config import Config
 import dist_test
+import duration_cache
+import job_format
+import log_view
+import metrics
+import state_writer
 
 TRACE_HTML = os.path.join(os.path.dirname(__file__), "trace.html")
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), "templates")
 LOG = None
 
 DIGEST_AUTH_KEY = random.getrandbits(4096)
@@ -43,6 +57,17 @@ def no_caching(*args, **kwargs):
 
 cherrypy.tools.no_caching = cherrypy.Tool('before_handler', no_caching)
 
+def load_templates(bytecode_cache_dir):
+  """
+  Compile the dashboard templates once, returning a dict of template name to
+  template. Their bytecode is cached on disk, so that restarts skip parsing.
+  """
+  Config.mkdir_p(bytecode_cache_dir)
+  env = Environment(loader=FileSystemLoader(TEMPLATE_DIR),
+                    bytecode_cache=FileSystemBytecodeCache(bytecode_cache_dir),
+                    auto_reload=False)
+  return dict((name, env.get_template(name)) for name in env.list_templates())
+
 
 class Authorize(cherrypy.Tool):
 
@@ -82,33 +107,200 @@ if __name__ == "__main__":
       allowed_ip_ranges=config.DIST_TEST_ALLOWED_IP_RANGES.split(","),
       accounts=json.loads(config.ACCOUNTS))
 
+class _Fanout(object):
+  """A submitted job whose 'tasks' are being queued, in order. The first
+  'enqueued' of them already are."""
+  def __init__(self, job_id, tasks, user, priority_class, enqueued=0):
+    self.job_id = job_id
+    self.tasks = tasks
+    self.user = user
+    self.priority_class = priority_class
+    self.enqueued = enqueued
+    self.attempts = 0
+    # The expected duration and the priority of each task from 'first' on,
+    # assigned when its first chunk is queued.
+    self.first = None
+    self.costs = None
+    self.priorities = None
+    # Slave id -> the expected work routed to it, over all chunks.
+    self.affinity_assigned = {}
+
 class DistTestServer(object):
 
+  # Number of task rows shown per page of the job view.
+  JOB_PAGE_SIZE = 500
+
+  # Maximum number of tasks returned per page of the tasks API.
+  MAX_TASKS_PAGE_SIZE = 10000
+
+  # Pages of finished jobs never change, so their rendered HTML is cached.
+  FINISHED_JOB_CACHE_SIZE = 200
+  FINISHED_JOB_CACHE_TTL_SECS = 60 * 60
+
+  # How long the list of recent jobs on the index page may be stale.
+  RECENT_JOBS_TTL_SECS = 5
+
+  # Task throughput and latencies are computed over tasks that started or
+  # finished within this window. The statistics are reused for STATS_TTL_SECS.
+  STATS_WINDOW_SECS = 300
+  STATS_TTL_SECS = 5
+
+  # Expected duration of tasks which have never run, for fair sharing and
+  # for estimating the outstanding work for the autoscaler.
+  DEFAULT_TASK_DURATION_SECS = 60
+
+  # Every SPECULATION_INTERVAL_SECS, slaves which would otherwise be idle are
+  # given duplicates of stragglers: running tasks which have taken over
+  # SPECULATION_SLOWDOWN times the p90 of their durations, plus
+  # SPECULATION_MIN_OVERRUN_SECS, in jobs with at most
+  # SPECULATION_MAX_REMAINING_FRACTION of their tasks left.
+  SPECULATION_INTERVAL_SECS = 30
+  SPECULATION_SLOWDOWN = 1.5
+  SPECULATION_MIN_OVERRUN_SECS = 60
+  SPECULATION_MAX_REMAINING_FRACTION = 0.05
+  # Most stragglers considered at once, including those already duplicated.
+  SPECULATION_MAX_CANDIDATES = 500
+  # Duplicates are built from the submitted tasks, which are kept for a day.
+  # Tasks submitted before the server restarted are not duplicated.
+  SUBMITTED_TASK_CACHE_SIZE = 200000
+  SUBMITTED_TASK_TTL_SECS = 60 * 60 * 24
+
+  # Task durations are kept in memory, and refreshed from MySQL this often.
+  DURATION_REFRESH_SECS = 30
+
+  # How often the isolates which slaves no longer report, and the durations
+  # of tasks which have not succeeded within the decay window, are forgotten.
+  PURGE_INTERVAL_SECS = 60 * 60
+
+  # A task whose isolate is in the cache of some slave is routed to that
+  # slave, and to any slave once it has waited AFFINITY_WAIT_SECS. Tasks
+  # routed to slaves which exited are moved back to their class this often.
+  AFFINITY_WAIT_SECS = 30
+  AFFINITY_RESCUE_INTERVAL_SECS = 60
+
+  # The counts of ResultsStore.fetch_job_summary.
+  JOB_SUMMARY_COUNTS = ["total_groups", "total_tasks", "finished_tasks", "running_tasks",
+                        "retried_tasks", "timedout_tasks", "failed_tasks", "succeeded_tasks",
+                        "failed_groups", "succeeded_groups", "flaky_groups", "finished_groups",
+                        "flaky_tasks"]
+
+  # Submitted jobs are registered in MySQL and queued in beanstalk in the
+  # background, this many tasks at a time. A chunk which fails is retried
+  # after FANOUT_RETRY_SECS, and the job is canceled once it has failed
+  # FANOUT_MAX_ATTEMPTS times in a row.
+  FANOUT_CHUNK_SIZE = 1000
+  FANOUT_RETRY_SECS = 10
+  FANOUT_MAX_ATTEMPTS = 3
+
+  # The beanstalk job ids of each job's tasks are kept for a day, for up to
+  # QUEUED_JOBS_SIZE jobs, so that canceling a job can delete its tasks from
+  # beanstalk. Otherwise each slave has to reserve and skip them one by one.
+  QUEUED_JOBS_SIZE = 2000
+
+  # Beanstalk tube statistics reported by /stats.json, as (beanstalk name, name).
+  QUEUE_STATS = [("current-jobs-ready", "ready"),
+                 ("current-jobs-urgent", "urgent"),
+                 ("current-jobs-reserved", "reserved"),
+                 ("current-jobs-delayed", "delayed"),
+                 ("current-jobs-buried", "buried"),
+                 ("current-waiting", "idle_slaves")]
+
   def __init__(self, config):
     self.config = config
     self.task_queue = dist_test.TaskQueue(self.config)
     self.results_store = dist_test.ResultsStore(self.config)
+    # Slaves are shared fairly within each priority class.
+    weights = json.loads(self.config.DIST_TEST_FAIR_SHARE_WEIGHTS)
+    self.fair_share = {}
+    for priority_class in dist_test.PRIORITY_CLASSES:
+      base = dist_test.class_base_priority(priority_class)
+      self.fair_share[priority_class] = dist_test.FairShare(
+        weights, base_priority=base, max_priority=base + dist_test.PRIORITY_CLASS_BAND - 1)
+    self.templates = load_templates(self.config.TEMPLATE_CACHE_DIR)
+    self.finished_job_cache = cache.ExpiringCache(max_size=self.FINISHED_JOB_CACHE_SIZE)
+    self.recent_jobs_cache = cache.ExpiringCache(max_size=1)
+    self.stats_cache = cache.ExpiringCache(max_size=1)
+    # A method named after the URL would shadow the metrics module.
+    self.metrics = self.prometheus_metrics
+    # (job_id, task_id) -> task JSON, for speculative duplicates.
+    self.submitted_tasks = cache.ExpiringCache(max_size=self.SUBMITTED_TASK_CACHE_SIZE)
+    # Attempts which have been duplicated, so that they are only duplicated once.
+    self.speculated_attempts = cache.ExpiringCache(max_size=self.SUBMITTED_TASK_CACHE_SIZE)
+    # job_id -> array of beanstalk job ids
+    self.queued_jobs = cache.ExpiringCache(max_size=self.QUEUED_JOBS_SIZE)
+    self.state_writer = state_writer.BatchingStateWriter(self.results_store)
+    self.durations = duration_cache.DurationCache(self.results_store)
+    # job_id -> _Fanout, for jobs whose tasks are still being queued.
+    self.fanouts = {}
+    # Held while queueing a chunk, so that a job is not canceled halfway through one.
+    self.fanout_lock = threading.Lock()
+    self.fanout_queue = Queue.Queue()
+    fanout_thread = threading.Thread(target=self._run_fanouts, name="fanout")
+    fanout_thread.daemon = True
+    fanout_thread.start()
+    self._resume_fanouts()
 
   @cherrypy.expose
   @cherrypy.tools.no_caching()
   def index(self):
     stats = self.task_queue.stats()
     body = "<h1>Stats</h1>\n" + self._render_stats(stats)
-    recent_jobs = self.results_store.fetch_recent_job_rows()
+    recent_jobs = self.recent_jobs_cache.get("recent_jobs")
+    if recent_jobs is None:
+      recent_jobs = self.results_store.fetch_recent_job_rows()
+      self.recent_jobs_cache.put("recent_jobs", recent_jobs, self.RECENT_JOBS_TTL_SECS)
     body += self._render_jobs(recent_jobs)
     return self.render_container(body)
 
   @cherrypy.expose
   @cherrypy.tools.no_caching()
-  def job(self, job_id, task_id=None):
-    tasks = self.results_store.fetch_task_rows_for_job(job_id)
-    if len(tasks) == 0:
+  def job(self, job_id, task_id=None, status=None, sort="task_id", order="asc", cursor=None):
+    cache_key = (job_id, status, sort, order, cursor)
+    cached = self.finished_job_cache.get(cache_key)
+    if cached is not None:
+      return self._serve_finished_page(*cached)
+
+    job_summary = self._summarize_job(job_id)
+    if job_summary is None:
       return "No tasks found for specified job_id %s" % job_id
-    job_summary, task_groups = self._summarize_tasks(tasks)
+    try:
+      tasks, next_cursor = self.results_store.fetch_task_rows_page(
+        job_id, status=status, sort=sort, descending=(order == "desc"),
+        cursor=cursor, limit=self.JOB_PAGE_SIZE)
+    except ValueError as e:
+      return str(e)
+    # Group the attempts of the tasks on this page, to mark flaky tasks.
+    task_ids = set([t['task_id'] for t in tasks])
+    tasks_by_id = defaultdict(list)
+    for t in self.results_store.fetch_task_rows_for_task_ids(job_id, task_ids):
+      tasks_by_id[t['task_id']].append(t)
+    task_groups = {}
+    for tid, group in tasks_by_id.iteritems():
+      task_groups[tid] = dist_test.TaskGroup(group)
+
+    view = dict(job_id=job_id, status=status, sort=sort, order=order,
+                cursor=cursor, next_cursor=next_cursor)
     body = ""
     body += self._render_job_header(job_id, job_summary)
-    body += self._render_tasks(tasks, job_summary, task_groups)
-    return self.render_container(body)
+    body += self._render_tasks(tasks, job_summary, task_groups, view)
+    page = self.render_container(body)
+    if job_summary['status'] != "finished":
+      return page
+    etag = '"%s"' % hashlib.sha1(page.encode("utf-8")).hexdigest()
+    self.finished_job_cache.put(cache_key, (etag, page), self.FINISHED_JOB_CACHE_TTL_SECS)
+    return self._serve_finished_page(etag, page)
+
+  def _serve_finished_page(self, etag, page):
+    """Serve the page of a finished job, letting browsers revalidate their copy
+    with If-None-Match instead of downloading it again."""
+    headers = cherrypy.response.headers
+    headers['Cache-Control'] = 'no-cache'
+    headers.pop('Pragma', None)
+    headers.pop('Expires', None)
+    headers['ETag'] = etag
+    # Raises a 304 Not Modified if the client's copy is current.
+    cherrypy.lib.cptools.validate_etags()
+    return page
 
   @staticmethod
   def _delta_us(delta):
@@ -148,37 +340,308 @@ class DistTestServer(object):
     else:
       return "Unknown log type"
 
-    url = self.results_store.generate_output_link(key)
-    return cgi.escape(urllib.urlopen(url).read(), quote=True)
+    # Escape the log chunk by chunk as it streams out of the blob store,
+    # rather than loading the whole thing into memory.
+    def stream():
+      for chunk in self.results_store.blob_store.iter_range(key):
+        yield cgi.escape(chunk, quote=True)
+    return stream()
+  view_log._cp_config = {'response.stream': True}
+
+  # Maps the 'output' parameter of the log and download endpoints to the
+  # task column holding its blob key.
+  OUTPUT_KEY_COLUMNS = {
+    "stdout": "stdout_key",
+    "stderr": "stderr_key",
+    "artifacts": "artifact_archive_key",
+  }
+
+  def _get_output_key(self, job_id, task_id, attempt, output):
+    """Return the blob key of a task's stdout, stderr or artifacts, or None."""
+    if output not in self.OUTPUT_KEY_COLUMNS:
+      return None
+    task = self.results_store.fetch_task(job_id, task_id, attempt)
+    if task is None:
+      return None
+    return task[self.OUTPUT_KEY_COLUMNS[output]]
+
+  def _get_log_key(self, job_id, task_id, attempt, log):
+    if log not in ("stdout", "stderr"):
+      return None
+    return self._get_output_key(job_id, task_id, attempt, log)
+
+  @cherrypy.expose
+  def download(self, job_id, task_id, attempt, output):
+    """Redirect to a download link for a task output. The job page links here
+    so that links are only generated (and signed) for outputs actually fetched."""
+    key = self._get_output_key(job_id, task_id, attempt, output)
+    if key is None:
+      raise cherrypy.NotFound()
+    raise cherrypy.HTTPRedirect(self.results_store.generate_output_link(key))
+
+  @cherrypy.expose
+  @cherrypy.tools.json_out()
+  def log_page(self, job_id, task_id, attempt, log, offset=0,
+               length=log_view.PAGE_SIZE, tail=False):
+    """Return one page of a task log as JSON. Only the requested byte range
+    is read from the blob store, so the cost doesn't depend on the log size."""
+    key = self._get_log_key(job_id, task_id, attempt, log)
+    if key is None:
+      return {"error": "Could not find requested log"}
+    length = min(int(length), log_view.MAX_PAGE_SIZE)
+    return log_view.read_page(self.results_store.blob_store, key,
+                              offset=int(offset), length=length,
+                              tail=tail in ("1", "true"))
+
+  @cherrypy.expose
+  @cherrypy.tools.json_out()
+  def grep_log(self, job_id, task_id, attempt, log, pattern):
+    """Search a task log for lines containing a string. Returns the line
+    number and byte offset of each match, which can be passed to log_page."""
+    if len(pattern) > log_view.MAX_PATTERN_LENGTH:
+      return {"error": "Search strings are limited to %d bytes" % log_view.MAX_PATTERN_LENGTH}
+    key = self._get_log_key(job_id, task_id, attempt, log)
+    if key is None:
+      return {"error": "Could not find requested log"}
+    matches, truncated = log_view.grep(
+      self.results_store.blob_store.iter_range(key), pattern.encode("utf-8"))
+    return dict(matches=[dict(line=l, offset=o, text=t.decode("utf-8", "replace"))
+                         for l, o, t in matches],
+                truncated=truncated)
+
+  @cherrypy.expose
+  @cherrypy.tools.authorize()
+  def blob(self, key):
+    """Serve a result blob from a local blob store. Supports HTTP range
+    requests. Unlike the dashboard, results are not readable by anyone,
+    just as the S3 links they replace are signed."""
+    store = self.results_store.blob_store
+    if not isinstance(store, blob_store.LocalBlobStore):
+      raise cherrypy.NotFound()
+    try:
+      path = store.local_path(key)
+    except KeyError:
+      raise cherrypy.NotFound()
+    content_type = mimetypes.guess_type(key)[0] or "text/plain"
+    return static.serve_file(path, content_type=content_type,
+                             disposition="inline", name=key)
+
+  @cherrypy.expose
+  @cherrypy.tools.json_out()
+  @cherrypy.tools.authorize()
+  def upload_blob(self, key):
+    """Store the request body in a local blob store. Used by slaves
+    configured with the 'http' blob store backend."""
+    store = self.results_store.blob_store
+    if not isinstance(store, blob_store.LocalBlobStore):
+      raise cherrypy.NotFound()
+    try:
+      store.put_file(key, cherrypy.request.body)
+    except KeyError:
+      raise cherrypy.NotFound()
+    return {"status": "SUCCESS"}
 
   @cherrypy.expose
   @cherrypy.tools.json_out()
   @cherrypy.tools.authorize()
   @cherrypy.tools.no_caching()
   def cancel_job(self, job_id):
+    # Stop queueing the job's tasks, then mark those queued canceled, so
+    # that slaves skip any they reserve while the queue is being purged.
+    with self.fanout_lock:
+      self.fanouts.pop(job_id, None)
     self.results_store.cancel_job(job_id)
-    return {"status": "SUCCESS"}
+    bs_ids = self.queued_jobs.get(job_id)
+    if bs_ids is None:
+      return {"status": "SUCCESS"}
+    self.queued_jobs.invalidate(job_id)
+    deleted, killed = self.task_queue.cancel_tasks(bs_ids)
+    LOG.info("Canceled job %s: deleted %d queued tasks, killed %d running tasks",
+             job_id, deleted, killed)
+    return {"status": "SUCCESS", "deleted": deleted, "killed": killed}
+
+  def _submit_task(self, task, priority, slave_id=None):
+    """Queue 'task', and remember its beanstalk id for cancel_job. If
+    'slave_id' is given, the task is routed to that slave, and queued for
+    any slave after AFFINITY_WAIT_SECS."""
+    if slave_id is None:
+      self._remember_bs_id(task.job_id, self.task_queue.submit_task(task, priority=priority))
+      return
+    fallback_bs_id = self.task_queue.submit_task(task, priority=priority,
+                                                 delay=self.AFFINITY_WAIT_SECS)
+    self._remember_bs_id(task.job_id, fallback_bs_id)
+    self._remember_bs_id(task.job_id,
+                         self.task_queue.submit_affinity_task(task, slave_id, fallback_bs_id,
+                                                              priority))
+
+  def _remember_bs_id(self, job_id, bs_id):
+    bs_ids = self.queued_jobs.get(job_id)
+    if bs_ids is None:
+      bs_ids = array.array('L')
+      self.queued_jobs.put(job_id, bs_ids, self.SUBMITTED_TASK_TTL_SECS)
+    bs_ids.append(bs_id)
 
   @cherrypy.expose
   @cherrypy.tools.json_out()
   @cherrypy.tools.authorize()
   @cherrypy.tools.no_caching()
-  def submit_job(self, job_id, job_json):
+  def submit_job(self, job_id, job_json=None, user=None, priority_class=None,
+                 max_failed_tasks=None):
+    """Persist a job, and return before its tasks are queued. The job id,
+    which the client picks, makes submission idempotent: submitting a job
+    id again, as a client retrying a timed out request does, changes
+    nothing.
+
+    The job description is either the 'job_json' form field, or the request
+    body, which may be gzipped. It may be in the compact form of job_format."""
+    if job_json is None:
+      job_json = cherrypy.request.body.read()
+      if cherrypy.request.headers.get('Content-Encoding') == 'gzip':
+        job_json = gzip.GzipFile(fileobj=StringIO.StringIO(job_json)).read()
     job_desc = json.loads(job_json)
+    priority_class = priority_class or job_desc.get('priority_class') or \
+        dist_test.DEFAULT_PRIORITY_CLASS
+    if priority_class not in dist_test.PRIORITY_CLASSES:
+      return {"status": "FAILURE",
+              "error": "Unknown priority class %s, expected one of %s" %
+                       (priority_class, ", ".join(dist_test.PRIORITY_CLASSES))}
+    # The job is canceled once more than this many of its tasks fail.
+    if max_failed_tasks is None:
+      max_failed_tasks = job_desc.get('max_failed_tasks')
+    if max_failed_tasks is not None:
+      try:
+        valid = int(max_failed_tasks) >= 0
+      except (TypeError, ValueError):
+        valid = False
+      if not valid:
+        return {"status": "FAILURE",
+                "error": "Invalid max_failed_tasks %s" % max_failed_tasks}
+      max_failed_tasks = int(max_failed_tasks)
+
+    tasks = self._make_tasks(job_id, job_desc, priority_class)
+    if len(tasks) == 0:
+      return {"status": "FAILURE", "error": "Job %s has no tasks" % job_id}
+    durations = self.durations.get_durations([t.description for t in tasks])
+    indexes = dict((t.task_id, i) for i, t in enumerate(tasks))
+    tasks = dist_test.sort_tasks_by_duration(tasks, durations)
+    task_order = [indexes[t.task_id] for t in tasks]
+    # Slaves warm their isolate caches with these, in the order they are needed.
+    isolate_hashes = []
+    seen = set()
+    for task in tasks:
+      if task.isolate_hash not in seen:
+        seen.add(task.isolate_hash)
+        isolate_hashes.append(task.isolate_hash)
+
+    if not self.results_store.create_submission(job_id, job_json, task_order, isolate_hashes,
+                                                user, priority_class, max_failed_tasks):
+      LOG.info("Job %s was already submitted", job_id)
+      return {"status": "SUCCESS", "job_id": job_id, "duplicate": True}
+    self._start_fanout(_Fanout(job_id, tasks, user, priority_class))
+    return {"status": "SUCCESS", "job_id": job_id}
+
+  def _make_tasks(self, job_id, job_desc, priority_class):
+    return [dist_test.make_job_task(job_id, priority_class, i, task_desc)
+            for i, task_desc in enumerate(job_format.expand_tasks(job_desc))]
+
+  def _start_fanout(self, fanout):
+    with self.fanout_lock:
+      self.fanouts[fanout.job_id] = fanout
+    self.fanout_queue.put(fanout)
+
+  def _resume_fanouts(self):
+    """Resume queueing the jobs which were still being queued when the
+    server stopped. A chunk that was interrupted is queued again, so some
+    of its tasks may run twice, and the first result of each is recorded."""
+    for row in self.results_store.fetch_unfinished_submissions():
+      tasks = self._make_tasks(row['job_id'], json.loads(row['job_json']), row['priority_class'])
+      tasks = [tasks[i] for i in json.loads(row['task_order'])]
+      LOG.info("Resuming the submission of job %s at task %d of %d",
+               row['job_id'], row['enqueued_tasks'], len(tasks))
+      self._start_fanout(_Fanout(row['job_id'], tasks, row['user'], row['priority_class'],
+                                 row['enqueued_tasks']))
+
+  def _run_fanouts(self):
+    """Queue the chunks of the submitted jobs, taking turns between them,
+    so that a large job does not hold up the first tasks of later ones."""
+    while True:
+      fanout = self.fanout_queue.get()
+      try:
+        if self._fan_out_chunk(fanout):
+          fanout.attempts = 0
+          self.fanout_queue.put(fanout)
+      except Exception:
+        fanout.attempts += 1
+        if fanout.attempts < self.FANOUT_MAX_ATTEMPTS:
+          LOG.warning("Failed to queue the tasks of job %s, will retry", fanout.job_id,
+                      exc_info=True)
+          threading.Timer(self.FANOUT_RETRY_SECS, self.fanout_queue.put, [fanout]).start()
+        else:
+          # Cancel the job, rather than leave its client waiting for it.
+          LOG.error("Failed to queue the tasks of job %s, canceling it", fanout.job_id,
+                    exc_info=True)
+          self.cancel_job(fanout.job_id)
+
+  def _fan_out_chunk(self, fanout):
+    """Register and queue the next chunk of the tasks of 'fanout', so that
+    slaves start on the first chunk while the rest are queued. Returns
+    whether there are more."""
+    if fanout.priorities is None:
+      fanout.first = fanout.enqueued
+      tasks = fanout.tasks[fanout.first:]
+      durations = self.durations.get_durations([t.description for t in tasks])
+      # Share the slaves fairly between users, or between jobs for clients
+      # which do not say who submitted them.
+      fanout.costs = [durations.get(t.description, self.DEFAULT_TASK_DURATION_SECS)
+                      for t in tasks]
+      fanout.priorities = self.fair_share[fanout.priority_class].assign_priorities(
+        fanout.user or fanout.job_id, fanout.costs,
+        self.task_queue.ready_priority(fanout.priority_class))
+
+    start = fanout.enqueued
+    end = min(start + self.FANOUT_CHUNK_SIZE, len(fanout.tasks))
+    tasks = fanout.tasks[start:end]
+    costs = fanout.costs[start - fanout.first:end - fanout.first]
+    priorities = fanout.priorities[start - fanout.first:end - fanout.first]
+    with self.fanout_lock:
+      if self.fanouts.get(fanout.job_id) is not fanout:
+        LOG.info("Job %s was canceled while its tasks were being queued", fanout.job_id)
+        return False
+      self.results_store.register_tasks(tasks, job_counted=True)
+      # Prefer the slaves which already have the tasks' isolates.
+      warm_slaves = self.results_store.fetch_warm_slaves(set(t.isolate_hash for t in tasks))
+      slave_ids = dist_test.assign_affinity(tasks, costs, warm_slaves, self.AFFINITY_WAIT_SECS,
+                                            fanout.affinity_assigned)
+      for task, priority, slave_id in zip(tasks, priorities, slave_ids):
+        self._submit_task(task, priority, slave_id)
+        self.submitted_tasks.put((task.job_id, task.task_id), task.to_json(),
+                                 self.SUBMITTED_TASK_TTL_SECS)
+      fanout.enqueued = end
+      self.results_store.record_submission_progress(fanout.job_id, fanout.enqueued)
+      if fanout.enqueued < len(fanout.tasks):
+        return True
+      if self.fanouts.get(fanout.job_id) is fanout:
+        del self.fanouts[fanout.job_id]
+    LOG.info("Queued all %d tasks of job %s", len(fanout.tasks), fanout.job_id)
+    return False
 
-    tasks = []
-    for i, task_desc in enumerate(job_desc['tasks']):
-      task_desc['job_id'] = job_id
-      task_desc['task_id'] = "%s.%d" % (task_desc['isolate_hash'], i)
-      task = dist_test.Task(task_desc)
-      tasks.append(task)
-
-    tasks = self._sort_tasks_by_duration(tasks)
+  @cherrypy.expose
+  @cherrypy.tools.json_out()
+  @cherrypy.tools.authorize()
+  @cherrypy.tools.no_caching()
+  def task_running(self, task_json, hostname):
+    """Batched ResultsStore.mark_task_running, for slaves."""
+    task = dist_test.Task.from_json(task_json)
+    return {"status": "SUCCESS", "run": self.state_writer.mark_task_running(task, hostname)}
 
-    self.results_store.register_tasks(tasks)
-    for task in tasks:
-      self.task_queue.submit_task(task)
-    return {"status": "SUCCESS"}
+  @cherrypy.expose
+  @cherrypy.tools.json_out()
+  @cherrypy.tools.authorize()
+  @cherrypy.tools.no_caching()
+  def task_finished(self, result_json):
+    """Batched ResultsStore.record_task_results, for slaves."""
+    result = dist_test.TaskResult.from_json(result_json)
+    return {"status": "SUCCESS", "recorded": self.state_writer.record_task_result(result)}
 
   @cherrypy.expose
   @cherrypy.tools.json_out()
@@ -188,44 +651,163 @@ class DistTestServer(object):
     task = dist_test.Task.from_json(task_json)
     if task.attempt < task.max_retries:
       task.attempt += 1
+      task.speculative = False
       self.results_store.register_tasks([task])
-      # Run retry tasks with a boosted priority. This prevents them from straggling
-      # if we've already started running another job.
-      retry_priority = 2**31 - (1000 * task.attempt)
-      retry_priority = max(retry_priority, 1000)
-      self.task_queue.submit_task(task, priority=retry_priority)
+      priority = dist_test.retry_priority(task.attempt, task.priority_class)
+      if self.results_store.fetch_job_descriptor(task.job_id) is None:
+        # Slaves could not resolve a reference to a task of a job submitted
+        # before job descriptions were recorded.
+        self._remember_bs_id(task.job_id,
+                             self.task_queue.submit_task(task, priority=priority, full=True))
+      else:
+        self._submit_task(task, priority)
     return {"status": "SUCCESS"}
 
-  def _sort_tasks_by_duration(self, tasks):
-    """Sort the tasks by the duration of their last completed execution, descending.
-
-    This is a simple form of longest-task-first scheduling to reduce the
-    effect of stragglers on overall job runtime."""
-    task_durations = self.results_store.fetch_recent_task_durations(tasks)
-    # turn it into a lookup table of description -> duration
-    dur_by_desc = defaultdict(int)
-    for t in task_durations:
-      dur_by_desc[t["description"]] = int(t["duration_secs"])
-    tasks_with_duration = []
-    for t in tasks:
-      # Tuple of (task, duration)
-      tasks_with_duration.append((t, dur_by_desc[t.description]))
-    # Sort tasks descending based on duration
-    sorted_tasks = sorted(tasks_with_duration, key=lambda t: t[1], reverse=True)
-    # Trim off the durations
-    sorted_tasks = [x[0] for x in sorted_tasks]
-    return sorted_tasks
+  def speculate_stragglers(self):
+    """Submit a duplicate of each straggling task near the end of its job,
+    while there are slaves with nothing else to do. Whichever run of the
+    attempt finishes first is recorded, and the other is killed by its slave."""
+    try:
+      self._speculate_stragglers()
+    except Exception:
+      # Keep the background task running, since it stops on any exception.
+      LOG.warning("Failed to submit duplicates of straggling tasks", exc_info=True)
+
+  def _speculate_stragglers(self):
+    stats = self.task_queue.stats()
+    spare_slaves = stats['current-waiting'] - stats['current-jobs-ready']
+    if spare_slaves <= 0:
+      return
+    stragglers = self.results_store.fetch_stragglers(
+      self.SPECULATION_SLOWDOWN, self.SPECULATION_MIN_OVERRUN_SECS,
+      self.SPECULATION_MAX_REMAINING_FRACTION, self.SPECULATION_MAX_CANDIDATES)
+    for row in stragglers:
+      if spare_slaves == 0:
+        break
+      attempt_key = (row['job_id'], row['task_id'], row['attempt'])
+      task_json = self.submitted_tasks.get((row['job_id'], row['task_id']))
+      if task_json is None or self.speculated_attempts.get(attempt_key) is not None:
+        continue
+      task = dist_test.Task.from_json(task_json)
+      task.attempt = row['attempt']
+      task.speculative = True
+      LOG.info("Task %s has run for %ds, against a p90 of %ds; submitting a duplicate",
+               task.get_id(), row['run_secs'], row['total_p90'])
+      self._submit_task(task, dist_test.retry_priority(task.attempt + 1, task.priority_class))
+      self.speculated_attempts.put(attempt_key, True, self.SUBMITTED_TASK_TTL_SECS)
+      spare_slaves -= 1
+
+  def purge_stale_rows(self):
+    """Forget the isolates which slaves no longer report having, and the
+    durations of tasks which have not succeeded for the decay window."""
+    try:
+      self.results_store.purge_isolate_peers()
+      self.results_store.purge_slave_isolates()
+      self.durations.forget(self.results_store.purge_duration_stats())
+    except Exception:
+      # Keep the background task running, since it stops on any exception.
+      LOG.warning("Failed to purge stale rows", exc_info=True)
+
+  def rescue_affinity_tasks(self):
+    """Queue the tasks routed to slaves which exited for any slave."""
+    try:
+      for job_id, bs_id in self.task_queue.rescue_affinity_tasks():
+        self._remember_bs_id(job_id, bs_id)
+    except Exception:
+      # Keep the background task running, since it stops on any exception.
+      LOG.warning("Failed to rescue the tasks of exited slaves", exc_info=True)
+
+  def refresh_durations(self):
+    """Pick up the durations of tasks which finished since the last refresh."""
+    try:
+      self.durations.refresh()
+    except Exception:
+      # Keep the background task running, since it stops on any exception.
+      LOG.warning("Failed to refresh task durations", exc_info=True)
 
   @cherrypy.expose
   @cherrypy.tools.json_out()
   @cherrypy.tools.no_caching()
   def job_status(self, job_id):
-    tasks = self.results_store.fetch_task_rows_for_job(job_id)
-    if len(tasks) == 0:
+    job_summary = self._summarize_job(job_id, json_compatible=True)
+    if job_summary is None:
       return {"error": "Did not fetch any tasks for specified job_id %s" % job_id}
-    job_summary, task_groups = self._summarize_tasks(tasks, json_compatible=True)
     return job_summary
 
+  @cherrypy.expose
+  @cherrypy.tools.json_out()
+  @cherrypy.tools.no_caching()
+  def stats_json(self):
+    """Served as /stats.json."""
+    stats = dict(self._collect_stats())
+    stats["mysql_query_seconds"] = metrics.MYSQL_QUERY_SECONDS.to_json()
+    stats["blob_store_seconds"] = metrics.BLOB_STORE_SECONDS.to_json()
+    return stats
+
+  @cherrypy.expose
+  @cherrypy.tools.no_caching()
+  def prometheus_metrics(self):
+    """Prometheus text exposition of the statistics in /stats.json, served
+    as /metrics."""
+    stats = self._collect_stats()
+    gauges = []
+    for _, name in self.QUEUE_STATS:
+      gauges.append(("dist_test_queue_" + name,
+                     "Beanstalk %s count, by tube." % name.replace("_", " "),
+                     [(dict(tube=tube), q[name]) for tube, q in sorted(stats["queue"].items())]))
+    gauges += [
+      ("dist_test_tasks_started_per_second",
+       "Tasks started per second over the last %d seconds." % stats["window_secs"],
+       [({}, stats["tasks_started_per_sec"])]),
+      ("dist_test_tasks_finished_per_second",
+       "Tasks finished per second over the last %d seconds." % stats["window_secs"],
+       [({}, stats["tasks_finished_per_sec"])]),
+      ("dist_test_task_queue_wait_seconds",
+       "Quantiles of the time tasks started recently spent queued.",
+       [(dict(quantile=q), stats["queue_wait_secs"][p]) for q, p in [("0.5", "p50"), ("0.95", "p95")]]),
+      ("dist_test_task_run_seconds",
+       "Quantiles of the run time of tasks finished recently.",
+       [(dict(quantile=q), stats["run_secs"][p]) for q, p in [("0.5", "p50"), ("0.95", "p95")]]),
+      ("dist_test_outstanding_work_seconds",
+       "Estimated seconds of work left in queued and running tasks.",
+       [(dict(state=s), stats["outstanding_work"]["%s_work_secs" % s]) for s in ["queued", "running"]]),
+    ]
+    cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    return metrics.format_prometheus(gauges)
+
+  def _collect_stats(self):
+    """Gather queue, throughput and latency statistics, caching them briefly
+    since they are polled by the autoscaler and by monitoring."""
+    stats = self.stats_cache.get("stats")
+    if stats is not None:
+      return stats
+    queue = {}
+    for tube, tube_stats in self.task_queue.tube_stats().iteritems():
+      queue[tube] = dict((name, int(tube_stats[key])) for key, name in self.QUEUE_STATS)
+
+    window = self.STATS_WINDOW_SECS
+    timings = self.results_store.fetch_recent_task_timings(window)
+    queue_waits = timings['queue_wait_secs']
+    run_times = timings['run_secs']
+    stats = dict(
+      queue=queue,
+      # Totals across tubes, for consumers which do not care about priorities.
+      # Every slave watches all tubes, so idle slaves are not summed.
+      queue_length=sum(q['ready'] for q in queue.values()),
+      running=sum(q['reserved'] for q in queue.values()),
+      idle_slaves=max([q['idle_slaves'] for q in queue.values()] or [0]),
+      window_secs=window,
+      tasks_started_per_sec=sum(n for _, n in queue_waits) / float(window),
+      tasks_finished_per_sec=sum(n for _, n in run_times) / float(window),
+      queue_wait_secs=dict(p50=metrics.histogram_quantile(queue_waits, 0.5),
+                           p95=metrics.histogram_quantile(queue_waits, 0.95)),
+      run_secs=dict(p50=metrics.histogram_quantile(run_times, 0.5),
+                    p95=metrics.histogram_quantile(run_times, 0.95)),
+      outstanding_work=self.results_store.fetch_outstanding_work(self.DEFAULT_TASK_DURATION_SECS),
+    )
+    self.stats_cache.put("stats", stats, self.STATS_TTL_SECS)
+    return stats
+
   @cherrypy.expose
   @cherrypy.tools.json_out()
   @cherrypy.tools.no_caching()
@@ -233,24 +815,42 @@ class DistTestServer(object):
     # Deprecated, use the "tasks" endpoint instead.
     return self.tasks(job_id, status="failed")
 
+  # Fields of the records returned by the tasks endpoint, in the order used
+  # by its compact format.
+  TASK_RECORD_FIELDS = ["task_id", "attempt", "description",
+                        "stdout_link", "stderr_link", "artifact_archive_link"]
+
   @cherrypy.expose
   @cherrypy.tools.json_out()
   @cherrypy.tools.no_caching()
-  def tasks(self, job_id, status=None):
-    if status not in (None, "failed", "succeeded", "finished"):
+  def tasks(self, job_id, status=None, limit=None, cursor=None):
+    """Return the tasks of a job, optionally filtered by status.
+
+    Without a 'limit', all matching tasks are returned as a list of records.
+    With a 'limit', one page is returned in a compact format:
+      {"fields": [...], "rows": [[...], ...], "next_cursor": ...}
+    where each row holds the values of 'fields', or null if the task has none.
+    Pass 'next_cursor' back as 'cursor' to fetch the next page."""
+    if status not in dist_test.ResultsStore.TASK_STATUS_FILTERS:
       return {"error": "Unknown status type %s" % status}
-    # fetch all tasks and filter by status. By default (None) return all tasks.
-    tasks = self.results_store.fetch_task_rows_for_job(job_id)
-    filtered = tasks
-    if status == "failed":
-      filtered = [t for t in tasks if t['status'] is not None and t['status'] != 0]
-    elif status == "succeeded":
-      filtered = [t for t in tasks if t['status'] is not None and t['status'] == 0]
-    elif status == "finished":
-      filtered = [t for t in tasks if t['status'] is not None]
+    paged = limit is not None
+    if paged:
+      try:
+        page_size = int(limit)
+      except ValueError:
+        page_size = 0
+      if page_size < 1:
+        raise cherrypy.HTTPError(400, "Invalid limit %s" % limit)
+      limit = min(page_size, self.MAX_TASKS_PAGE_SIZE)
+    try:
+      tasks, next_cursor = self.results_store.fetch_task_rows_page(
+        job_id, status=status, cursor=cursor, limit=limit)
+    except ValueError as e:
+      return {"error": str(e)}
+
     # construct a record for each filtered task
     records = []
-    for t in filtered:
+    for t in tasks:
       record = dict(task_id=t['task_id'],
                     attempt=t['attempt'],
                     description=t['description'])
@@ -261,89 +861,63 @@ class DistTestServer(object):
       if t['artifact_archive_key']:
         record['artifact_archive_link'] = self.results_store.generate_output_link(t['artifact_archive_key'])
       records.append(record)
-    return records
+    if not paged:
+      return records
+    return dict(fields=self.TASK_RECORD_FIELDS,
+                rows=[[r.get(f) for f in self.TASK_RECORD_FIELDS] for r in records],
+                next_cursor=next_cursor)
 
-  def _summarize_tasks(self, tasks, json_compatible=False):
-    """Computes aggregate statistics on a set of tasks and groups tasks into groups based on task_id.
-    Returns a tuple of (statistics, task_groups).
+  def _summarize_job(self, job_id, json_compatible=False):
+    """Computes aggregate statistics on the tasks of a job, where tasks are grouped
+    by task_id. Returns None if the job has no tasks.
 
     The json_compatible kwarg is used to request JSON-compatible output, which is used by the client
     to report progress.
 
-    The statistics object is a dictionary of string keys to integer values.
+    The statistics object is a dictionary of string keys to integer values, plus
+    the job's status and, unless json_compatible is set, its timing.
 
-    task_groups is a dictionary that maps a string task_id to the list of tasks with that task_id.
-    This is used to group together multiple attempted runs when a task is configured to
+    Groups are used to combine multiple attempted runs when a task is configured to
     be retried on failure.
     Tasks are uniquely identified by the compound key (job_id, task_id, attempt).
     """
-
-    # Task-level status information
-    result = {}
-    result['total_tasks'] = len(tasks)
-    result['finished_tasks'] = len([1 for t in tasks if t['status'] is not None])
-    result['running_tasks'] = len([1 for t in tasks if t['status'] is None])
-    result['retried_tasks'] = len([1 for t in tasks if t['attempt'] > 0])
-    result['timedout_tasks'] = len([1 for t in tasks if t['status'] == -9])
-    result['failed_tasks'] = len([1 for t in tasks if t['status'] is not None and t['status'] != 0])
-    result['succeeded_tasks'] = len([1 for t in tasks if t['status'] == 0])
-
-    # Group-level status information
-    tasks_by_id = defaultdict(list)
-    result['failed_groups'] = 0
-    result['succeeded_groups'] = 0
-    result['flaky_groups'] = 0
-
-    # Group tasks by task ID and turn them into TaskGroups
-    for t in tasks:
-      tasks_by_id[t['task_id']].append(t)
-    task_groups = {}
-    for task_id, group in tasks_by_id.iteritems():
-      task_groups[task_id] = dist_test.TaskGroup(group)
-
-    result['total_groups'] = len(task_groups)
-    result['flaky_groups'] = len([1 for g in task_groups.values() if g.is_flaky])
-    result['failed_groups'] = len([1 for g in task_groups.values() if g.is_failed])
-    result['succeeded_groups'] = len([1 for g in task_groups.values() if g.is_succeeded])
-    result['finished_groups'] = len([1 for g in task_groups.values() if g.is_finished])
+    result = self.results_store.fetch_job_summary(job_id)
+    fanout = self.fanouts.get(job_id)
+    if fanout is not None:
+      # Count the tasks which are still to be queued, so that the job does
+      # not look finished before they are.
+      if result is None:
+        result = dict((k, 0) for k in self.JOB_SUMMARY_COUNTS)
+        result['submit_timestamp'] = datetime.datetime.now()
+        result['complete_timestamp'] = None
+      result['total_groups'] = len(fanout.tasks)
+    if result is None:
+      return None
 
     # Determine job state: if it's finished, how long its been running
     finish_time = None
-    runtime = None
-    submit_time = min([t["submit_timestamp"] for t in tasks])
+    submit_time = result.pop('submit_timestamp')
+    complete_time = result.pop('complete_timestamp')
 
     result['status'] = "running"
     stop = datetime.datetime.now()
 
     if result['total_groups'] == result['finished_groups']:
       result['status'] = "finished"
-      finish_time = max([t["complete_timestamp"] for t in tasks])
+      finish_time = complete_time
       stop = finish_time
     runtime = stop - submit_time
 
-    # Compute sum of failed tasks in each flaky group
-    flaky_groups = [g for g in task_groups.values() if g.is_flaky]
-    result['flaky_tasks'] = 0
-    for group in flaky_groups:
-      flaky_tasks = [t for t in group.tasks if t['status'] != 0]
-      result['flaky_tasks'] += len(flaky_tasks)
-
     # datetimes can't be auto-JSON'd, do not include them
     if not json_compatible:
       result["submit_time"] = submit_time
       result["finish_time"] = finish_time
       result['runtime'] = runtime
 
-    return result, task_groups
+    return result
 
   def _render_stats(self, stats):
-    template = Template("""
-      <code>
-        Queue length: {{ stats['current-jobs-ready'] }}
-        Running: {{ stats['current-jobs-reserved'] }}
-        Idle slaves: {{ stats['current-waiting'] }}
-      </code>""")
-    return template.render(stats=stats)
+    return self.templates["stats.html"].render(stats=stats)
 
 
   def _render_jobs(self, jobs):
@@ -351,29 +925,7 @@ class DistTestServer(object):
     stats["total_jobs"] = len(jobs)
     stats["total_tasks"] = sum([j["num_tasks"] for j in jobs])
 
-    template = Template("""
-    <h1>Recent Jobs (last 1 day)</h1>
-    <br style="clear: both;"/>
-    <table class="table" id="jobs">
-    <thead>
-      <tr>
-        <th>Job ({{ stats.total_jobs |e }}) </th>
-        <th>Submitted</th>
-        <th>Num Tasks ({{ stats.total_tasks |e }})</th>
-      </tr>
-    </thead>
-    <tbody>
-      {% for job in jobs %}
-        <tr>
-          <td><a href="/job?job_id={{ job.job_id |urlencode }}">{{ job.job_id |e }}</a></td>
-          <td>{{ job.submit_timestamp |e }}</td>
-          <td>{{ job.num_tasks |e }}</td>
-        </tr>
-      {% endfor %}
-      </tbody>
-    </table>
-    """)
-    return template.render(jobs=jobs, stats=stats)
+    return self.templates["jobs.html"].render(jobs=jobs, stats=stats)
 
   def _render_job_header(self, job_id, job_summary):
     if job_summary['total_groups'] > 0:
@@ -388,46 +940,38 @@ class DistTestServer(object):
     job["fail_percent"] = "%.2f%%" % fail_percent
     job["job_id"] = job_id
 
-    print job
-    template = Template("""
-    <h1> Job {{ job.job_id | e }} ({{ job_summary.status }}) </h1>
-    <div class="progress-bar">
-      <div class="filler green" style="width: {{ job.success_percent }};"></div>
-      <div class="filler red" style="width: {{ job.fail_percent }};"></div>
-    </div>
-
-    <br style="clear:both"/>
-    <p>
-    <strong>Submitted: {{ job_summary.submit_time }}</strong>
-    </p>
-    <p>
-    <strong>Runtime: {{ job_summary.runtime }}</strong>
-    </p>
-    <p>
-    <a href="/">Back to home</a>
-    <a href="/trace?job_id={{ job.job_id | urlencode }}">Trace view</a>
-    </p>
-
-    """)
-    return template.render(job=job, job_summary=job_summary)
-
-  def _generate_view_link(self, task, output):
-    return "/view_log?job_id=%s&task_id=%s&attempt=%s&log=%s" % \
-        (urllib.quote(task["job_id"]), urllib.quote(task["task_id"]), urllib.quote(str(task["attempt"])), urllib.quote(output))
-
-
-  def _render_tasks(self, tasks, job_summary, task_groups):
+    return self.templates["job_header.html"].render(job=job, job_summary=job_summary)
+
+  def _generate_task_params(self, task):
+    return "job_id=%s&task_id=%s&attempt=%s" % \
+        (urllib.quote(task["job_id"]), urllib.quote(task["task_id"]), urllib.quote(str(task["attempt"])))
+
+
+  def _job_view_link(self, view, **changes):
+    """Link to the job page, with the filter, sort order and page of 'view'
+    updated by 'changes'. Changing the filter or sort order resets the page."""
+    params = dict(view)
+    params.pop('next_cursor', None)
+    if 'cursor' not in changes:
+      params['cursor'] = None
+    params.update(changes)
+    return "/job?" + urllib.urlencode([(k, v) for k, v in sorted(params.iteritems())
+                                       if v is not None])
+
+  def _render_tasks(self, tasks, job_summary, task_groups, view):
     for t in tasks:
-      # stdout/stderr links
+      # stdout/stderr links. Download links go through the /download redirect,
+      # so that they are only signed when clicked.
+      task_params = self._generate_task_params(t)
       if t['stdout_key']:
-        t['stdout_link'] = self.results_store.generate_output_link(t['stdout_key'])
-        t['stdout_view_link'] = self._generate_view_link(t, "stdout")
+        t['stdout_link'] = "/download?%s&output=stdout" % task_params
+        t['stdout_log_params'] = task_params + "&log=stdout"
       if t['stderr_key']:
-        t['stderr_link'] = self.results_store.generate_output_link(t['stderr_key'])
-        t['stderr_view_link'] = self._generate_view_link(t, "stderr")
+        t['stderr_link'] = "/download?%s&output=stderr" % task_params
+        t['stderr_log_params'] = task_params + "&log=stderr"
       # artifact link
       if t['artifact_archive_key']:
-        t['artifact_archive_link'] = self.results_store.generate_output_link(t['artifact_archive_key'])
+        t['artifact_archive_link'] = "/download?%s&output=artifacts" % task_params
       # Calculate the elapsed time
       if t['start_timestamp'] is not None and t['complete_timestamp'] is not None:
         delta = t['complete_timestamp'] - t['start_timestamp']
@@ -438,7 +982,7 @@ class DistTestServer(object):
       else:
         t['runtime'] = None
 
-      # Set task status classes for filtering.
+      # Set task status classes for highlighting.
       status = []
       task_group = task_groups[t["task_id"]]
       if t['status'] is None:
@@ -455,170 +999,19 @@ class DistTestServer(object):
 
       t['status_class'] = ' '.join(status)
 
-    template = Template("""
-    <br style="clear: both;"/>
-    <div>
-      Show:
-      <a id="show-all">all ({{ job_summary.total_tasks }})</a> |
-      <a id="show-running">running ({{ job_summary.running_tasks }})</a> |
-      <a id="show-failed">failed ({{ job_summary.failed_tasks }})</a> |
-      <a id="show-successful">successful ({{ job_summary.succeeded_tasks }})</a> |
-      <a id="show-timedout">timed out ({{ job_summary.timedout_tasks }})</a> |
-      <a id="show-flaky">flaky ({{ job_summary.flaky_tasks }})</a>
-    </div>
-    <table class="table sortable" id="tasks">
-    <thead>
-      <tr>
-        <th>time(s)</th>
-        <th>description</th>
-        <th>hostname</th>
-        <th>status</th>
-        <th>results</th>
-        <th>stdout</th>
-        <th>stderr</th>
-        <th>artifacts</th>
-        <th>task</th>
-        <th>attempt</th>
-      </tr>
-    </thead>
-    <tbody>
-      {% for task in tasks %}
-        <tr class="{{ task.status_class |e }}">
-          <td>{{ task.runtime | int |e }}</td>
-          <td>{{ task.description |e }}</td>
-          <td>{{ task.hostname |e }}</td>
-          <td>{{ task.status |e }}</td>
-          <td>{{ task.output_archive_hash |e }}</td>
-          <td>{{ task.stdout_abbrev |e }}
-              {% if task.stdout_link %}
-              <br/>
-              <a class="view" href="#" viewlink="{{ task.stdout_view_link |e }}" viewheader="{{ task.description |e }}.{{ task.task_id |e }}.stdout">view</a>
-              <a href="{{ task.stdout_link |e }}">download</a>
-              {% endif %}
-          </td>
-          <td>{{ task.stderr_abbrev |e }}
-              {% if task.stderr_link %}
-              <br/>
-              <a class="view" href="#" viewlink="{{ task.stderr_view_link |e }}" viewheader="{{ task.description |e }}.{{ task.task_id |e }}.stderr">view</a>
-              <a href="{{ task.stderr_link |e }}">download</a>
-              {% endif %}
-          </td>
-          <td>
-              {% if task.artifact_archive_link %}
-              <a href="{{ task.artifact_archive_link |e }}">download</a>
-              {% endif %}
-          </td>
-          <td>{{ task.task_id |e }}</td>
-          <td>{{ task.attempt |e }}</td>
-        </tr>
-      {% endfor %}
-      </tbody>
-    </table>
-    """)
-    return template.render(tasks=tasks, job_summary=job_summary)
+    def sort_link(column):
+      """Sort by 'column', toggling the order if the view is already sorted by it."""
+      order = "asc"
+      if view['sort'] == column and view['order'] == "asc":
+        order = "desc"
+      return self._job_view_link(view, sort=column, order=order)
+
+    return self.templates["tasks.html"].render(tasks=tasks, job_summary=job_summary, view=view,
+                                               link=self._job_view_link, sort_link=sort_link)
 
   def render_container(self, body):
     """ Render the "body" HTML inside of a bootstrap container page. """
-    template = Template("""
-    <!DOCTYPE html>
-    <html>
-      <head><title>Distributed Test Server</title>
-      <link rel="stylesheet" href="//maxcdn.bootstrapcdn.com/bootstrap/3.2.0/css/bootstrap.min.css" />
-      <style>
-        .progress-bar {
-          border: 1px solid #666;
-          background: #eee;
-          height: 30px;
-          width: 80%;
-          margin: auto;
-          padding: 0;
-          margin-bottom: 1em;
-        }
-        .progress-bar .filler {
-          margin: 0px;
-          height: 100%;
-          border: 0;
-          float:left;
-        }
-        .filler.green { background-color: #0f0; }
-        .task-running { background-color: #ffa; }
-        .task-successful { background-color: #afa; }
-        .task-failed { background-color: #faa; }
-        .task-flaky { background-color: #fc9; }
-        .filler.red { background-color: #f00; }
-
-        /* Required for scrollbar on modal window */
-        .modal-dialog { overflow-y: initial !important; }
-        .modal-body {
-          height: 100%;
-          overflow-y: auto;
-          font-family: monospace;
-          white-space:pre;
-        }
-
-      </style>
-    </head>
-    <body>
-
-      <!-- Modal -->
-      <div id="logModal" class="modal fade" role="dialog">
-        <div class="modal-dialog modal-lg">
-
-          <!-- Modal content-->
-          <div class="modal-content">
-            <div class="modal-header">
-              <button type="button" class="close" data-dismiss="modal">&times;</button>
-              <h4 class="modal-title">Modal Header</h4>
-            </div>
-            <div class="modal-body">
-              <p>Some text in the modal.</p>
-            </div>
-            <div class="modal-footer">
-              <button type="button" class="btn btn-default" data-dismiss="modal">Close</button>
-            </div>
-          </div>
-
-        </div>
-      </div>
-      <div class="container-fluid">
-      {{ body }}
-      </div>
-      <script src="//ajax.googleapis.com/ajax/libs/jquery/1.11.1/jquery.min.js"></script>
-      <script src="//maxcdn.bootstrapcdn.com/bootstrap/3.2.0/js/bootstrap.min.js"></script>
-      <script src="//cdnjs.cloudflare.com/ajax/libs/jquery.tablesorter/2.18.2/js/jquery.tablesorter.min.js"></script>
-      <script>
-        $(document).ready(function() {
-          function showOnly(clazz) {
-            $('#tasks tbody tr:not(.' + clazz + ')').hide();
-            $('#tasks tbody tr.' + clazz).show();
-            return false;
-          }
-          function showAll() {
-            $('#tasks tbody tr').show();
-            return false;
-          }
-
-          $('table.sortable').tablesorter();
-          $('#show-all').click(function() { showAll(); });
-          $('#show-running').click(function() { showOnly('task-running'); });
-          $('#show-successful').click(function() { showOnly('task-successful'); });
-          $('#show-failed').click(function() { showOnly('task-failed'); });
-          $('#show-timedout').click(function() { showOnly('task-timedout'); });
-          $('#show-flaky').click(function() { showOnly('task-flaky'); });
-
-          // Setup the lightbox for the "view" logs links
-          $( "a.view" ).click(function() {
-              $('#logModal .modal-title').text($(this).attr("viewheader"));
-              $('#logModal .modal-body').load($(this).attr("viewlink"), function() {
-                $('#logModal').modal();
-              });
-          });
-        });
-      </script>
-    </body>
-    </html>
-    """)
-    return template.render(body=body)
+    return self.templates["container.html"].render(body=body, log_page_size=log_view.PAGE_SIZE)
 
 
 if __name__ == "__main__":
@@ -633,9 +1026,19 @@ if __name__ == "__main__":
   cherrypy.config.update({
     'server.socket_host': '0.0.0.0',
     'server.socket_port': 8081,
+    'server.thread_pool': config.DIST_TEST_SERVER_THREADS,
     'log.access_file': config.SERVER_ACCESS_LOG,
     'log.error_file': config.SERVER_ERROR_LOG,
   })
+  server = DistTestServer(config)
+  cherrypy.process.plugins.Monitor(cherrypy.engine, server.speculate_stragglers,
+                                   frequency=server.SPECULATION_INTERVAL_SECS).subscribe()
+  cherrypy.process.plugins.Monitor(cherrypy.engine, server.refresh_durations,
+                                   frequency=server.DURATION_REFRESH_SECS).subscribe()
+  cherrypy.process.plugins.Monitor(cherrypy.engine, server.purge_stale_rows,
+                                   frequency=server.PURGE_INTERVAL_SECS).subscribe()
+  cherrypy.process.plugins.Monitor(cherrypy.engine, server.rescue_affinity_tasks,
+                                   frequency=server.AFFINITY_RESCUE_INTERVAL_SECS).subscribe()
   LOG.info("Starting server")
-  cherrypy.quickstart(DistTestServer(config))
+  cherrypy.quickstart(server)
 
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+"""
+Discrete-event simulation of a dist_test cluster, for evaluating scheduling
+changes without a live cluster.
+
+The model follows the server and slaves: jobs are sorted by
+dist_test.sort_tasks_by_duration and put on a beanstalk-like priority queue,
+at priorities assigned by dist_test.FairShare with each job as a flow. N
+slaves reserve tasks in priority then submission order, download their
+isolate bundle unless they already have it cached, and run them. Failed
+tasks are retried with dist_test.retry_priority, and a slave releases any
+retry of a task that failed on it, according to its slave.RetryCache.
+
+Workloads are either replayed from dist_test_tasks rows, or synthetic.
+"""
+
+import collections
+import copy
+import heapq
+import logging
+import math
+import optparse
+import random
+
+import dist_test
+import metrics
+import slave
+
+# Expected duration of tasks not in the known durations, as the server assumes.
+UNKNOWN_DURATION_SECS = 60
+
+class SimTask(object):
+  """A task attempt in a simulated workload."""
+
+  def __init__(self, job_id, task_id, description, duration_secs, submit_time=0,
+               fail_prob=0.0, max_retries=0, isolate_hash=None):
+    self.job_id = job_id
+    self.task_id = task_id
+    self.description = description
+    self.duration_secs = duration_secs
+    # Time the task's job is submitted, in seconds from the start.
+    self.submit_time = submit_time
+    # Probability that an attempt fails.
+    self.fail_prob = fail_prob
+    self.max_retries = max_retries
+    self.isolate_hash = isolate_hash or task_id
+    self.attempt = 0
+
+  def get_retry_id(self):
+    return "%s.%s" % (self.job_id, self.task_id)
+
+  def retry(self):
+    t = copy.copy(self)
+    t.attempt += 1
+    return t
+
+class _SimSlave(object):
+  def __init__(self, slave_id, retry_cache):
+    self.slave_id = slave_id
+    self.retry_cache = retry_cache
+    self.isolate_cache = set()
+    self.busy_secs = 0.0
+    self.download_secs = 0.0
+
+class Simulator(object):
+  """Simulates running a workload on 'num_slaves' slaves.
+
+  Each task download takes 'download_secs', or 'cached_download_secs' if the
+  slave has run a task with the same isolate hash before. A slave which
+  releases a retry task sleeps for 'release_sleep_secs' before reserving
+  again. The scheduling policies under test can be swapped out with
+  'sort_by_duration', 'fair_share', 'retry_priority' and
+  'retry_cache_factory', which is passed the simulated 'clock' (None
+  disables the anti-affinity of retries)."""
+
+  def __init__(self, num_slaves, download_secs=0, cached_download_secs=0,
+               release_sleep_secs=5, sort_by_duration=True, fair_share=True,
+               retry_priority=dist_test.retry_priority,
+               retry_cache_factory=slave.RetryCache, seed=0):
+    self.num_slaves = num_slaves
+    self.download_secs = download_secs
+    self.cached_download_secs = cached_download_secs
+    self.release_sleep_secs = release_sleep_secs
+    self.sort_by_duration = sort_by_duration
+    self.fair_share = fair_share
+    self.retry_priority = retry_priority
+    self.retry_cache_factory = retry_cache_factory
+    self.seed = seed
+
+  def run(self, tasks, durations=None):
+    """Run the workload 'tasks' to completion, and return a SimResult.
+
+    'durations' maps descriptions to the durations known to the server when
+    sorting a job's tasks. By default the true durations are used."""
+    if durations is None:
+      durations = dict((t.description, t.duration_secs) for t in tasks)
+    self.durations = durations
+    self.rng = random.Random(self.seed)
+    self.fair_share_state = dist_test.FairShare() if self.fair_share else None
+    self.now = 0.0
+    self.seq = 0
+    # Heap of (time, seq, callback, args).
+    self.events = []
+    # Heap of (priority, seq, task), like a beanstalk tube.
+    self.queue = []
+    # Slaves waiting in reserve, longest-waiting first.
+    self.idle = collections.deque()
+    self.result = SimResult(self.num_slaves)
+
+    jobs = collections.OrderedDict()
+    for t in tasks:
+      jobs.setdefault(t.job_id, []).append(t)
+    for job_tasks in jobs.itervalues():
+      self._schedule(min(t.submit_time for t in job_tasks), self._submit_job, job_tasks)
+    self.slaves = []
+    for i in xrange(self.num_slaves):
+      cache = None
+      if self.retry_cache_factory:
+        # Retries expire in simulated time.
+        cache = self.retry_cache_factory(clock=lambda: self.now)
+      self.slaves.append(_SimSlave(i, cache))
+      self.idle.append(self.slaves[-1])
+
+    while self.events:
+      self.now, _, callback, args = heapq.heappop(self.events)
+      callback(*args)
+    self.result.slaves = self.slaves
+    return self.result
+
+  def _next_seq(self):
+    self.seq += 1
+    return self.seq
+
+  def _schedule(self, time, callback, *args):
+    heapq.heappush(self.events, (time, self._next_seq(), callback, args))
+
+  def _submit_job(self, tasks):
+    if self.sort_by_duration:
+      tasks = dist_test.sort_tasks_by_duration(tasks, self.durations)
+    priorities = [dist_test.DEFAULT_PRIORITY] * len(tasks)
+    if self.fair_share_state is not None:
+      costs = [self.durations.get(t.description, UNKNOWN_DURATION_SECS) for t in tasks]
+      head_priority = self.queue[0][0] if self.queue else None
+      priorities = self.fair_share_state.assign_priorities(tasks[0].job_id, costs, head_priority)
+    for t, priority in zip(tasks, priorities):
+      self.result.submitted(t, self.now)
+      heapq.heappush(self.queue, (priority, self._next_seq(), t))
+    self._dispatch()
+
+  def _dispatch(self):
+    while self.idle and self.queue:
+      s = self.idle.popleft()
+      priority, seq, task = heapq.heappop(self.queue)
+      if s.retry_cache is not None and s.retry_cache.get(task.get_retry_id()) is not None:
+        # Released jobs keep their place in the queue.
+        self.result.releases += 1
+        heapq.heappush(self.queue, (priority, seq, task))
+        self._schedule(self.now + self.release_sleep_secs, self._slave_free, s)
+        continue
+      download = self.download_secs
+      if task.isolate_hash in s.isolate_cache:
+        download = self.cached_download_secs
+      s.isolate_cache.add(task.isolate_hash)
+      failed = self.rng.random() < task.fail_prob
+      end = self.now + download + task.duration_secs
+      s.busy_secs += end - self.now
+      s.download_secs += download
+      self._schedule(end, self._finish, s, task, self.now, failed)
+
+  def _finish(self, s, task, start, failed):
+    self.result.finished(task, s.slave_id, start, self.now, failed)
+    if failed and task.attempt < task.max_retries:
+      heapq.heappush(self.queue, (self.retry_priority(task.attempt + 1), self._next_seq(),
+                                  task.retry()))
+      if s.retry_cache is not None:
+        s.retry_cache.put(task.get_retry_id())
+    self._slave_free(s)
+
+  def _slave_free(self, s):
+    self.idle.append(s)
+    self._dispatch()
+
+class SimResult(object):
+  """The attempts run by a simulation, and statistics computed from them."""
+
+  def __init__(self, num_slaves):
+    self.num_slaves = num_slaves
+    self.job_submit_times = {}
+    # (job_id, task_id) -> list of (slave_id, start, end, failed)
+    self.attempts = collections.OrderedDict()
+    self.releases = 0
+    self.slaves = []
+
+  def submitted(self, task, now):
+    self.job_submit_times.setdefault(task.job_id, now)
+    self.attempts.setdefault((task.job_id, task.task_id), [])
+
+  def finished(self, task, slave_id, start, end, failed):
+    self.attempts[(task.job_id, task.task_id)].append((slave_id, start, end, failed))
+
+  def summary(self, tail_fraction=0.9):
+    """Compute the overall makespan, slave utilization, and per-job makespans
+    and straggler tails. A job's tail is the time between the finish of
+    'tail_fraction' of its tasks and the finish of its last task."""
+    group_finish = collections.defaultdict(list)
+    num_attempts = 0
+    failed_tasks = 0
+    for (job_id, task_id), attempts in self.attempts.iteritems():
+      num_attempts += len(attempts)
+      group_finish[job_id].append(max(end for _, _, end, _ in attempts))
+      if all(failed for _, _, _, failed in attempts):
+        failed_tasks += 1
+    end = max([max(f) for f in group_finish.itervalues()] or [0])
+    start = min(self.job_submit_times.values() or [0])
+    makespan = end - start
+
+    job_makespans = []
+    job_tails = []
+    for job_id, finishes in group_finish.iteritems():
+      finishes.sort()
+      job_makespans.append(finishes[-1] - self.job_submit_times[job_id])
+      tail_index = max(0, int(math.ceil(tail_fraction * len(finishes))) - 1)
+      job_tails.append(finishes[-1] - finishes[tail_index])
+
+    busy = sum(s.busy_secs for s in self.slaves)
+    download = sum(s.download_secs for s in self.slaves)
+    capacity = self.num_slaves * makespan
+    return dict(
+      makespan=makespan,
+      utilization=busy / capacity if capacity else 0.0,
+      download_fraction=download / busy if busy else 0.0,
+      jobs=len(group_finish),
+      tasks=len(self.attempts),
+      attempts=num_attempts,
+      failed_tasks=failed_tasks,
+      releases=self.releases,
+      job_makespan_p50=metrics.quantile(job_makespans, 0.5),
+      job_makespan_max=max(job_makespans or [None]),
+      job_tail_p50=metrics.quantile(job_tails, 0.5),
+      job_tail_max=max(job_tails or [None]),
+    )
+
+def workload_from_task_rows(rows):
+  """Build a workload replaying dist_test_tasks rows, as returned by
+  ResultsStore.fetch_task_rows_for_job. Each task runs for the mean of its
+  recorded run times, preferring successful runs, and fails with its
+  observed failure rate. Tasks which never ran are skipped."""
+  groups = collections.OrderedDict()
+  for r in rows:
+    groups.setdefault((r['job_id'], r['task_id']), []).append(r)
+  if not groups:
+    return []
+  t0 = min(r['submit_timestamp'] for r in rows)
+  tasks = []
+  for (job_id, task_id), attempts in groups.iteritems():
+    ran = [a for a in attempts if a['start_timestamp'] and a['complete_timestamp']]
+    if not ran:
+      continue
+    run_secs = lambda a: (a['complete_timestamp'] - a['start_timestamp']).total_seconds()
+    succeeded = [run_secs(a) for a in ran if a['status'] == 0]
+    samples = succeeded or [run_secs(a) for a in ran]
+    num_failed = len([a for a in ran if a['status'] != 0])
+    tasks.append(SimTask(job_id, task_id, attempts[0]['description'],
+                         duration_secs=sum(samples) / len(samples),
+                         submit_time=(min(a['submit_timestamp'] for a in attempts) - t0).total_seconds(),
+                         fail_prob=num_failed / float(len(ran)),
+                         max_retries=attempts[0]['max_retries'],
+                         # Task ids are "<isolate hash>.<index>"
+                         isolate_hash=task_id.rsplit(".", 1)[0]))
+  return tasks
+
+def synthetic_workload(num_jobs=5, tasks_per_job=200, job_interval_secs=300,
+                       median_duration_secs=30, duration_sigma=1.0,
+                       flaky_fraction=0.05, flaky_fail_prob=0.3, max_retries=2,
+                       num_bundles=10, seed=0):
+  """Generate jobs of tasks with log-normally distributed durations, a
+  fraction of which are flaky. Tasks share 'num_bundles' isolate bundles, and
+  a task keeps its description and duration across jobs, as when the same
+  test suite is submitted repeatedly."""
+  rng = random.Random(seed)
+  suite = []
+  for i in xrange(tasks_per_job):
+    duration = rng.lognormvariate(math.log(median_duration_secs), duration_sigma)
+    fail_prob = flaky_fail_prob if rng.random() < flaky_fraction else 0.0
+    suite.append(("test-%d" % i, duration, fail_prob, "bundle-%d" % rng.randrange(num_bundles)))
+  tasks = []
+  for j in xrange(num_jobs):
+    for i, (description, duration, fail_prob, bundle) in enumerate(suite):
+      tasks.append(SimTask("job-%d" % j, "%s.%d" % (bundle, i), description, duration,
+                           submit_time=j * job_interval_secs, fail_prob=fail_prob,
+                           max_retries=max_retries, isolate_hash=bundle))
+  return tasks
+
+# Scheduling variants compared by the benchmark, as Simulator keyword arguments.
+VARIANTS = [
+  ("baseline", {}),
+  ("fifo", dict(sort_by_duration=False)),
+  ("no-fair-share", dict(fair_share=False)),
+  # Fair share priorities are all at least DEFAULT_PRIORITY, so retries are
+  # only on a par with new tasks without it.
+  ("no-retry-boost", dict(fair_share=False,
+                          retry_priority=lambda attempt: dist_test.DEFAULT_PRIORITY)),
+  ("no-anti-affinity", dict(retry_cache_factory=None)),
+]
+
+BENCHMARK_COLUMNS = ["makespan", "utilization", "download_fraction", "attempts",
+                     "releases", "job_makespan_p50", "job_makespan_max",
+                     "job_tail_p50", "job_tail_max"]
+
+def benchmark(tasks, variants=VARIANTS, seeds=(0, 1, 2), **sim_args):
+  """Run each variant on the workload 'tasks' with each of 'seeds', and
+  return a list of (variant name, summary averaged over the seeds)."""
+  results = []
+  for name, overrides in variants:
+    args = dict(sim_args)
+    args.update(overrides)
+    summaries = [Simulator(seed=seed, **args).run(tasks).summary() for seed in seeds]
+    averaged = {}
+    for col in BENCHMARK_COLUMNS:
+      values = [s[col] for s in summaries if s[col] is not None]
+      averaged[col] = sum(values) / float(len(values)) if values else None
+    results.append((name, averaged))
+  return results
+
+def format_benchmark(results):
+  lines = ["%-18s" % "variant" + "".join("%18s" % c for c in BENCHMARK_COLUMNS)]
+  for name, summary in results:
+    cells = []
+    for col in BENCHMARK_COLUMNS:
+      v = summary[col]
+      cells.append("%18s" % ("-" if v is None else "%.2f" % v))
+    lines.append("%-18s" % name + "".join(cells))
+  return "\n".join(lines)
+
+def main():
+  logging.basicConfig(level=logging.WARN)
+  p = optparse.OptionParser(
+    usage="usage: %prog [options] [job_id ...]",
+    description="Benchmark scheduling variants by simulating the given jobs, " +
+                "replayed from MySQL, or a synthetic workload if no jobs are given.")
+  p.add_option("--slaves", type="int", default=20, help="number of slaves")
+  p.add_option("--download-secs", type="float", default=5,
+               help="time to download an isolate bundle which is not cached")
+  p.add_option("--cached-download-secs", type="float", default=0.5,
+               help="time to set up an isolate bundle which is cached")
+  p.add_option("--seeds", type="int", default=3, help="number of random seeds to average over")
+  p.add_option("--synthetic-jobs", type="int", default=5)
+  p.add_option("--synthetic-tasks", type="int", default=200, help="tasks per synthetic job")
+  options, args = p.parse_args()
+
+  if args:
+    from config import Config
+    results_store = dist_test.ResultsStore(Config())
+    rows = []
+    for job_id in args:
+      rows += results_store.fetch_task_rows_for_job(job_id)
+    tasks = workload_from_task_rows(rows)
+  else:
+    tasks = synthetic_workload(num_jobs=options.synthetic_jobs,
+                               tasks_per_job=options.synthetic_tasks)
+  print format_benchmark(benchmark(tasks, seeds=range(options.seeds),
+                                   num_slaves=options.slaves,
+                                   download_secs=options.download_secs,
+                                   cached_download_secs=options.cached_download_secs))
+
+if __name__ == "__main__":
+  main()
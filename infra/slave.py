@@ -4,12 +4,13 @@ from __future__ import with_statement
 import beanstalkc
 import boto
 import collections
-import cStringIO
 import errno
 import fcntl
 import glob2
+import hashlib
 import logging
 import os
+import random
 import urllib
 import urllib2
 import re
@@ -21,61 +22,390 @@ try:
 except:
   import json
 import signal
+import socket
 import subprocess
+import tempfile
 import sys
 import threading
 import time
 import zipfile
 
+import cache
 from config import Config
 import dist_test
 import file_path
+import job_format
+import peer_blobs
 
-LOG = None
+LOG = logging.getLogger('dist_test.slave')
 
 # The number of times each task will retry when trying to download its
 # dependencies.
 NUM_DOWNLOAD_ATTEMPTS_PER_TASK = 3
 
+# How often a running task checks whether the server has told it to die.
+KILL_CHECK_SECS = 2
+
+# Name of the archive member mapping each deduplicated artifact path to the
+# path of the identical file that was actually stored.
+DUPLICATES_MANIFEST = "_DUPLICATES_.json"
+
+def _file_digest(path):
+  h = hashlib.sha1()
+  with open(path, "rb") as f:
+    while True:
+      chunk = f.read(1024 * 1024)
+      if not chunk:
+        break
+      h.update(chunk)
+  return h.hexdigest()
+
+def dedupe_by_content(paths):
+  """Split 'paths' into files with distinct contents and duplicates.
+
+  Returns a tuple of (unique, duplicates), where 'unique' is a sorted list of
+  paths and 'duplicates' maps each remaining path to the path in 'unique'
+  with the same contents. Only files of equal size are hashed."""
+  by_size = collections.defaultdict(list)
+  for p in sorted(paths):
+    by_size[os.stat(p).st_size].append(p)
+
+  unique = []
+  duplicates = {}
+  for size, same_size in by_size.iteritems():
+    if len(same_size) == 1:
+      unique.append(same_size[0])
+      continue
+    by_digest = {}
+    for p in same_size:
+      digest = _file_digest(p)
+      if digest in by_digest:
+        duplicates[p] = by_digest[digest]
+      else:
+        by_digest[digest] = p
+        unique.append(p)
+  return sorted(unique), duplicates
+
 class RetryCache(object):
   """Time-based and count-based cache to avoid running retried tasks
-  again on the same slave. If a slave sees a retry it submitted, it
-  puts it back into beanstalk and does a short sleep in the hope that
-  another slave dequeues it.
+  again on the same host. If a slave sees a retry submitted by a slave on
+  its host, it puts it back into beanstalk and does a short sleep in the
+  hope that another host dequeues it.
 
-  This cache tracks the number of times that a given task has been retried
-  by this slave. When the number of times reaches a threshold, the task
-  is evicted from the cache, letting the task run on the same slave.
-  This prevents livelock.
+  This cache tracks the number of times that a given task has been put
+  back by this slave. When the number of times reaches a threshold, the
+  task is let run on this slave, which prevents livelock.
 
-  Otherwise, the cache is evicted based on oldest insertion time."""
+  Otherwise, entries expire after 'ttl_secs', and are evicted based on
+  oldest insertion time. The retries are shared with the other slaves on
+  the host through a marker file for each in 'shared_dir', if given. Both
+  operations are O(1), except that put also prunes 'shared_dir'."""
 
-  def __init__(self, max_size=100, max_count=10):
+  def __init__(self, max_size=100, max_count=10, ttl_secs=600, shared_dir=None,
+               clock=time.time):
     """Create a new RetryCache.
-    
+
     max_size: maximum number of items in the cache.
-    max_count: maximum number of touches before an item expires."""
+    max_count: maximum number of touches before an item expires.
+    ttl_secs: seconds after which an item expires.
+    shared_dir: directory shared by the slaves on the host, if any."""
+    # item -> [count, expiry time], in insertion order.
     self.cache = collections.OrderedDict()
     self.max_size = max_size
     self.max_count = max_count
+    self.ttl_secs = ttl_secs
+    self.shared_dir = shared_dir
+    self.clock = clock
+    if shared_dir is not None and not os.path.isdir(shared_dir):
+      try:
+        os.makedirs(shared_dir)
+      except OSError, e:
+        # Another slave on the host made it first.
+        if e.errno != errno.EEXIST:
+          raise
 
   def get(self, item):
-    if not item in self.cache.keys():
-      return None
-    count = self.cache[item]
-    if count > self.max_count:
-      LOG.debug("Item %s hit max_count of %d, evicting from cache", item, self.max_count)
+    """Return 'item' if this host submitted it and it should not run here
+    yet, counting the touch, or None otherwise."""
+    now = self.clock()
+    entry = self.cache.get(item)
+    if entry is None:
+      expiry = self._shared_expiry(item)
+      if expiry is None:
+        return None
+      entry = self._insert(item, expiry)
+    if entry[1] <= now:
       del self.cache[item]
-    else:
-      self.cache[item] += 1
-
+      return None
+    if entry[0] >= self.max_count:
+      # Kept until it expires, so that the shared marker is not picked up again.
+      LOG.debug("Item %s hit max_count of %d, letting it run", item, self.max_count)
+      return None
+    entry[0] += 1
     return item
 
   def put(self, item):
-    if len(self.cache.keys()) == self.max_size:
-      LOG.debug("Cache is at capacity %d, evicting oldest item %s", self.max_size, item)
-      self.cache.popitem()
-    self.cache[item] = 0
+    now = self.clock()
+    self.cache.pop(item, None)
+    self._insert(item, now + self.ttl_secs)
+    if self.shared_dir is None:
+      return
+    try:
+      path = self._shared_path(item)
+      open(path, "w").close()
+      # The marker expires 'ttl_secs' after its mtime.
+      os.utime(path, (now, now))
+      self._prune_shared(now)
+    except (IOError, OSError):
+      LOG.warning("Failed to share retry %s with the slaves on this host", item, exc_info=True)
+
+  def _insert(self, item, expiry):
+    if len(self.cache) >= self.max_size:
+      oldest, _ = self.cache.popitem(last=False)
+      LOG.debug("Cache is at capacity %d, evicting oldest item %s", self.max_size, oldest)
+    entry = [0, expiry]
+    self.cache[item] = entry
+    return entry
+
+  def _shared_path(self, item):
+    return os.path.join(self.shared_dir, hashlib.sha1(item).hexdigest())
+
+  def _shared_expiry(self, item):
+    """The expiry time of the host's marker for 'item', or None."""
+    if self.shared_dir is None:
+      return None
+    try:
+      return os.stat(self._shared_path(item)).st_mtime + self.ttl_secs
+    except OSError:
+      return None
+
+  def _prune_shared(self, now):
+    """Remove the expired markers, and the oldest beyond 'max_size'."""
+    markers = []
+    for name in os.listdir(self.shared_dir):
+      path = os.path.join(self.shared_dir, name)
+      try:
+        mtime = os.stat(path).st_mtime
+        if mtime + self.ttl_secs <= now:
+          os.unlink(path)
+        else:
+          markers.append((mtime, path))
+      except OSError:
+        # Pruned by another slave.
+        continue
+    markers.sort()
+    for _, path in markers[:max(0, len(markers) - self.max_size)]:
+      try:
+        os.unlink(path)
+      except OSError:
+        pass
+
+class JobDescriptorCache(object):
+  """Resolves the task references queued in beanstalk into Tasks, using the
+  descriptions of their jobs, each of which is fetched from MySQL once."""
+
+  MAX_JOBS = 100
+  TTL_SECS = 60 * 60
+
+  def __init__(self, results_store):
+    self.results_store = results_store
+    # job_id -> (job_format.TaskIndex, priority class)
+    self.jobs = cache.ExpiringCache(max_size=self.MAX_JOBS)
+
+  def resolve(self, ref):
+    """Return the Task referred to by 'ref', or None if its job is unknown."""
+    job = self.jobs.get(ref['job_id'])
+    if job is None:
+      row = self.results_store.fetch_job_descriptor(ref['job_id'])
+      if row is None or row['job_json'] is None:
+        return None
+      job = (job_format.TaskIndex(json.loads(row['job_json'])), row['priority_class'])
+      self.jobs.put(ref['job_id'], job, self.TTL_SECS)
+    tasks, priority_class = job
+    index = dist_test.job_task_index(ref['task_id'])
+    task = dist_test.make_job_task(ref['job_id'], priority_class, index, tasks.task(index))
+    task.attempt = ref['attempt']
+    task.speculative = ref.get('speculative', False)
+    return task
+
+class IsolateWarmer(threading.Thread):
+  """Downloads the isolates of newly submitted jobs into the cache of an
+  idle slave, so that its first tasks of those jobs do not all fetch the
+  same files from the isolate server at once.
+
+  Only the first WARMUP_HASHES_PER_JOB distinct isolates of each job are
+  downloaded, since the tasks of a job mostly share their dependencies.
+  Each slave waits a random delay of up to JITTER_SECS before warming up
+  for a job, and only one slave on a host downloads at a time, to spread
+  the load on the isolate server. Each isolate is warmed up once per host:
+  the slaves on the host share a marker file for each warmed isolate,
+  which expires after WARMED_TTL_SECS. A warmup is aborted once the slave
+  starts a task."""
+
+  POLL_SECS = 10
+  # Jobs submitted longer ago than this are already running.
+  WINDOW_SECS = 300
+  WARMUP_HASHES_PER_JOB = 5
+  JITTER_SECS = 30
+  TIMEOUT_SECS = 600
+  WARMED_TTL_SECS = 60 * 60
+
+  def __init__(self, slave):
+    threading.Thread.__init__(self, name="isolate-warmer")
+    self.daemon = True
+    self.slave = slave
+    # job_id -> time seen, for the jobs of the last WINDOW_SECS.
+    self.seen_jobs = {}
+    self.host_lock_path = "%s.warmup.lock" % slave.config.ISOLATE_CACHE_DIR
+    # Shared by the slaves on the host, like their isolate cache dirs.
+    self.warmed_dir = "%s.warmed" % slave.config.ISOLATE_CACHE_DIR
+    if not os.path.isdir(self.warmed_dir):
+      try:
+        os.makedirs(self.warmed_dir)
+      except OSError, e:
+        # Another slave on the host made it first.
+        if e.errno != errno.EEXIST:
+          raise
+    # The running download, if any.
+    self.process = None
+    self.process_lock = threading.Lock()
+
+  def run(self):
+    while True:
+      time.sleep(self.POLL_SECS)
+      try:
+        self.warm_up()
+      except Exception:
+        LOG.warning("Failed to warm up the isolate cache", exc_info=True)
+
+  def warm_up(self):
+    now = time.time()
+    for job_id, seen in self.seen_jobs.items():
+      if seen < now - self.WINDOW_SECS:
+        del self.seen_jobs[job_id]
+    self._prune_warmed(now)
+    rows = self.slave.results_store.fetch_recent_isolate_hashes(
+      self.WINDOW_SECS, self.seen_jobs.keys())
+    for row in rows:
+      self.seen_jobs[row['job_id']] = now
+      hashes = [h for h in json.loads(row['isolate_hashes'])[:self.WARMUP_HASHES_PER_JOB]
+                if not self._warmed_on_host(h)]
+      if not hashes or self.slave.is_busy:
+        continue
+      time.sleep(random.uniform(0, self.JITTER_SECS))
+      for isolate_hash in hashes:
+        if self.slave.is_busy:
+          return
+        self._download(isolate_hash)
+
+  def abort(self):
+    """Stop the running download, if any."""
+    with self.process_lock:
+      if self.process is not None:
+        self.process.terminate()
+
+  def _warmed_path(self, isolate_hash):
+    return os.path.join(self.warmed_dir, hashlib.sha1(isolate_hash).hexdigest())
+
+  def _warmed_on_host(self, isolate_hash):
+    """Return whether a slave on the host recently warmed up 'isolate_hash'."""
+    try:
+      return os.stat(self._warmed_path(isolate_hash)).st_mtime + self.WARMED_TTL_SECS > time.time()
+    except OSError:
+      return False
+
+  def _prune_warmed(self, now):
+    """Remove the expired markers of warmed isolates."""
+    for name in os.listdir(self.warmed_dir):
+      path = os.path.join(self.warmed_dir, name)
+      try:
+        if os.stat(path).st_mtime + self.WARMED_TTL_SECS <= now:
+          os.unlink(path)
+      except OSError:
+        # Pruned by another slave.
+        continue
+
+  def _download(self, isolate_hash):
+    """Download 'isolate_hash' into the cache, unless the slave is busy or
+    another slave on the host warmed it up. Returns whether it was
+    downloaded."""
+    with open(self.host_lock_path, "a") as host_lock:
+      fcntl.lockf(host_lock.fileno(), fcntl.LOCK_EX)
+      # Another slave may have warmed it up while this one waited.
+      if self._warmed_on_host(isolate_hash):
+        return False
+      with self.slave.cache_lock:
+        env, download_cmd = self.slave.isolate_download_cmd(isolate_hash)
+        target = tempfile.mkdtemp(prefix="dist-test-warmup", dir=self.slave.cache_dir)
+        try:
+          with self.process_lock:
+            # The slave marks itself busy before aborting the download.
+            if self.slave.is_busy:
+              return False
+            LOG.info("Warming up the isolate cache with %s", isolate_hash)
+            self.process = subprocess.Popen(
+              download_cmd + ["-i", isolate_hash, "--target", target],
+              env=env, stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+          timer = threading.Timer(self.TIMEOUT_SECS, self.abort)
+          timer.start()
+          rc = self.process.wait()
+          timer.cancel()
+          if rc != 0:
+            LOG.warning("Failed to warm up the isolate cache with %s", isolate_hash)
+            return False
+          self.slave.isolate_downloaded(isolate_hash)
+          open(self._warmed_path(isolate_hash), "w").close()
+          return True
+        finally:
+          with self.process_lock:
+            self.process = None
+          shutil.rmtree(target, ignore_errors=True)
+
+class MasterStateWriter(object):
+  """Records task state through the master, which batches the writes of
+  all slaves into one MySQL transaction per flush. It offers the
+  ResultsStore methods that the slave writes with.
+
+  A write has been committed once it returns. If the master cannot be
+  reached, the write is made directly to MySQL instead. That is safe even
+  if the master did commit it, since a result which is already recorded
+  counts as recorded without being applied twice."""
+
+  NUM_ATTEMPTS = 3
+
+  def __init__(self, config, results_store):
+    self.config = config
+    self.results_store = results_store
+
+  def _post(self, path, params):
+    url = self.config.DIST_TEST_MASTER + path
+    for attempt in xrange(self.NUM_ATTEMPTS):
+      try:
+        result = json.loads(urllib2.urlopen(url, data=urllib.urlencode(params)).read())
+        if result.get('status') == 'SUCCESS':
+          return result
+        LOG.warning("Failed to write task state via %s: %s", url, repr(result))
+      except Exception:
+        LOG.warning("Failed to write task state via %s", url, exc_info=True)
+      time.sleep(1)
+    return None
+
+  def mark_task_running(self, task):
+    hostname = socket.gethostname()
+    result = self._post("/task_running", {'task_json': task.to_json(), 'hostname': hostname})
+    if result is None:
+      return self.results_store.record_tasks_running([(task, hostname)])[0]
+    return result['run']
+
+  def mark_task_finished(self, task, result_code, stdout, stderr, artifact_archive,
+                         download_secs, run_secs, archive_secs=0):
+    result = self.results_store.upload_task_result(task, result_code, stdout, stderr,
+                                                   artifact_archive, download_secs, run_secs,
+                                                   archive_secs)
+    response = self._post("/task_finished", {'result_json': result.to_json()})
+    if response is None:
+      return self.results_store.record_task_results([result])[0]
+    return response['recorded']
 
 class Slave(object):
 
@@ -85,10 +415,41 @@ class Slave(object):
     self.config.ensure_dist_test_configured()
     self.task_queue = dist_test.TaskQueue(self.config)
     self.results_store = dist_test.ResultsStore(self.config)
+    # Writes the state of tasks to MySQL, with the same interface as results_store.
+    self.state_writer = self.results_store
+    if self.config.DIST_TEST_BATCH_STATE_WRITES:
+      self.state_writer = MasterStateWriter(self.config, self.results_store)
     self.cache_dir = self._get_exclusive_cache_dir()
+    self.peer_blobs = None
+    if self.config.DIST_TEST_PEER_BLOBS:
+      # Each slave on a host has its own port, offset by its cache dir's number.
+      port = self.config.DIST_TEST_PEER_BLOBS_PORT
+      if port:
+        port += int(self.cache_dir.rsplit(".", 1)[1])
+      self.peer_blobs = peer_blobs.PeerBlobServer(self.cache_dir, self.config.ISOLATE_SERVER,
+                                                  port=port)
+      self.peer_blobs.start()
+      LOG.info("Serving isolate blobs to other slaves at %s", self.peer_blobs.url)
+    self.slave_id = None
+    if self.config.DIST_TEST_TASK_AFFINITY:
+      # One per cache dir, like the peer blob port.
+      self.slave_id = "%s.%s" % (socket.gethostname(), self.cache_dir.rsplit(".", 1)[1])
+      self.task_queue.watch_affinity_tube(self.slave_id)
+      LOG.info("Taking the tasks routed to slave %s", self.slave_id)
     self.cur_task = None
     self.is_busy = False
-    self.retry_cache = RetryCache()
+    # Shared by the slaves on the host, like their isolate cache dirs.
+    self.retry_cache = RetryCache(max_size=self.config.DIST_TEST_RETRY_CACHE_SIZE,
+                                  ttl_secs=self.config.DIST_TEST_RETRY_CACHE_TTL_SECS,
+                                  shared_dir="%s.retries" % self.config.ISOLATE_CACHE_DIR)
+    self.job_descriptors = JobDescriptorCache(self.results_store)
+    # Held while downloading into the isolate cache.
+    self.cache_lock = threading.Lock()
+    self.warmer = None
+    if self.config.DIST_TEST_WARMUP_ISOLATES:
+      self.warmer = IsolateWarmer(self)
+      self.warmer.start()
+    self.class_quotas = json.loads(self.config.DIST_TEST_CLASS_QUOTAS)
 
   def _get_exclusive_cache_dir(self):
     for i in xrange(0, 16):
@@ -123,7 +484,6 @@ class Slave(object):
     if task.task.artifact_archive_globs is None or len(task.task.artifact_archive_globs) == 0:
       return None
     all_matched = set()
-    total_size = 0
     for g in task.task.artifact_archive_globs:
       try:
           matched = glob2.iglob(test_dir + "/" + g)
@@ -132,72 +492,122 @@ class Slave(object):
             if not canonical.startswith(test_dir):
               LOG.warn("Glob %s matched file outside of test_dir, skipping: %s" % (g, canonical))
               continue
-            total_size += os.stat(canonical).st_size
             all_matched.add(canonical)
       except Exception as e:
         LOG.warn("Error while globbing %s: %s" % (g, e))
 
     if len(all_matched) == 0:
       return None
+
+    # Only store one copy of files with identical contents. The rest are
+    # listed in a manifest so that the client can restore them on extraction.
+    unique, duplicates = dedupe_by_content(all_matched)
+    total_size = sum([os.stat(m).st_size for m in unique])
+
+    # The archive is spooled to a temp file next to the test dir, rather than
+    # held in memory, so that it can be streamed to the results store.
+    archive_file = tempfile.TemporaryFile(prefix="dist-test-archive",
+                                          dir=os.path.dirname(test_dir))
     max_size = 200*1024*1024 # 200MB max uncompressed size
     if total_size > max_size:
       # If size exceeds the maximum size, upload a zip with an error message instead
       LOG.info("Task %s generated too many bytes of matched artifacts (%d > %d)," \
                + "uploading archive with error message instead.",
               task.task.get_id(), total_size, max_size)
-      archive_buffer = cStringIO.StringIO()
-      with zipfile.ZipFile(archive_buffer, "w") as myzip:
+      with zipfile.ZipFile(archive_file, "w") as myzip:
         myzip.writestr("_ARCHIVE_TOO_BIG_",
                        "Size of matched uncompressed test artifacts exceeded maximum size" \
                        + "(%d bytes > %d bytes)!" % (total_size, max_size))
-      return archive_buffer
+      archive_file.seek(0)
+      return archive_file
 
     # Write out the archive
-    archive_buffer = cStringIO.StringIO()
-    with zipfile.ZipFile(archive_buffer, "w", zipfile.ZIP_DEFLATED) as myzip:
-      for m in all_matched:
-        arcname = os.path.relpath(m, test_dir)
-        while arcname.startswith("/"):
-          arcname = arcname[1:]
-        myzip.write(m, arcname)
-
-    return archive_buffer
-
-  def download_task_files(self, task, test_dir):
-    """
-    Download all of the files associated with 'task' into 'test_dir'.
-    The directory is expected to already exist.
-    """
+    def arcname(path):
+      name = os.path.relpath(path, test_dir)
+      while name.startswith("/"):
+        name = name[1:]
+      return name
+
+    compression = zipfile.ZIP_DEFLATED
+    if not self.config.DIST_TEST_COMPRESS_ARTIFACTS:
+      compression = zipfile.ZIP_STORED
+    with zipfile.ZipFile(archive_file, "w", compression, allowZip64=True) as myzip:
+      for m in unique:
+        myzip.write(m, arcname(m))
+      if duplicates:
+        manifest = dict([(arcname(d), arcname(o)) for d, o in duplicates.iteritems()])
+        myzip.writestr(DUPLICATES_MANIFEST, json.dumps(manifest, indent=2))
+
+    archive_file.seek(0)
+    return archive_file
+
+  def isolate_download_cmd(self, isolate_hash):
+    """Return the environment and the start of the command line with which
+    to download 'isolate_hash' from isolate into this slave's cache."""
     env = os.environ.copy()
     # Make isolateserver run in 'bot' mode. This prevents it from trying
     # to use oauth to authenticate.
     env['SWARMING_HEADLESS'] = '1'
 
+    isolate_server = self.config.ISOLATE_SERVER
+    if self.peer_blobs is not None:
+      # Fetch the blobs from the slaves which have them, if any do.
+      try:
+        peers = self.results_store.fetch_isolate_peers(isolate_hash)
+      except Exception:
+        LOG.warning("Failed to fetch the peers with isolate %s", isolate_hash, exc_info=True)
+        peers = []
+      self.peer_blobs.set_peers(peer_blobs.nearest_first(self.peer_blobs.host_ip, peers))
+      isolate_server = self.peer_blobs.local_url
+
     download_cmd_base = [os.path.join(self.config.ISOLATE_HOME, "isolateserver.py"),
            "download",
-           "--isolate-server=%s" % self.config.ISOLATE_SERVER,
+           "--isolate-server=%s" % isolate_server,
            "--cache=%s" % self.cache_dir,
            "--verbose"]
+    return env, download_cmd_base
 
-    LOG.info("Downloading files from isolate...")
-    download_cmd = download_cmd_base + [
-           "-i", task.task.isolate_hash,
-           "--target", test_dir]
-    rc, stdout, stderr = self.run_command_and_touch_task(
-           download_cmd, task, timeout=600, env=env)
-    if rc != 0:
-      raise Exception("failed to download task files: %s" % stderr)
-
-    # The above doesn't download the '.isolated' file itself. We need
-    # this file since it describes the task working directory, command
-    # line, etc.
-    LOG.info("Downloading isolated file from isolate...")
-    isolated_path = os.path.join(test_dir, "task.isolated")
-    download_cmd = download_cmd_base + ["-f", task.task.isolate_hash, isolated_path]
-    rc, stdout, stderr = self.run_command_and_touch_task(
-           download_cmd, task, timeout=600, env=env)
-    if rc != 0:
-      raise Exception("failed to download task files: %s" % stderr)
+  def isolate_downloaded(self, isolate_hash):
+    """Let the other slaves fetch the blobs of 'isolate_hash' from this one,
+    and the server route the tasks which need them to it."""
+    try:
+      if self.peer_blobs is not None:
+        self.results_store.advertise_isolate(isolate_hash, self.peer_blobs.url)
+      if self.slave_id is not None:
+        self.results_store.record_slave_isolate(self.slave_id, isolate_hash)
+    except Exception:
+      LOG.warning("Failed to advertise isolate %s", isolate_hash, exc_info=True)
+
+  def download_task_files(self, task, test_dir):
+    """
+    Download all of the files associated with 'task' into 'test_dir'.
+    The directory is expected to already exist.
+    """
+    # The cache is not shared with a warmup download.
+    if self.warmer is not None:
+      self.warmer.abort()
+    with self.cache_lock:
+      env, download_cmd_base = self.isolate_download_cmd(task.task.isolate_hash)
+      LOG.info("Downloading files from isolate...")
+      download_cmd = download_cmd_base + [
+             "-i", task.task.isolate_hash,
+             "--target", test_dir]
+      rc, stdout, stderr = self.run_command_and_touch_task(
+             download_cmd, task, timeout=600, env=env)
+      if rc != 0:
+        raise Exception("failed to download task files: %s" % stderr)
+
+      # The above doesn't download the '.isolated' file itself. We need
+      # this file since it describes the task working directory, command
+      # line, etc.
+      LOG.info("Downloading isolated file from isolate...")
+      isolated_path = os.path.join(test_dir, "task.isolated")
+      download_cmd = download_cmd_base + ["-f", task.task.isolate_hash, isolated_path]
+      rc, stdout, stderr = self.run_command_and_touch_task(
+             download_cmd, task, timeout=600, env=env)
+      if rc != 0:
+        raise Exception("failed to download task files: %s" % stderr)
+      self.isolate_downloaded(task.task.isolate_hash)
 
     # We expect to have all of the files that we download writable, but
     # 'isolateserver.py download' defaults to not writable.
@@ -211,7 +621,7 @@ class Slave(object):
         return self.download_task_files(task, test_dir)
       except:
         LOG.warning("failed to download task files. %d tries remaining" % rem_attempts, exc_info=True)
-        if rem_attempts == 0:
+        if rem_attempts == 0 or not self.results_store.is_task_running(task.task):
           raise
         # Recreate the target directory since some files may have been downloaded
         # in the first attempt.
@@ -221,10 +631,12 @@ class Slave(object):
 
   def run_task(self, task):
     """ Download the files, run the task, and upload results. """
-    if not self.results_store.mark_task_running(task.task):
+    if not self.state_writer.mark_task_running(task.task):
       LOG.info("Task %s canceled", task.task.description)
       return
 
+    # Time spent in each phase, for the duration statistics.
+    download_secs = run_secs = archive_secs = 0
     start_time = time.time()
     stdout = None
     stderr = None
@@ -244,6 +656,7 @@ class Slave(object):
       # bouncing among slaves.
       rc = -2
       stderr = str(e)
+    download_secs = time.time() - start_time
 
     # Then run the actual task, unless it already failed downloading above.
     if downloaded:
@@ -267,27 +680,30 @@ class Slave(object):
       # '.' isn't usually on the path, so we need to ensure that the command
       # is an absoluate path.
       file_path.ensure_command_has_abs_path(cmd, cwd)
+      run_start = time.time()
       rc, stdout, stderr = self.run_command_and_touch_task(
           cmd, task,
           timeout=task.task.timeout,
           cwd=cwd)
+      run_secs = time.time() - run_start
 
       # Don't upload logs from successful builds
       if rc == 0:
         stdout = None
         stderr = None
 
+      archive_start = time.time()
       artifact_archive = self.make_archive(task, test_dir)
+      archive_secs = time.time() - archive_start
 
-    end_time = time.time()
-    duration_secs = end_time - start_time
-
-    self.results_store.mark_task_finished(task.task,
-                                          result_code=rc,
-                                          stdout=stdout,
-                                          stderr=stderr,
-                                          artifact_archive=artifact_archive,
-                                          duration_secs=duration_secs)
+    recorded = self.state_writer.mark_task_finished(task.task,
+                                                    result_code=rc,
+                                                    stdout=stdout,
+                                                    stderr=stderr,
+                                                    artifact_archive=artifact_archive,
+                                                    download_secs=download_secs,
+                                                    run_secs=run_secs,
+                                                    archive_secs=archive_secs)
 
     # Do cleanup of temp files
     if test_dir is not None:
@@ -296,11 +712,13 @@ class Slave(object):
     if artifact_archive is not None:
       artifact_archive.close()
 
-    if rc != 0:
+    if not recorded:
+      LOG.info("Task %s was finished elsewhere or canceled, discarding result",
+               task.task.get_id())
+    elif rc != 0:
       # If there have been too many failures, cancel the job
-      num_failed = self.results_store.count_num_failed_tasks(task.task)
-      if num_failed > 100:
-        LOG.info("Job %s has too many failed tasks (%d), cancelling" % (task.task.job_id, num_failed))
+      if self.results_store.has_too_many_failures(task.task.job_id):
+        LOG.info("Job %s has too many failed tasks, cancelling" % task.task.job_id)
         self.cancel_job(task.task.job_id)
       # Retry if non-zero exit code and have retries remaining
       elif task.task.attempt < task.task.max_retries:
@@ -312,7 +730,11 @@ class Slave(object):
     Run the command 'cmd' with the given timeout 'timeout'.
 
     While the command is running, periodically touches 'task in the
-    queue so that it doesn't get re-assigned to another slave.
+    queue so that it doesn't get re-assigned to another slave, and checks
+    that its attempt is still running. The command is killed if the attempt
+    was finished by a speculative duplicate, or canceled. The server also
+    sends a kill message when it cancels the job, which is checked for
+    every KILL_CHECK_SECS.
 
     Parameters
     ----------
@@ -334,6 +756,7 @@ class Slave(object):
     stderr = ""
 
     last_touch = time.time()
+    last_kill_check = last_touch
     kill_term_time = last_touch + timeout
     kill_kill_time = kill_term_time + 5
     while True:
@@ -355,6 +778,16 @@ class Slave(object):
         LOG.info("Task did not exit after SIGTERM. Sending SIGKILL")
         p.kill()
 
+      if now - last_kill_check > KILL_CHECK_SECS:
+        last_kill_check = now
+        try:
+          if self.task_queue.check_killed(task):
+            LOG.info("Task %s canceled, killing it", task.task.get_id())
+            stderr += "\n------\nKilled since the job was canceled"
+            p.kill()
+        except:
+          LOG.info("Could not check for a kill message", exc_info=True)
+
       if time.time() - last_touch > 10:
         LOG.info("Still running: " + task.task.description)
         try:
@@ -363,6 +796,14 @@ class Slave(object):
           LOG.info("Could not touch beanstalk queue elem", exc_info=True)
           pass
         last_touch = time.time()
+        try:
+          if not self.results_store.is_task_running(task.task):
+            LOG.info("Task %s finished elsewhere or canceled, killing it",
+                     task.task.get_id())
+            stderr += "\n------\nKilled since the task was finished elsewhere or canceled"
+            p.kill()
+        except:
+          LOG.info("Could not check the task status", exc_info=True)
 
     return p.wait(), stdout, stderr
 
@@ -400,26 +841,60 @@ class Slave(object):
       try:
         logging.info("waiting for next task...")
         self.is_busy = False
-        self.cur_task = self.task_queue.reserve_task()
+        self.cur_task = self.task_queue.reserve_task(self.class_quotas)
       except Exception, e:
         LOG.warning("Failed to reserve job: %s" % str(e))
         time.sleep(1)
         continue
+      if self.cur_task is None:
+        # Timed out waiting on the classes under their quotas.
+        continue
+
+      if self.cur_task.task is None:
+        ref = self.cur_task.ref
+        try:
+          self.cur_task.task = self.job_descriptors.resolve(ref)
+        except Exception, e:
+          LOG.warning("Failed to fetch the description of job %s: %s" % (ref['job_id'], str(e)))
+          self.cur_task.bs_elem.release()
+          self.cur_task = None
+          time.sleep(1)
+          continue
+        if self.cur_task.task is None:
+          LOG.error("Deleting task %s of unknown job %s", ref['task_id'], ref['job_id'])
+          self.task_queue.delete_task(self.cur_task)
+          self.cur_task = None
+          continue
 
       LOG.info("got task: %s", self.cur_task.task.to_json())
 
       if self.retry_cache.get(self.cur_task.task.get_retry_id()) is not None:
         sleep_time = 5
-        LOG.info("Got a retry task submitted by this slave, releasing it and sleeping %d s...", sleep_time)
+        LOG.info("Got a retry task submitted by this host, releasing it and sleeping %d s...", sleep_time)
         self.cur_task.bs_elem.release()
         time.sleep(sleep_time)
         continue
 
+      try:
+        claimed = self.task_queue.claim_affinity_task(self.cur_task)
+      except Exception, e:
+        LOG.warning("Failed to claim task: %s" % str(e))
+        self.cur_task.bs_elem.release()
+        self.cur_task = None
+        time.sleep(1)
+        continue
+      if not claimed:
+        LOG.info("Task %s was already taken by another slave, deleting it",
+                 self.cur_task.task.task_id)
+        self.task_queue.delete_task(self.cur_task)
+        self.cur_task = None
+        continue
+
       self.is_busy = True
       self.run_task(self.cur_task)
       try:
         logging.info("task complete")
-        self.cur_task.bs_elem.delete()
+        self.task_queue.delete_task(self.cur_task)
       except Exception, e:
         LOG.warning("Failed to delete job: %s" % str(e))
       finally:
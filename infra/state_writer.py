@@ -0,0 +1,90 @@
+import logging
+import threading
+import time
+
+class _PendingWrite(object):
+  def __init__(self, kind, item):
+    self.kind = kind
+    self.item = item
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+class BatchingStateWriter(object):
+  """Coalesces the task state writes of all slaves, which are funneled
+  through the master, into one MySQL transaction per flush.
+
+  A flush starts once writes have been waiting for 'flush_interval_secs',
+  and takes up to 'max_batch_size' of them. Each caller blocks until the
+  transaction holding its write has committed, and gets the same answer as
+  from the unbatched ResultsStore call, so a write that returned has been
+  durably recorded. If the transaction fails, every write in it raises,
+  and nothing in it was recorded."""
+
+  RUNNING = "running"
+  FINISHED = "finished"
+
+  def __init__(self, results_store, flush_interval_secs=0.1, max_batch_size=500):
+    self.results_store = results_store
+    self.flush_interval_secs = flush_interval_secs
+    self.max_batch_size = max_batch_size
+    self.pending = []
+    self.cond = threading.Condition()
+    self.thread = threading.Thread(target=self._run, name="state-writer")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def mark_task_running(self, task, hostname):
+    """Batched ResultsStore.record_tasks_running of a single task."""
+    return self._write(self.RUNNING, (task, hostname))
+
+  def record_task_result(self, result):
+    """Batched ResultsStore.record_task_results of a single TaskResult."""
+    return self._write(self.FINISHED, result)
+
+  def _write(self, kind, item):
+    write = _PendingWrite(kind, item)
+    with self.cond:
+      self.pending.append(write)
+      self.cond.notify()
+    write.done.wait()
+    if write.error is not None:
+      raise write.error
+    return write.result
+
+  def _run(self):
+    while True:
+      with self.cond:
+        while not self.pending:
+          self.cond.wait()
+      # Let more writes arrive, so that they share the commit.
+      time.sleep(self.flush_interval_secs)
+      with self.cond:
+        batch = self.pending[:self.max_batch_size]
+        del self.pending[:self.max_batch_size]
+      self._flush(batch)
+
+  def _flush(self, batch):
+    running = [w for w in batch if w.kind == self.RUNNING]
+    finished = [w for w in batch if w.kind == self.FINISHED]
+    try:
+      with self.results_store.transaction():
+        if running and finished:
+          # Lock all the rows in one sorted pass, since locking those of
+          # each kind in turn could deadlock with another batch.
+          self.results_store.lock_task_rows([w.item[0] for w in running] +
+                                            [w.item.task for w in finished])
+        if running:
+          results = self.results_store.record_tasks_running([w.item for w in running])
+          for w, result in zip(running, results):
+            w.result = result
+        if finished:
+          results = self.results_store.record_task_results([w.item for w in finished])
+          for w, result in zip(finished, results):
+            w.result = result
+    except Exception, e:
+      logging.warning("Failed to write a batch of %d task states", len(batch), exc_info=True)
+      for w in batch:
+        w.error = e
+    for w in batch:
+      w.done.set()
@@ -1,6 +1,30 @@
 #!/usr/bin/env python
+import autoscale
+import BaseHTTPServer
+import blob_store
+import cache
+import datetime
 import dist_test
+import duration_cache
+import hashlib
+import imp
+import job_format
+import json
+import log_view
+import metrics
+import os
+import peer_blobs
+import shutil
+import sys
+import simulator
+import slave
+import state_writer
+import tempfile
+import threading
+import time
 import unittest
+import urllib2
+import zlib
 
 class TestTaskGroup(unittest.TestCase):
 
@@ -11,5 +35,719 @@ class TestTaskGroup(unittest.TestCase):
         self.assertFalse(group.is_flaky)
         self.assertFalse(group.is_succeeded)
 
+class TestDedupeByContent(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _write(self, name, contents):
+        path = os.path.join(self.tmp, name)
+        with open(path, "w") as f:
+            f.write(contents)
+        return path
+
+    def test_dedupe(self):
+        a = self._write("a.log", "same")
+        b = self._write("b.log", "same")
+        c = self._write("c.log", "diff")
+        d = self._write("d.log", "longer")
+        unique, duplicates = slave.dedupe_by_content([d, c, b, a])
+        self.assertEquals([a, c, d], unique)
+        self.assertEquals({b: a}, duplicates)
+
+class TestJobFormat(unittest.TestCase):
+
+    def test_compact(self):
+        tasks = []
+        for name in ["a", "b"]:
+            for _ in xrange(3):
+                tasks.append(dict(isolate_hash=name * 40, description=name + "-test",
+                                  timeout=600, artifact_archive_globs=["**/*.xml"]))
+        tasks[4]['timeout'] = 1200
+        del tasks[5]['timeout']
+        job = job_format.compact(dict(tasks=tasks))
+        self.assertEquals(["**/*.xml"], job['task_defaults']['artifact_archive_globs'])
+        # Not every task has a timeout, so it cannot default.
+        self.assertFalse('timeout' in job['task_defaults'])
+        self.assertEquals([3, 1, 1, 1], [t.get('count', 1) for t in job['tasks']])
+        self.assertEquals(tasks, list(job_format.expand_tasks(job)))
+        # Compacting the compact form changes nothing.
+        self.assertEquals(job, job_format.compact(job))
+
+class TestJobDescriptorCache(unittest.TestCase):
+
+    def test_resolve(self):
+        job = dict(task_defaults=dict(timeout=600),
+                   tasks=[dict(isolate_hash="a" * 40, description="a-test", count=2),
+                          dict(isolate_hash="b" * 40, description="b-test", max_retries=2)])
+        fetches = []
+        class Store(object):
+            def fetch_job_descriptor(self, job_id):
+                fetches.append(job_id)
+                if job_id == "job":
+                    return dict(job_json=json.dumps(job), priority_class="nightly")
+                return None
+        descriptors = slave.JobDescriptorCache(Store())
+        tasks = [dist_test.make_job_task("job", "nightly", i, t)
+                 for i, t in enumerate(job_format.expand_tasks(job))]
+        tasks[2].attempt = 1
+        tasks[2].speculative = True
+        for task in tasks:
+            resolved = descriptors.resolve(json.loads(task.to_ref_json()))
+            self.assertEquals(task.to_json(), resolved.to_json())
+        self.assertEquals(["job"], fetches)
+        self.assertEquals(None, descriptors.resolve(dict(job_id="other", task_id="a.0", attempt=0)))
+        # Retries of jobs with no description are queued whole.
+        class Elem(object):
+            body = tasks[2].to_json()
+        self.assertEquals(tasks[2].to_json(), dist_test.ReservedTask(Elem()).task.to_json())
+
+class TestRestoreDuplicates(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def test_relative_dest(self):
+        os.environ.setdefault("DIST_TEST_MASTER", "http://master")
+        import client
+        os.makedirs("out/logs")
+        with open("out/logs/a.txt", "w") as f:
+            f.write("log")
+        with open(os.path.join("out", client.DUPLICATES_MANIFEST), "w") as f:
+            json.dump({"logs/copy/b.txt": "logs/a.txt", "../escape.txt": "logs/a.txt"}, f)
+        client._restore_duplicates("./out/../out")
+        self.assertEquals("log", open("out/logs/copy/b.txt").read())
+        self.assertFalse(os.path.exists("escape.txt"))
+        self.assertFalse(os.path.exists(os.path.join("out", client.DUPLICATES_MANIFEST)))
+
+class TestRetryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_anti_affinity(self):
+        now = [0]
+        make = lambda: slave.RetryCache(max_size=2, max_count=2, ttl_secs=60,
+                                        shared_dir=self.tmp, clock=lambda: now[0])
+        mine, neighbor = make(), make()
+        mine.put("a")
+        # The slave on the same host avoids it too, until it has released it max_count times.
+        for cache in [mine, neighbor]:
+            self.assertEquals(["a", "a", None], [cache.get("a") for _ in xrange(3)])
+        # The oldest retry is evicted, here and on the host.
+        now[0] = 1
+        mine.put("b")
+        now[0] = 2
+        mine.put("c")
+        self.assertEquals(None, mine.get("a"))
+        self.assertEquals(2, len(os.listdir(self.tmp)))
+        self.assertEquals("b", make().get("b"))
+        # Retries expire.
+        now[0] = 62
+        self.assertEquals(None, mine.get("c"))
+        self.assertEquals(None, make().get("c"))
+
+class TestIsolateWarmer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmp, "downloads")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def make_warmer(self, index, download_cmd):
+        test = self
+        class Config(object):
+            ISOLATE_CACHE_DIR = os.path.join(test.tmp, "cache")
+        class Store(object):
+            def fetch_recent_isolate_hashes(self, window_secs, exclude_job_ids):
+                rows = [dict(job_id="job", isolate_hashes=json.dumps(["a" * 40, "b" * 40]))]
+                return [r for r in rows if r['job_id'] not in exclude_job_ids]
+        class Slave(object):
+            config = Config()
+            results_store = Store()
+            is_busy = False
+            cache_lock = threading.Lock()
+            cache_dir = "%s.%d" % (Config.ISOLATE_CACHE_DIR, index)
+            downloaded = []
+            def isolate_download_cmd(self, isolate_hash):
+                return os.environ.copy(), [sys.executable, "-c", download_cmd]
+            def isolate_downloaded(self, isolate_hash):
+                self.downloaded.append(isolate_hash)
+        s = Slave()
+        os.makedirs(s.cache_dir)
+        warmer = slave.IsolateWarmer(s)
+        warmer.JITTER_SECS = 0
+        return warmer
+
+    def test_once_per_host(self):
+        record = "import sys; open(%r, 'a').write(sys.argv[2] + '\\n')" % self.log
+        mine, neighbor = self.make_warmer(0, record), self.make_warmer(1, record)
+        mine.warm_up()
+        neighbor.warm_up()
+        self.assertEquals(["a" * 40, "b" * 40], open(self.log).read().split())
+        self.assertEquals(["a" * 40, "b" * 40], mine.slave.downloaded)
+        self.assertEquals([], neighbor.slave.downloaded)
+
+    def test_abort(self):
+        warmer = self.make_warmer(0, "import time; time.sleep(60)")
+        thread = threading.Thread(target=warmer.warm_up)
+        thread.start()
+        while warmer.process is None:
+            time.sleep(0.01)
+        # As the slave does when it starts a task.
+        warmer.slave.is_busy = True
+        warmer.abort()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEquals(None, warmer.process)
+        self.assertEquals([], warmer.slave.downloaded)
+        self.assertEquals([], os.listdir(warmer.warmed_dir))
+
+class TestPeerBlobs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.isolate_hits = []
+        hits = self.isolate_hits
+        class IsolateHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                hits.append(self.path)
+                body = zlib.compress("from isolate")
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        self.isolate = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), IsolateHandler)
+        thread = threading.Thread(target=self.isolate.serve_forever)
+        thread.daemon = True
+        thread.start()
+        isolate_url = "http://127.0.0.1:%d" % self.isolate.server_address[1]
+        self.servers = []
+        for name in ["a", "b"]:
+            cache_dir = os.path.join(self.tmp, name)
+            os.makedirs(cache_dir)
+            server = peer_blobs.PeerBlobServer(cache_dir, isolate_url, host_ip="127.0.0.1")
+            server.start()
+            self.servers.append(server)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        self.isolate.shutdown()
+        self.isolate.server_close()
+        shutil.rmtree(self.tmp)
+
+    def _retrieve(self, server, digest):
+        url = "%s/content-gs/retrieve/default-gzip/%s" % (server.local_url, digest)
+        return zlib.decompress(urllib2.urlopen(url).read())
+
+    def test_fetch_from_peer(self):
+        a, b = self.servers
+        content = "blob" * 1000
+        digest = hashlib.sha1(content).hexdigest()
+        with open(os.path.join(a.cache_dir, digest), "w") as f:
+            f.write(content)
+        b.set_peers(peer_blobs.nearest_first(b.host_ip, [a.url, b.url]))
+        self.assertEquals(content, self._retrieve(b, digest))
+        self.assertEquals([], self.isolate_hits)
+
+        # A compressible blob of several chunks, which zlib buffers.
+        large = "a" * (3 * peer_blobs.CHUNK_SIZE)
+        large_digest = hashlib.sha1(large).hexdigest()
+        with open(os.path.join(a.cache_dir, large_digest), "w") as f:
+            f.write(large)
+        self.assertEquals(large, self._retrieve(b, large_digest))
+        self.assertEquals([], self.isolate_hits)
+
+        # Blobs which the peer does not have, or has corrupt, come from isolate.
+        other = hashlib.sha1("other").hexdigest()
+        self.assertEquals("from isolate", self._retrieve(b, other))
+        with open(os.path.join(a.cache_dir, digest), "w") as f:
+            f.write("corrupt")
+        self.assertEquals("from isolate", self._retrieve(b, digest))
+        self.assertEquals(2, len(self.isolate_hits))
+
+        # Other hosts can only fetch blobs, not reach the isolate server.
+        for path in ["/content-gs/retrieve/default-gzip/%s" % other, "/blob/../" + digest]:
+            with self.assertRaises(urllib2.HTTPError) as cm:
+                urllib2.urlopen(a.url + path)
+            self.assertEquals(404, cm.exception.code)
+        self.assertEquals(2, len(self.isolate_hits))
+
+    def test_nearest_first(self):
+        peers = ["http://10.1.2.3:1", "http://10.9.0.1:2", "http://10.1.2.9:3"]
+        self.assertEquals(["http://10.1.2.3:1", "http://10.1.2.9:3", "http://10.9.0.1:2"],
+                          peer_blobs.nearest_first("10.1.2.3", peers))
+
+class TestLocalBlobStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.store = blob_store.LocalBlobStore(self.tmp, "http://master")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_ranges(self):
+        self.store.put_string("job.task.0.stdout", "0123456789")
+        self.assertEquals(10, self.store.size("job.task.0.stdout"))
+        self.assertEquals("234", self.store.read_range("job.task.0.stdout", 2, 5))
+        self.assertEquals(["01234", "56789"],
+                          list(self.store.iter_range("job.task.0.stdout", chunk_size=5)))
+        self.assertEquals(["78", "9"],
+                          list(self.store.iter_range("job.task.0.stdout", 7, chunk_size=2)))
+        self.assertEquals("http://master/blob?key=job.task.0.stdout",
+                          self.store.generate_url("job.task.0.stdout"))
+
+    def test_put_file(self):
+        with tempfile.TemporaryFile() as f:
+            f.write("archive")
+            f.seek(0)
+            self.store.put_file("job.task.0-artifacts.zip", f)
+        self.assertEquals("archive", self.store.read_range("job.task.0-artifacts.zip", 0, 100))
+
+    def test_invalid_key(self):
+        self.assertRaises(KeyError, self.store.put_string, "../escape", "x")
+
+class TestHttpBlobStore(unittest.TestCase):
+
+    def setUp(self):
+        self.uploads = []
+        uploads = self.uploads
+        class UploadHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                if not self.headers.get('Authorization', '').startswith('Digest username="user"'):
+                    self.send_response(401)
+                    self.send_header("WWW-Authenticate",
+                                     'Digest realm="dist_test", nonce="abc", qop="auth"')
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                uploads.append((self.path, body))
+                self.send_response(200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            def log_message(self, *args):
+                pass
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), UploadHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.store = blob_store.HttpBlobStore(
+            "http://127.0.0.1:%d" % self.server.server_address[1], "user", "password")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_authenticated_upload(self):
+        self.store.put_string("job.task.0.stdout", "output")
+        with tempfile.TemporaryFile() as f:
+            f.write("skipped archive")
+            f.seek(len("skipped "))
+            self.store.put_file("job.task.0-artifacts.zip", f)
+        # The file is sent again in full after the auth challenge.
+        self.assertEquals([("/upload_blob?key=job.task.0.stdout", "output"),
+                           ("/upload_blob?key=job.task.0-artifacts.zip", "archive")],
+                          self.uploads)
+
+class TestExpiringCache(unittest.TestCase):
+
+    def test_expiry_and_eviction(self):
+        now = [100]
+        c = cache.ExpiringCache(max_size=2, clock=lambda: now[0])
+        c.put("a", 1, 10)
+        c.put("b", 2, 20)
+        self.assertEquals(1, c.get("a"))
+        # "b" is now the least recently used entry
+        c.put("c", 3, 20)
+        self.assertEquals(None, c.get("b"))
+        self.assertEquals(1, c.get("a"))
+        now[0] = 110
+        self.assertEquals(None, c.get("a"))
+        self.assertEquals(3, c.get("c"))
+        # An expired entry is evicted before the least recently used one.
+        c.put("d", 4, 20)
+        self.assertEquals(3, c.get("c"))
+        c.put("a", 1, 5)
+        c.put("e", 5, 20)
+        # "e" is the least recently used, but "a" expires first.
+        self.assertEquals(1, c.get("a"))
+        now[0] = 116
+        c.put("f", 6, 20)
+        self.assertEquals([None, 5, 6], [c.get(k) for k in "aef"])
+
+class _FakeResultsStore(object):
+    """Records the batches written by a BatchingStateWriter."""
+
+    def __init__(self):
+        self.transactions = []
+        self.fail = False
+
+    def transaction(self):
+        store = self
+        class Transaction(object):
+            def __enter__(self):
+                store.transactions.append([])
+            def __exit__(self, *exc):
+                pass
+        return Transaction()
+
+    def lock_task_rows(self, tasks):
+        self.transactions[-1].append(("lock", len(tasks)))
+
+    def record_tasks_running(self, entries):
+        self.transactions[-1].append(("running", len(entries)))
+        return [task.attempt == 0 for task, _ in entries]
+
+    def record_task_results(self, results):
+        if self.fail:
+            raise Exception("deadlock")
+        self.transactions[-1].append(("finished", len(results)))
+        return [r.result_code == 0 for r in results]
+
+class TestBatchingStateWriter(unittest.TestCase):
+
+    def _task(self, i, attempt=0):
+        return dist_test.Task(dict(job_id="job", task_id="t.%d" % i,
+                                   isolate_hash="t", description="d", attempt=attempt))
+
+    def test_batching(self):
+        store = _FakeResultsStore()
+        writer = state_writer.BatchingStateWriter(store, flush_interval_secs=0.2)
+        answers = {}
+        def write(i):
+            answers[i] = (writer.mark_task_running(self._task(i, attempt=i % 2), "host"),
+                          writer.record_task_result(
+                              dist_test.TaskResult(self._task(i), i % 3, "host", run_secs=1)))
+        threads = [threading.Thread(target=write, args=(i,)) for i in xrange(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # Each caller gets its own answer, and the writes share transactions.
+        self.assertEquals(dict((i, (i % 2 == 0, i % 3 == 0)) for i in xrange(6)), answers)
+        writes = [w for batch in store.transactions for w in batch]
+        self.assertEquals(6, sum(n for kind, n in writes if kind == "running"))
+        self.assertEquals(6, sum(n for kind, n in writes if kind == "finished"))
+        self.assertTrue(len(store.transactions) < 12)
+
+        store.fail = True
+        self.assertRaises(Exception, writer.record_task_result,
+                          dist_test.TaskResult(self._task(0), 0, "host", run_secs=1))
+
+    def test_mixed_batch(self):
+        store = _FakeResultsStore()
+        writer = state_writer.BatchingStateWriter(store, flush_interval_secs=0.2)
+        threads = [threading.Thread(target=writer.mark_task_running, args=(self._task(i), "host"))
+                   for i in xrange(2)]
+        threads += [threading.Thread(target=writer.record_task_result,
+                                     args=(dist_test.TaskResult(self._task(i), 0, "host"),))
+                    for i in xrange(2, 5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # The rows of both kinds of write are locked together, before either is applied.
+        self.assertEquals([[("lock", 5), ("running", 2), ("finished", 3)]], store.transactions)
+
+    def test_task_result_json(self):
+        result = dist_test.TaskResult(self._task(1), 1, "host", download_secs=1, run_secs=2.5)
+        result.stderr_key = "job.t.1.0.stderr"
+        copy = dist_test.TaskResult.from_json(result.to_json())
+        self.assertEquals(result.to_json(), copy.to_json())
+        self.assertTrue(copy.matches(dict(status=1, hostname="host", stdout_key=None,
+                                          stderr_key="job.t.1.0.stderr")))
+        self.assertFalse(copy.matches(dict(status=1, hostname="other", stdout_key=None,
+                                           stderr_key="job.t.1.0.stderr")))
+
+class TestDurationCache(unittest.TestCase):
+
+    def test_incremental_refresh(self):
+        t0 = datetime.datetime(2020, 1, 1)
+        rows = [dict(description="a", total_p50=10.0, update_timestamp=t0),
+                dict(description="b", total_p50=20.0, update_timestamp=t0)]
+        fetches = []
+        class Store(object):
+            def fetch_duration_stats_since(self, timestamp):
+                fetches.append(timestamp)
+                return [r for r in rows if timestamp is None or r['update_timestamp'] >= timestamp]
+        durations = duration_cache.DurationCache(Store(), overlap_secs=60)
+        # The first lookup loads everything, and duplicates are looked up once.
+        self.assertEquals({"a": 10.0}, durations.get_durations(["a", "a", "c"]))
+        self.assertEquals([None], fetches)
+
+        rows[1] = dict(description="b", total_p50=25.0,
+                       update_timestamp=t0 + datetime.timedelta(seconds=5))
+        durations.refresh()
+        self.assertEquals(t0 - datetime.timedelta(seconds=60), fetches[-1])
+        self.assertEquals({"a": 10.0, "b": 25.0}, durations.get_durations(["a", "b"]))
+        durations.refresh()
+        self.assertEquals(t0 - datetime.timedelta(seconds=55), fetches[-1])
+        # Purged statistics are dropped.
+        del rows[0]
+        durations.forget(["a"])
+        self.assertEquals({"b": 25.0}, durations.get_durations(["a", "b"]))
+
+class TestLogView(unittest.TestCase):
+
+    def test_read_page(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            store = blob_store.LocalBlobStore(tmp, "")
+            store.put_string("log", "0123456789")
+            page = log_view.read_page(store, "log", offset=8, length=4)
+            self.assertEquals((8, 10, 10, "89"),
+                              (page["start"], page["end"], page["size"], page["text"]))
+            page = log_view.read_page(store, "log", length=4, tail=True)
+            self.assertEquals((6, 10, "6789"), (page["start"], page["end"], page["text"]))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_grep_across_chunks(self):
+        chunks = ["first li", "ne\nERROR: bad\nok\nERR", "OR: worse"]
+        matches, truncated = log_view.grep(chunks, "ERROR:")
+        self.assertEquals([(2, 11, "ERROR: bad"), (4, 25, "ERROR: worse")], matches)
+        self.assertFalse(truncated)
+        matches, truncated = log_view.grep(chunks, "ERROR", max_matches=1)
+        self.assertEquals(1, len(matches))
+        self.assertTrue(truncated)
+        matches, _ = log_view.grep(chunks, "ERROR", max_text_length=5)
+        self.assertEquals(["ERROR", "ERROR"], [text for _, _, text in matches])
+
+    def test_long_lines(self):
+        chunks = ["x" * 6, "x" * 6 + "\nshort\n", "y" * 20]
+        self.assertEquals([(0, "x" * 8), (13, "short"), (19, "y" * 8)],
+                          list(log_view.iter_lines(chunks, max_line_length=8)))
+
+class TestMetrics(unittest.TestCase):
+
+    def test_quantile(self):
+        self.assertEquals(None, metrics.quantile([], 0.5))
+        self.assertEquals(2, metrics.quantile([4, 1, 3, 2], 0.5))
+        self.assertEquals(10, metrics.quantile(range(1, 11), 0.95))
+        self.assertEquals(1, metrics.quantile([1], 0.95))
+        values = [4, 1, 3, 2, 2, 2, 9]
+        counts = [(v, values.count(v)) for v in set(values)]
+        for q in [0, 0.3, 0.5, 0.95, 1]:
+            self.assertEquals(metrics.quantile(values, q), metrics.histogram_quantile(counts, q))
+        self.assertEquals(None, metrics.histogram_quantile([], 0.5))
+
+    def test_histogram(self):
+        h = metrics.Histogram("test_seconds", "Test.", ("op",), buckets=(1, 10))
+        h.observe(0.5, "get")
+        h.observe(1, "get")
+        h.observe(20, "get")
+        h.observe(5, "put")
+        [(labels, cumulative, count, total), _] = h.snapshot()
+        self.assertEquals({"op": "get"}, labels)
+        self.assertEquals([(1, 2), (10, 2), (float("inf"), 3)], cumulative)
+        self.assertEquals(3, count)
+        self.assertEquals(21.5, total)
+
+        text = metrics.format_prometheus([("test_gauge", "A gauge.", [({"tube": "a"}, 3), ({}, None)])],
+                                         histograms=[h])
+        self.assertTrue('test_gauge{tube="a"} 3.0\n' in text)
+        self.assertTrue('test_seconds_bucket{le="+Inf",op="get"} 3\n' in text)
+        self.assertTrue('test_seconds_count{op="put"} 1\n' in text)
+
+class TestAutoscaler(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        clock = lambda: self.now
+        self.provider = autoscale.SimulatedProvider(clock)
+        self.scaler = autoscale.Autoscaler(self.provider, target_secs=100, executors_per_node=2,
+                                           max_nodes=50, shrink_delay_secs=300, clock=clock)
+
+    def _stats(self, queued_tasks, queued_work_secs):
+        return dict(outstanding_work=dict(queued_tasks=queued_tasks, queued_work_secs=queued_work_secs,
+                                          running_tasks=0, running_work_secs=0))
+
+    def test_desired_size(self):
+        self.assertEquals(1, self.scaler.desired_size(self._stats(0, 0)))
+        self.assertEquals(5, self.scaler.desired_size(self._stats(100, 1000)))
+        # Limited by the number of tasks, and by max_nodes
+        self.assertEquals(2, self.scaler.desired_size(self._stats(3, 1000)))
+        self.assertEquals(50, self.scaler.desired_size(self._stats(1000, 100000)))
+
+    def test_grow_and_shrink(self):
+        self.assertEquals(5, self.scaler.step(self._stats(100, 1000)))
+        self.now = 120
+        self.assertEquals(0, self.scaler.step(self._stats(0, 0)))
+        # Still within the shrink delay
+        self.now = 400
+        self.assertEquals(0, self.scaler.step(self._stats(0, 0)))
+        # Past the shrink delay, but the nodes' 10 minute minimum is not used up
+        self.now = 500
+        self.assertEquals(0, self.scaler.step(self._stats(0, 0)))
+        self.now = 590
+        self.assertEquals(-4, self.scaler.step(self._stats(0, 0)))
+        self.assertEquals(1, len(self.provider.list_nodes()))
+        self.assertEquals(4 * 600, self.provider.billed_secs)
+
+class TestGceProvider(unittest.TestCase):
+
+    FAKE_GCLOUD = """#!%s
+import json, sys
+args = sys.argv[1:]
+open(%r, "a").write(" ".join(args) + "\\n")
+if "list-instances" in args:
+    print json.dumps([dict(instance="zones/z/instances/" + n) for n in ["s1", "s2", "s3"]])
+elif "list" in args:
+    print json.dumps([dict(name="s1", creationTimestamp="2016-03-01T10:20:30.123-08:00"),
+                      dict(name="other", creationTimestamp="2016-03-01T10:20:30Z")])
+elif "describe" in args:
+    print json.dumps(dict(targetSize=3))
+"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmp, "calls")
+        gcloud = os.path.join(self.tmp, "gcloud")
+        with open(gcloud, "w") as f:
+            f.write(self.FAKE_GCLOUD % (sys.executable, self.log))
+        os.chmod(gcloud, 0755)
+        self.old_path = os.environ["PATH"]
+        os.environ["PATH"] = self.tmp + os.pathsep + self.old_path
+        self.gce = imp.load_source("gce_autoscale", os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), "gce-autoscale.py"))
+
+    def tearDown(self):
+        os.environ["PATH"] = self.old_path
+        shutil.rmtree(self.tmp)
+
+    def _resizes(self):
+        return [l.split()[-1] for l in open(self.log) if " resize " in l]
+
+    def test_parse_timestamp(self):
+        self.assertEquals(1456856430, self.gce.parse_timestamp("2016-03-01T18:20:30Z"))
+        self.assertEquals(1456856430, self.gce.parse_timestamp("2016-03-01T10:20:30.123-08:00"))
+        self.assertEquals(1456856430, self.gce.parse_timestamp("2016-03-01T19:50:30+01:30"))
+
+    def test_list_and_grow(self):
+        provider = self.gce.GceProvider("group")
+        nodes = provider.list_nodes()
+        # Instances still being created count, so growing does not add them twice.
+        self.assertEquals(["s1", "s2", "s3"], [n.name for n in nodes])
+        self.assertEquals(1456856430, nodes[0].start_time)
+        provider.grow_to(3)
+        self.assertEquals([], self._resizes())
+        provider.grow_to(5)
+        self.assertEquals(["--size=5"], self._resizes())
+
+class TestSimulator(unittest.TestCase):
+
+    def _tasks(self, durations, **kwargs):
+        return [simulator.SimTask("job", "task-%d" % i, "desc-%d" % i, d, **kwargs)
+                for i, d in enumerate(durations)]
+
+    def test_longest_first(self):
+        tasks = self._tasks([1, 2, 3, 4])
+        # Longest first: one slave runs 4 then 1, the other 3 then 2.
+        summary = simulator.Simulator(num_slaves=2).run(tasks).summary()
+        self.assertEquals(5, summary["makespan"])
+        self.assertEquals(1.0, summary["utilization"])
+        # In submission order, the 4 second task starts last.
+        summary = simulator.Simulator(num_slaves=2, sort_by_duration=False).run(tasks).summary()
+        self.assertEquals(6, summary["makespan"])
+
+    def test_retries_and_download_cache(self):
+        tasks = self._tasks([10], fail_prob=1.0, max_retries=1)
+        sim = simulator.Simulator(num_slaves=2, download_secs=3, cached_download_secs=1)
+        summary = sim.run(tasks).summary()
+        self.assertEquals(2, summary["attempts"])
+        self.assertEquals(1, summary["failed_tasks"])
+        # The retry goes to the idle slave, which has to download the bundle.
+        self.assertEquals(0, summary["releases"])
+        self.assertEquals(26, summary["makespan"])
+
+        # With one slave, the retry is released max_count times before the
+        # slave's retry cache lets it run there.
+        sim = simulator.Simulator(num_slaves=1, download_secs=3, cached_download_secs=1)
+        summary = sim.run(tasks).summary()
+        self.assertEquals(10, summary["releases"])
+        self.assertEquals(13 + 10 * 5 + 11, summary["makespan"])
+
+    def test_fair_share(self):
+        big = [simulator.SimTask("big", "big-%d" % i, "big-%d" % i, 10) for i in xrange(100)]
+        small = [simulator.SimTask("small", "small-%d" % i, "small-%d" % i, 10, submit_time=5)
+                 for i in xrange(4)]
+        def small_job_makespan(**kwargs):
+            result = simulator.Simulator(num_slaves=2, **kwargs).run(big + small)
+            return max(end for (job_id, _), attempts in result.attempts.iteritems()
+                       for _, _, end, _ in attempts if job_id == "small") - 5
+        # Without fair share, the small job waits for the whole big job.
+        self.assertEquals(515, small_job_makespan(fair_share=False))
+        # With it, the small job gets one of the two slaves.
+        self.assertEquals(45, small_job_makespan())
+
+class TestFairShare(unittest.TestCase):
+
+    def test_assign_priorities(self):
+        base = dist_test.DEFAULT_PRIORITY
+        fair_share = dist_test.FairShare({"light": 0.5})
+        self.assertEquals([base, base + 10, base + 20],
+                          fair_share.assign_priorities("a", [10, 10, 10], None))
+        # A new flow starts at the head of the queue, interleaved with "a"
+        self.assertEquals([base, base + 5],
+                          fair_share.assign_priorities("b", [5, 5], base))
+        # More work for "a" queues behind its earlier tasks.
+        self.assertEquals([base + 30], fair_share.assign_priorities("a", [10], base + 10))
+        # Lighter flows advance faster.
+        self.assertEquals([base + 10, base + 30],
+                          fair_share.assign_priorities("light", [10, 10], base + 10))
+        # Once the queue empties, everyone starts afresh.
+        self.assertEquals([base], fair_share.assign_priorities("a", [10], None))
+
+    def test_priority_classes(self):
+        interactive = dist_test.class_base_priority("interactive")
+        precommit = dist_test.class_base_priority("precommit")
+        fair_share = dist_test.FairShare(base_priority=precommit,
+                                         max_priority=precommit + 99)
+        # Tags stay within the band of their class.
+        self.assertEquals([precommit, precommit + 99],
+                          fair_share.assign_priorities("a", [200, 10], None))
+        self.assertTrue(precommit + 99 < dist_test.class_base_priority("nightly"))
+        # Retries go ahead of new tasks of their class, but not of more urgent ones.
+        retry = dist_test.retry_priority(1, "precommit")
+        self.assertTrue(interactive < retry < precommit)
+        self.assertEquals(dist_test.retry_priority(1), dist_test.DEFAULT_PRIORITY - 1000)
+
+    def test_assign_affinity(self):
+        tasks = [dist_test.Task(dict(job_id="job", task_id="%s.%d" % (h * 40, i),
+                                     isolate_hash=h * 40, description=h + "-test"))
+                 for i, h in enumerate("aaaab")]
+        warm_slaves = {"a" * 40: ["host1.0", "host2.0"]}
+        # Each warm slave gets work until it has 30 seconds of it.
+        self.assertEquals(["host1.0", "host2.0", "host1.0", None, None],
+                          dist_test.assign_affinity(tasks, [20, 40, 20, 10, 10], warm_slaves, 30))
+        self.assertEquals([None] * 5, dist_test.assign_affinity(tasks, [10] * 5, {}, 30))
+        # The budget holds across the chunks of a job.
+        assigned = {}
+        self.assertEquals(["host1.0", "host2.0"],
+                          dist_test.assign_affinity(tasks[:2], [20, 40], warm_slaves, 30, assigned))
+        self.assertEquals(["host1.0", None, None],
+                          dist_test.assign_affinity(tasks[2:], [20, 10, 10], warm_slaves, 30,
+                                                    assigned))
+        self.assertEquals({"host1.0": 40, "host2.0": 40}, assigned)
+
 if __name__ == "__main__":
     unittest.main()